@@ -1,24 +1,43 @@
+import asyncio
+import functools
 import json
+import time
 
+import ujson
 import uvicorn
 import aioredis
 import aiohttp
 
 from starlette.applications import Starlette
-from starlette.responses import PlainTextResponse, Response, JSONResponse
+from starlette.responses import Response, PlainTextResponse, JSONResponse, StreamingResponse
 from starlette.endpoints import HTTPEndpoint
 from starlette.templating import Jinja2Templates
 from starlette.background import BackgroundTask
 
 from updater.authority_updater import AuthorityUpdater
-from updater.background_tasks import do_authority_update
+from updater.updater_state import AuthorityUpdaterState
+from updater.background_tasks import do_authority_update, run_authority_update_scheduler
 from objects.bib import BibliographicRecordsChunk
 from objects.authority import AuthorityRecordsChunk
-from objects.polona_lod import PolonaLodRecord
+from objects.polona_lod import PolonaLodRecord, create_polona_lod_jsons_batch
 from utils.marc_utils import normalize_nlp_id_bib, convert_nlp_id_auth_to_sierra_format
+from utils.cache_utils import authority_int_cache, authority_ext_cache, upstream_response_cache, mget_with_cache
+from utils.cache_utils import normalize_query
+from utils.single_flight_utils import SingleFlight
+from utils.serialization_utils import decode_authority_value
+from utils.authority_records_utils import AUTHORITY_RECORDS_MEDIA_TYPES, open_authority_records_store
+from utils.authority_records_utils import convert_raw_authority_records
+from utils.metrics_utils import metrics, set_request_labels, timed_endpoint, render_metrics, METRICS_KEY
+from utils.metrics_utils import run_metrics_flusher, flush_metrics
+from utils.executor_utils import run_cpu_bound, shutdown_cpu_executor
 
 from applog.utils import read_logging_config, setup_logging
 from config.base_url_config import IS_LOCAL, LOC_HOST, LOC_PORT, PROD_HOST, PROD_PORT
+from config.redis_config import AUTHORITY_INDEX_DB, EXTERNAL_IDS_INDEX_DB, STATE_DB, POLONA_LOD_DB
+from config.updater_config import UPDATER_SCHEDULER_ENABLED, UPDATER_SCHEDULE_INTERVAL
+from config.polona_lod_config import POLONA_LOD_BATCH_MAX_IDS, POLONA_LOD_BATCH_CONCURRENCY
+from config.authority_records_config import AUTHORITY_RECORDS_MAX_IDS
+from config.metrics_config import METRICS_FLUSH_INTERVAL
 
 
 # setup logging
@@ -30,6 +49,9 @@ setup_logging(logconfig_dict)
 templates = Jinja2Templates(directory='templates')
 app = Starlette(debug=False, template_directory='templates')
 
+# coalesces identical concurrent requests (per worker)
+single_flight = SingleFlight()
+
 
 @app.on_event("startup")
 async def startup():
@@ -40,8 +62,16 @@ async def startup():
     # setup async redis connection pools
     global conn_auth_int
     global conn_auth_ext
-    conn_auth_int = await aioredis.create_redis_pool('redis://localhost', db=8, encoding='utf-8', maxsize=50)
-    conn_auth_ext = await aioredis.create_redis_pool('redis://localhost', db=9, encoding='utf-8', maxsize=50)
+    conn_auth_int = await aioredis.create_redis_pool('redis://localhost', db=AUTHORITY_INDEX_DB,
+                                                     encoding='utf-8', maxsize=50)
+    conn_auth_ext = await aioredis.create_redis_pool('redis://localhost', db=EXTERNAL_IDS_INDEX_DB,
+                                                     encoding='utf-8', maxsize=50)
+    global conn_polona_lod
+    conn_polona_lod = await aioredis.create_redis_pool('redis://localhost', db=POLONA_LOD_DB,
+                                                       encoding='utf-8', maxsize=50)
+    global conn_state
+    conn_state = await aioredis.create_redis_pool('redis://localhost', db=STATE_DB,
+                                                  encoding='utf-8', maxsize=5)
 
     # setup async aiohttp connection pool
     global aiohttp_connector
@@ -49,10 +79,41 @@ async def startup():
     global aiohttp_session
     aiohttp_session = aiohttp.ClientSession(connector=aiohttp_connector)
 
+    # full authority records from local authorities dump (None if dump or its offsets index is not available)
+    global authority_records_store
+    authority_records_store = open_authority_records_store()
+
     # create updaters and updater_status
     global auth_updater
     auth_updater = AuthorityUpdater()
 
+    # schedule incremental updates (lock in redis lets only one worker update at a time)
+    global auth_update_scheduler
+    auth_update_scheduler = None
+    if UPDATER_SCHEDULER_ENABLED:
+        auth_update_scheduler = asyncio.ensure_future(
+            run_authority_update_scheduler(auth_updater, aiohttp_session, conn_auth_int, conn_state,
+                                           UPDATER_SCHEDULE_INTERVAL, conn_polona_lod))
+
+    # metrics of this worker are periodically added to totals of all workers in redis (see /metrics)
+    global metrics_flusher
+    metrics_flusher = asyncio.ensure_future(run_metrics_flusher(metrics, conn_state, METRICS_FLUSH_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if auth_update_scheduler:
+        auth_update_scheduler.cancel()
+
+    # changes since the last flush are not lost
+    metrics_flusher.cancel()
+    await flush_metrics(metrics, conn_state)
+
+    if authority_records_store:
+        authority_records_store.close()
+
+    shutdown_cpu_executor()
+
 
 # homepage
 @app.route('/')
@@ -60,71 +121,142 @@ async def homepage(request):
     return templates.TemplateResponse('docs.html', {'request': request})
 
 
+async def stream_records_chunk(chunk_class, query_params, identifier_type):
+    # chunk object is created inside the shared stream (single flight), so every flight fetches, parses
+    # and enriches its own page - stream_output_xml() of the object can be consumed only once
+    chunk_object = await chunk_class(aiohttp_session, conn_auth_int, conn_auth_ext, query_params, identifier_type,
+                                     stream=True)
+    async for part in chunk_object.stream_output_xml():
+        yield part
+
+
 # bibs
 # chunk of bibs - data.bn.org.pl wrapper - main endpoint
 @app.route('/api/{identifier_type}/bibs')
 class BibsChunkEnrichedWithIds(HTTPEndpoint):
     async def get(self, request):
-        bib_chunk_object = await BibliographicRecordsChunk(aiohttp_session,
-                                                           conn_auth_int,
-                                                           conn_auth_ext,
-                                                           request.query_params,
-                                                           request.path_params['identifier_type'])
-        resp_content = bib_chunk_object.xml_processed_chunk
+        start = time.perf_counter()
+        identifier_type = request.path_params['identifier_type']
+        set_request_labels('bibs', identifier_type)
+        # identical concurrent requests share one fetched, parsed and enriched page
+        # (for_omnis is part of the query)
+        data_bn_query = normalize_query(BibliographicRecordsChunk.create_query_for_data_bn(request.query_params))
+        flight_key = ('bibs', data_bn_query, identifier_type)
 
-        return Response(resp_content, media_type='application/xml')
+        # response is streamed - nextPage is sent first, then every enriched record
+        output_xml = single_flight.stream(flight_key, functools.partial(
+            stream_records_chunk, BibliographicRecordsChunk, request.query_params, identifier_type))
+        return StreamingResponse(metrics.time_stream(output_xml, start), media_type='application/xml')
 
 
 @app.route('/api/{identifier_type}/authorities')
 class AuthoritiesChunkEnrichedWithIds(HTTPEndpoint):
     async def get(self, request):
-        authorities_chunk_object = await AuthorityRecordsChunk(aiohttp_session,
-                                                               conn_auth_int,
-                                                               conn_auth_ext,
-                                                               request.query_params,
-                                                               request.path_params['identifier_type'])
-        resp_content = authorities_chunk_object.xml_processed_chunk
+        start = time.perf_counter()
+        identifier_type = request.path_params['identifier_type']
+        set_request_labels('authorities', identifier_type)
+        # identical concurrent requests share one fetched, parsed and enriched page
+        # (for_omnis is part of the query)
+        data_bn_query = normalize_query(AuthorityRecordsChunk.create_query_for_data_bn(request.query_params))
+        flight_key = ('authorities', data_bn_query, identifier_type)
 
-        return Response(resp_content, media_type='application/xml')
+        # response is streamed - nextPage is sent first, then every enriched record
+        output_xml = single_flight.stream(flight_key, functools.partial(
+            stream_records_chunk, AuthorityRecordsChunk, request.query_params, identifier_type))
+        return StreamingResponse(metrics.time_stream(output_xml, start), media_type='application/xml')
 
 
 # authorities
 # returns authorities with internal and external ids endpoint (single or more) in json
 @app.route('/api/authorities/{authority_ids}')
 class AuthoritiesChunkWithExternalIds(HTTPEndpoint):
+    @timed_endpoint('authorities-ids')
     async def get(self, request):
         authority_ids = [auth_id for auth_id in request.path_params['authority_ids'].split(',')]
-        resp = await conn_auth_int.mget(*authority_ids)
+        resp = await mget_with_cache(conn_auth_int, authority_ids, authority_int_cache, decode_authority_value)
 
         joined_dict = {}
-        for auth, auth_ids in zip(authority_ids, resp):
+        for auth in authority_ids:
+            auth_ids = resp.get(auth)
             if auth_ids:
-                joined_dict.setdefault(auth, {}).setdefault('ids_from_internal', {}).update(json.loads(auth_ids))
+                joined_dict.setdefault(auth, {}).setdefault('ids_from_internal', {}).update(auth_ids)
             else:
                 joined_dict.setdefault(auth, {}).setdefault('ids_from_internal', None)
 
         authority_ids_transformed_to_sierra_format = {auth_id: convert_nlp_id_auth_to_sierra_format(auth_id) for auth_id in authority_ids}
-        resp_2 = await conn_auth_ext.mget(*list(authority_ids_transformed_to_sierra_format.values()))
+        resp_2 = await mget_with_cache(conn_auth_ext, authority_ids_transformed_to_sierra_format.values(),
+                                       authority_ext_cache, json.loads)
 
-        for auth, auth_ids in zip(list(authority_ids_transformed_to_sierra_format.keys()), resp_2):
+        for auth, auth_id_sierra in authority_ids_transformed_to_sierra_format.items():
+            auth_ids = resp_2.get(auth_id_sierra)
             if auth_ids:
-                joined_dict.setdefault(auth, {}).setdefault('ids_from_external', {}).update(json.loads(auth_ids))
+                joined_dict.setdefault(auth, {}).setdefault('ids_from_external', {}).update(auth_ids)
             else:
                 joined_dict.setdefault(auth, {}).setdefault('ids_from_external', None)
 
         return JSONResponse(joined_dict)
 
 
+# returns full authority records (single or more) from local authorities dump
+# format: json (default), marcxml or marc
+@app.route('/api/authority-records/{authority_ids}')
+class AuthorityRecords(HTTPEndpoint):
+    @timed_endpoint('authority-records')
+    async def get(self, request):
+        output_format = request.query_params.get('format', 'json')
+        if output_format not in AUTHORITY_RECORDS_MEDIA_TYPES:
+            return PlainTextResponse(f'Dostępne formaty: {", ".join(AUTHORITY_RECORDS_MEDIA_TYPES)}.',
+                                     status_code=400)
+
+        raw_authority_ids = request.path_params['authority_ids'].split(',')
+        authority_ids = list(dict.fromkeys(auth_id.strip() for auth_id in raw_authority_ids if auth_id.strip()))
+        if len(authority_ids) > AUTHORITY_RECORDS_MAX_IDS:
+            return PlainTextResponse(f'Maksymalna liczba identyfikatorów: {AUTHORITY_RECORDS_MAX_IDS}.',
+                                     status_code=400)
+
+        if not authority_records_store:
+            return PlainTextResponse('Pełne rekordy wzorcowe są niedostępne.', status_code=503)
+
+        raw_records = await authority_records_store.get_raw_records(authority_ids)
+        if output_format != 'json' and not any(raw_records.values()):
+            return PlainTextResponse('Nie znaleziono rekordów.', status_code=404)
+
+        body = await run_cpu_bound(convert_raw_authority_records, raw_records, output_format)
+        return Response(body, media_type=AUTHORITY_RECORDS_MEDIA_TYPES[output_format])
+
+
 # polona-lod
+async def get_live_polona_lod_record(bib_nlp_id: str) -> PolonaLodRecord:
+    return await single_flight.do(('polona-lod', bib_nlp_id),
+                                  lambda: PolonaLodRecord(bib_nlp_id, aiohttp_session, conn_auth_int, conn_auth_ext))
+
+
+async def get_polona_lod_response(bib_nlp_id: str, version: str) -> Response:
+    # precomputed document (see run_polona_lod_indexer.py) is served as is, live computation is the fallback
+    # (documents affected by authority updates are removed by the updater until recomputed)
+    precomputed_json = await conn_polona_lod.hget(bib_nlp_id, version)
+    if precomputed_json is not None:
+        return Response(precomputed_json, media_type='application/json')
+
+    polona_back = await get_live_polona_lod_record(bib_nlp_id)
+    return JSONResponse(polona_back.get_json() if version == 'v1' else polona_back.get_json_v2())
+
+
 # html endpoint for polona.pl
 # aggregates authority external ids for single bib record
 # and presents them with some additional context from NLP descriptors
 @app.route('/polona-lod/{bib_nlp_id}')
 class PolonaLodFront(HTTPEndpoint):
+    @timed_endpoint('polona-lod-front', 'all_ids')
     async def get(self, request):
         bib_nlp_id = normalize_nlp_id_bib(request.path_params['bib_nlp_id'])
-        polona_back = await PolonaLodRecord(bib_nlp_id, aiohttp_session, conn_auth_int, conn_auth_ext)
-        polona_json = polona_back.get_json()
+
+        precomputed_json = await conn_polona_lod.hget(bib_nlp_id, 'v1')
+        if precomputed_json is not None:
+            polona_json = ujson.loads(precomputed_json)
+        else:
+            polona_json = (await get_live_polona_lod_record(bib_nlp_id)).get_json()
+
         return templates.TemplateResponse('polona-lod.html', {'request': request,
                                                               'bib_nlp_id': bib_nlp_id,
                                                               'polona_json': polona_json})
@@ -133,21 +265,71 @@ class PolonaLodFront(HTTPEndpoint):
 # json endpoint for polona.pl
 @app.route('/api/polona-lod/{bib_nlp_id}')
 class PolonaLodAPI(HTTPEndpoint):
+    @timed_endpoint('polona-lod', 'all_ids')
     async def get(self, request):
         bib_nlp_id = normalize_nlp_id_bib(request.path_params['bib_nlp_id'])
-        polona_back = await PolonaLodRecord(bib_nlp_id, aiohttp_session, conn_auth_int, conn_auth_ext)
-        polona_json = polona_back.get_json()
-        return JSONResponse(polona_json)
+        return await get_polona_lod_response(bib_nlp_id, 'v1')
 
 
 # json endpoint for polona.pl v2
 @app.route('/api/v2/polona-lod/{bib_nlp_id}')
 class PolonaLodV2API(HTTPEndpoint):
+    @timed_endpoint('polona-lod-v2', 'all_ids')
     async def get(self, request):
         bib_nlp_id = normalize_nlp_id_bib(request.path_params['bib_nlp_id'])
-        polona_back = await PolonaLodRecord(bib_nlp_id, aiohttp_session, conn_auth_int, conn_auth_ext)
-        polona_json = polona_back.get_json_v2()
-        return JSONResponse(polona_json)
+        return await get_polona_lod_response(bib_nlp_id, 'v2')
+
+
+# batch json endpoint for polona.pl v2 (results lists)
+# bib ids: comma separated in path (GET) or json list in body (POST)
+@app.route('/api/v2/polona-lod-batch/{bib_nlp_ids}')
+@app.route('/api/v2/polona-lod-batch', methods=['POST'])
+class PolonaLodV2BatchAPI(HTTPEndpoint):
+    @timed_endpoint('polona-lod-batch', 'all_ids')
+    async def get(self, request):
+        return await self.get_batch_response(request.path_params['bib_nlp_ids'].split(','))
+
+    @timed_endpoint('polona-lod-batch', 'all_ids')
+    async def post(self, request):
+        try:
+            bib_nlp_ids = await request.json()
+        except ValueError:
+            bib_nlp_ids = None
+
+        if not isinstance(bib_nlp_ids, list) or not all(isinstance(bib_nlp_id, str) for bib_nlp_id in bib_nlp_ids):
+            return PlainTextResponse('Oczekiwano listy identyfikatorów w formacie json.', status_code=400)
+
+        return await self.get_batch_response(bib_nlp_ids)
+
+    @staticmethod
+    async def get_batch_response(raw_bib_nlp_ids):
+        bib_nlp_ids = list(dict.fromkeys(normalize_nlp_id_bib(bib_nlp_id.strip())
+                                         for bib_nlp_id in raw_bib_nlp_ids if bib_nlp_id.strip()))
+        if len(bib_nlp_ids) > POLONA_LOD_BATCH_MAX_IDS:
+            return PlainTextResponse(f'Maksymalna liczba identyfikatorów: {POLONA_LOD_BATCH_MAX_IDS}.',
+                                     status_code=400)
+
+        # precomputed documents of all records in single round trip
+        pipe = conn_polona_lod.pipeline()
+        for bib_nlp_id in bib_nlp_ids:
+            pipe.hget(bib_nlp_id, 'v2')
+        serialized_jsons = dict(zip(bib_nlp_ids, await pipe.execute()))
+
+        # the rest is computed live, all together
+        missing_bib_nlp_ids = [bib_nlp_id for bib_nlp_id, serialized_json in serialized_jsons.items()
+                               if serialized_json is None]
+        if missing_bib_nlp_ids:
+            converted_jsons = await create_polona_lod_jsons_batch(missing_bib_nlp_ids, aiohttp_session,
+                                                                  conn_auth_int, conn_auth_ext,
+                                                                  POLONA_LOD_BATCH_CONCURRENCY)
+            for bib_nlp_id, converted_json in converted_jsons.items():
+                converted_json_v2 = PolonaLodRecord.convert_polona_json_to_v2(converted_json)
+                serialized_jsons[bib_nlp_id] = ujson.dumps(converted_json_v2, ensure_ascii=False,
+                                                           escape_forward_slashes=False)
+
+        # documents are already serialized - response body is joined from them
+        body = ','.join(f'{ujson.dumps(bib_nlp_id)}:{serialized_jsons[bib_nlp_id]}' for bib_nlp_id in bib_nlp_ids)
+        return Response(f'{{{body}}}', media_type='application/json')
 
 
 # updater
@@ -155,10 +337,11 @@ class PolonaLodV2API(HTTPEndpoint):
 @app.route('/updater/authorities')
 class IndexUpdater(HTTPEndpoint):
     async def get(self, request):
-        if auth_updater.update_in_progress:
+        if await AuthorityUpdaterState(conn_state).is_update_in_progress():
             return PlainTextResponse("Aktualizacja w toku. Spróbuj za chwilę.")
         else:
-            task = BackgroundTask(do_authority_update, auth_updater, aiohttp_session, conn_auth_int)
+            task = BackgroundTask(do_authority_update, auth_updater, aiohttp_session, conn_auth_int, conn_state,
+                                  conn_polona_lod)
             return PlainTextResponse("Rozpoczęto aktualizację.", background=task)
 
 
@@ -166,8 +349,33 @@ class IndexUpdater(HTTPEndpoint):
 @app.route('/updater/status/')
 class UpdaterStatusView(HTTPEndpoint):
     async def get(self, request):
-        return JSONResponse({'update_in_progress': auth_updater.update_in_progress,
-                             'last_update': str(auth_updater.last_auth_update)})
+        # status is shared by all workers
+        updater_state = AuthorityUpdaterState(conn_state)
+        last_update = await updater_state.get_last_update() or auth_updater.last_auth_update
+        return JSONResponse({'update_in_progress': await updater_state.is_update_in_progress(),
+                             'last_update': str(last_update)})
+
+
+# cache
+# get in-process cache status (per worker)
+@app.route('/cache/status/')
+class CacheStatusView(HTTPEndpoint):
+    async def get(self, request):
+        return JSONResponse({'authority_int_cache': authority_int_cache.get_stats(),
+                             'authority_ext_cache': authority_ext_cache.get_stats(),
+                             'upstream_response_cache': upstream_response_cache.get_stats(),
+                             'single_flight': single_flight.get_stats()})
+
+
+# metrics
+# per-stage durations and counters of all workers in prometheus text format
+@app.route('/metrics')
+class MetricsView(HTTPEndpoint):
+    async def get(self, request):
+        # metrics of this worker are flushed first, the rest is at most METRICS_FLUSH_INTERVAL old
+        await metrics.flush(conn_state)
+        totals = await conn_state.hgetall(METRICS_KEY)
+        return PlainTextResponse(render_metrics(totals), media_type='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
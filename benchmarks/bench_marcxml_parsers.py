@@ -0,0 +1,55 @@
+import argparse
+import io
+import time
+from pathlib import Path
+
+from pymarc import MARCReader, marcxml
+
+from pymarc_patches.parser_backends import PARSER_BACKENDS
+
+
+PATH_TO_TEST_DATA = Path.cwd() / 'nlp_database' / 'test'
+
+
+def create_data_bn_response(path_to_test_file: Path) -> bytes:
+    # convert test .mrc file to marcxml page in data.bn.org.pl format
+    with open(path_to_test_file, 'rb') as fp:
+        records = [marcxml.record_to_xml(rcd, namespace=True) for rcd in
+                   MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore', permissive=True) if rcd]
+
+    return b''.join([b'<resp><nextPage>http://data.bn.org.pl/api/bibs.marcxml?sinceId=1&amp;limit=100</nextPage>'
+                     b'<collection>',
+                     *records,
+                     b'</collection></resp>'])
+
+
+def benchmark_backend(backend: str, content: bytes, repeat: int) -> float:
+    parse = PARSER_BACKENDS[backend]
+    records_count = 0
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        next_page, records = parse(io.BytesIO(content), normalize_form='NFC')
+        records_count += len(records)
+    elapsed = time.perf_counter() - start
+
+    return records_count / elapsed
+
+
+def main(repeat: int) -> None:
+    for path_to_test_file in sorted(PATH_TO_TEST_DATA.glob('*.mrc')):
+        content = create_data_bn_response(path_to_test_file)
+        results = {backend: benchmark_backend(backend, content, repeat) for backend in PARSER_BACKENDS}
+
+        print(f'{path_to_test_file.name} ({len(content)} bytes, {repeat} repeats):')
+        for backend, records_per_sec in results.items():
+            print(f'  {backend:>10}: {records_per_sec:10.0f} records/sec '
+                  f'(x{records_per_sec / results["sax"]:.2f} vs sax)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark marcxml parser backends on nlp_database/test data.')
+    parser.add_argument('--repeat', type=int, default=50, help='number of parses per backend and file')
+    args = parser.parse_args()
+
+    main(args.repeat)
@@ -0,0 +1,9 @@
+# constants for local full authority records (served from authorities dump by nlp_id)
+from pathlib import Path
+
+# authorities dump and its nlp_id -> (offset, length) index (see run_indexer.py)
+PATH_TO_AUTHORITY_RECORDS = Path.cwd() / 'nlp_database' / 'production' / 'authorities-all.marc'
+PATH_TO_AUTHORITY_RECORDS_OFFSETS = Path.cwd() / 'nlp_database' / 'production' / 'authorities-all-offsets.db'
+
+# authority records endpoint: maximal number of ids in single request
+AUTHORITY_RECORDS_MAX_IDS = 100
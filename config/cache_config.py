@@ -0,0 +1,26 @@
+# constants for in-process (per worker) caches
+
+# authority index lookups (redis db=8, keyed by normalized heading and by nlp_id)
+AUTHORITY_INT_CACHE_MAX_SIZE = 50000
+AUTHORITY_INT_CACHE_TTL = 3600  # seconds
+# generation of authority index (changed by every update and by rebuild) - kept in the index db itself,
+# so it's read in the same MGET as cached keys; when it changes, caches of all workers are cleared
+# (key can't collide with normalized headings - upper case - nor with nlp_ids)
+AUTHORITY_INDEX_GENERATION_KEY = 'meta:generation'
+
+# external ids lookups (redis db=9, keyed by nlp_id in sierra format)
+AUTHORITY_EXT_CACHE_MAX_SIZE = 50000
+AUTHORITY_EXT_CACHE_TTL = 3600  # seconds
+# generation of external ids index (changed by rebuild, see AUTHORITY_INDEX_GENERATION_KEY)
+# (key can't collide with nlp_ids)
+EXTERNAL_IDS_INDEX_GENERATION_KEY = 'meta:generation'
+
+# memoized normalized names (prepare_name_for_indexing)
+NORMALIZED_NAMES_CACHE_MAX_SIZE = 100000
+
+# data.bn.org.pl response bodies (marcxml pages and single marc records), keyed by normalized query
+UPSTREAM_CACHE_MAX_BYTES = 128 * 1024 * 1024
+UPSTREAM_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024  # larger responses are not cached
+UPSTREAM_CACHE_TTL = 300  # seconds
+# revalidate expired entries with If-None-Match/If-Modified-Since (if upstream sent ETag/Last-Modified)
+UPSTREAM_CACHE_REVALIDATE = True
@@ -0,0 +1,13 @@
+# constants for executor of cpu-bound steps (marc parsing and serialization)
+
+# 'process' - process pool (event loop and parsing don't share GIL)
+# 'thread' - thread pool (no pickling, but parsing still holds GIL most of the time)
+# None - run on the event loop (old behaviour)
+CPU_EXECUTOR_KIND = 'process'
+
+# number of pool workers per app worker
+CPU_EXECUTOR_MAX_WORKERS = 2
+
+# number of records serialized in one executor call, while streaming response
+# (every slice is sent as soon as it's ready)
+SERIALIZATION_SLICE_SIZE = 5
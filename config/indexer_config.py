@@ -91,3 +91,17 @@ FIELDS_TO_CHECK_FOR_OMNIS = [('100', ['a', 'b', 'c', 'd']),
 # authority record fields (types of records) to index
 
 AUTHORITY_INDEX_FIELDS = ['100', '110', '111', '130', '148', '150', '151', '155']
+
+# number of authority records in single batch passed to indexer worker process
+INDEXER_BATCH_SIZE = 5000
+
+# bulk loading to redis: number of keys in single MSET and number of MSETs sent in single pipeline
+REDIS_BULK_LOAD_CHUNK_SIZE = 1000
+REDIS_BULK_LOAD_CHUNKS_PER_PIPELINE = 10
+
+# number of bibliographic records resolved together while precomputing polona lod documents
+POLONA_LOD_CHUNK_SIZE = 500
+
+# offline enrichment of bibliographic dump (preprocess_dump_file.py):
+# number of bibliographic records in single batch passed to worker process (terms of the batch are sent in single MGET)
+PREPROCESS_BATCH_SIZE = 1000
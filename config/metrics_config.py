@@ -0,0 +1,10 @@
+# constants for metrics exposed on /metrics (see utils/metrics_utils.py)
+
+# every worker adds its metrics to totals in redis (STATE_DB) every interval seconds
+METRICS_FLUSH_INTERVAL = 5  # seconds
+
+# upper bounds of duration histogram buckets (seconds)
+METRICS_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# identifier types used as label values (other values from request path are labelled as 'other')
+METRICS_IDENTIFIER_TYPES = ('nlp_id', 'mms_id', 'all_ids')
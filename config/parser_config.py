@@ -0,0 +1,6 @@
+# constants for marcxml parser configuration
+
+# backend used for parsing data.bn.org.pl marcxml responses
+# 'iterparse' - ElementTree iterparse (expat + C tree builder), faster
+# 'sax' - xml.sax based XmlHandlerPatched
+MARCXML_PARSER_BACKEND = 'iterparse'
@@ -0,0 +1,17 @@
+# constants for polona lod endpoints
+
+# batch endpoint: maximal number of bib ids in single request
+POLONA_LOD_BATCH_MAX_IDS = 100
+# batch endpoint: maximal number of concurrent requests to data.bn.org.pl (per request)
+POLONA_LOD_BATCH_CONCURRENCY = 10
+
+# precomputed documents store (POLONA_LOD_DB): hash (v1, v2) per bib nlp_id and set of bib nlp_ids per
+# authority heading the documents were computed from (documents of headings changed by authority updater
+# are removed - served live - and added to stale set, see run_polona_lod_indexer.py --stale)
+POLONA_LOD_HEADING_KEY_PREFIX = 'heading:'
+POLONA_LOD_STALE_KEY = 'meta:stale'
+
+# precomputed documents expire - changes of bibliographic records in data.bn.org.pl are not tracked,
+# so document of changed record is served until it expires (or is recomputed with --bib-ids)
+# and then computed live (full rebuild should be run more often than that)
+POLONA_LOD_DOCUMENT_TTL = 7 * 24 * 60 * 60
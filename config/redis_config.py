@@ -0,0 +1,19 @@
+# constants for redis databases configuration
+
+# live indexes used by the app
+AUTHORITY_INDEX_DB = 8          # authority index (normalized heading / nlp_id -> internal ids)
+EXTERNAL_IDS_INDEX_DB = 9       # external ids index (nlp_id in sierra format -> external ids)
+
+# shadow databases - indexes are rebuilt here and swapped with live ones (SWAPDB) when complete
+AUTHORITY_INDEX_SHADOW_DB = 10
+EXTERNAL_IDS_INDEX_SHADOW_DB = 11
+
+# minimal ratio of keys in rebuilt (shadow) index to keys in live index required to swap them
+MIN_SHADOW_TO_LIVE_KEYS_RATIO = 0.9
+
+# app state shared between uvicorn workers (updater checkpoint, resume cursors and lock)
+STATE_DB = 12
+
+# precomputed polona lod documents (keyed by bib nlp_id) and its shadow db used during full rebuild
+POLONA_LOD_DB = 13
+POLONA_LOD_SHADOW_DB = 14
@@ -0,0 +1,19 @@
+# constants for authority updater configuration
+
+# number of parsed data.bn.org.pl pages fetched ahead of the one being applied to the index
+UPDATER_PREFETCH_DEPTH = 3
+
+# number of sub-ranges of updatedDate window fetched concurrently
+UPDATER_DATE_WINDOW_SPLITS = 4
+
+# built-in scheduler of incremental updates (runs in every worker, lock lets only one of them update at a time)
+UPDATER_SCHEDULER_ENABLED = True
+UPDATER_SCHEDULE_INTERVAL = 900  # seconds
+
+# updater lock expiry (refreshed by heartbeat during the whole update) - protects from lock left by killed worker
+UPDATER_LOCK_TTL = 600  # seconds
+UPDATER_LOCK_REFRESH_INTERVAL = 60  # seconds
+
+# incremental update window starts at the end of the last completed one (watermark) minus overlap
+# (records updated around the watermark are fetched again - applying them is idempotent)
+UPDATER_WATERMARK_OVERLAP = 300  # seconds
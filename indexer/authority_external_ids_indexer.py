@@ -1,12 +1,17 @@
-import itertools
 import logging
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, List, Optional, Tuple
 
 import redis
 
 from sqlite_clients.generic_client import GenericClient
+from config.cache_config import EXTERNAL_IDS_INDEX_GENERATION_KEY
+from config.redis_config import EXTERNAL_IDS_INDEX_DB
+from config.indexer_config import REDIS_BULK_LOAD_CHUNK_SIZE, REDIS_BULK_LOAD_CHUNKS_PER_PIPELINE
+from utils.cache_utils import new_index_generation
+from utils.indexer_utils import bulk_load_to_redis
 
 
 logger = logging.getLogger(__name__)
@@ -20,84 +25,58 @@ class AuthorityExternalIdsIndex(object):
         self.final_index = self.create_authority_external_ids_index()
 
     def create_authority_external_ids_index(self) -> dict:
-        indexes_to_join = []
+        # sources to join: (sqlite database file, column with external id, key name, id processing method)
+        sources = []
 
         if self.geonames:
             # geographic descriptors
-            path_to_geo_geonames_db = Path.cwd() / 'sql_databases' / 'geographic_geonames_bn_filtered.db'
-            geo_geonames_cl = GenericClient(str(path_to_geo_geonames_db),
-                                   'SELECT bn__descr_nlp_id, result__geonames_id, score, max_score FROM results',
-                                   'geonames_uri',
-                                   id_processing_method=create_geonames_uri)
-
-            geo_geonames_dict = geo_geonames_cl.create_index()
-            indexes_to_join.append(geo_geonames_dict)
+            sources.append(('geographic_geonames_bn_filtered.db', 'result__geonames_id', 'geonames_uri',
+                            create_geonames_uri))
 
         if self.wikidata:
             # geographic descriptors
-            path_to_geo_wikidata_db = Path.cwd() / 'sql_databases' / 'geographic_wikidata_bn_filtered.db'
-            geo_wikidata_cl = GenericClient(str(path_to_geo_wikidata_db),
-                                   'SELECT bn__descr_nlp_id, result__wkp_id, score, max_score FROM results',
-                                   'wikidata_uri',
-                                   id_processing_method=create_wikidata_uri)
-
-            geo_wikidata_dict = geo_wikidata_cl.create_index()
-            indexes_to_join.append(geo_wikidata_dict)
-
+            sources.append(('geographic_wikidata_bn_filtered.db', 'result__wkp_id', 'wikidata_uri',
+                            create_wikidata_uri))
             # personal descriptors
-            path_to_personal_wikidata_db = Path.cwd() / 'sql_databases' / 'personal_wikidata_bn.db'
-            personal_wikidata_cl = GenericClient(str(path_to_personal_wikidata_db),
-                                            'SELECT bn__descr_nlp_id, result__wkp_id, score, max_score FROM results',
-                                            'wikidata_uri',
-                                            id_processing_method=create_wikidata_uri)
-
-            personal_wikidata_dict = personal_wikidata_cl.create_index()
-            indexes_to_join.append(personal_wikidata_dict)
-
+            sources.append(('personal_wikidata_bn.db', 'result__wkp_id', 'wikidata_uri',
+                            create_wikidata_uri))
             # corporate descriptors
-            path_to_corporate_wikidata_db = Path.cwd() / 'sql_databases' / 'corporate_wikidata_bn_filtered.db'
-            corporate_wikidata_cl = GenericClient(str(path_to_corporate_wikidata_db),
-                                                 'SELECT bn__descr_nlp_id, result__wkp_id, score, max_score FROM results',
-                                                 'wikidata_uri',
-                                                 id_processing_method=create_wikidata_uri)
-
-            corporate_wikidata_dict = corporate_wikidata_cl.create_index()
-            indexes_to_join.append(corporate_wikidata_dict)
-
+            sources.append(('corporate_wikidata_bn_filtered.db', 'result__wkp_id', 'wikidata_uri',
+                            create_wikidata_uri))
             # subject descriptors
-            path_to_subject_wikidata_db = Path.cwd() / 'sql_databases' / 'subject_wikidata_bn.db'
-            subject_wikidata_cl = GenericClient(str(path_to_subject_wikidata_db),
-                                                  'SELECT bn__descr_nlp_id, result__wkp_id, score, max_score FROM results',
-                                                  'wikidata_uri',
-                                                  id_processing_method=create_wikidata_uri)
-
-            subject_wikidata_dict = subject_wikidata_cl.create_index()
-            indexes_to_join.append(subject_wikidata_dict)
-
+            sources.append(('subject_wikidata_bn.db', 'result__wkp_id', 'wikidata_uri',
+                            create_wikidata_uri))
             # genre descriptors
-            path_to_genre_wikidata_db = Path.cwd() / 'sql_databases' / 'genre_wikidata_bn.db'
-            genre_wikidata_cl = GenericClient(str(path_to_genre_wikidata_db),
-                                                'SELECT bn__descr_nlp_id, result__wkp_id, score, max_score FROM results',
-                                                'wikidata_uri',
-                                                id_processing_method=create_wikidata_uri)
-
-            genre_wikidata_dict = genre_wikidata_cl.create_index()
-            indexes_to_join.append(genre_wikidata_dict)
+            sources.append(('genre_wikidata_bn.db', 'result__wkp_id', 'wikidata_uri',
+                            create_wikidata_uri))
 
         if self.orcid:
             # personal descriptors
-            path_to_personal_orcid_db = Path.cwd() / 'sql_databases' / 'personal_orcid_bn.db'
-            personal_orcid_cl = GenericClient(str(path_to_personal_orcid_db),
-                                                'SELECT bn__descr_nlp_id, result__orcid_id, score, max_score FROM results',
-                                                'orcid_id',
-                                                id_processing_method=None)
+            sources.append(('personal_orcid_bn.db', 'result__orcid_id', 'orcid_id',
+                            None))
 
-            personal_orcid_dict = personal_orcid_cl.create_index()
-            indexes_to_join.append(personal_orcid_dict)
+        # sources are loaded in parallel threads (sqlite releases GIL while executing queries)
+        # and joined in the order above, so the result doesn't depend on which source finishes first
+        with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+            indexes_to_join = list(executor.map(self.create_index_from_source, sources))
 
         final_index = self.join_indexes(indexes_to_join)
         return final_index
 
+    @staticmethod
+    def create_index_from_source(source: Tuple[str, str, str, Optional[Callable[[str], str]]]) -> dict:
+        db_file_name, fetched_id_column, dict_key_name, id_processing_method = source
+        path_to_db = Path.cwd() / 'sql_databases' / db_file_name
+
+        client = GenericClient(str(path_to_db),
+                               fetched_id_column,
+                               dict_key_name,
+                               id_processing_method=id_processing_method)
+
+        index = client.create_index()
+        logger.info(f'Wczytano {db_file_name}: {len(index)} identyfikatorów.')
+        return index
+
     def get_ids(self, nlp_id: str) -> Optional[str]:
         return self.final_index.get(self.transform_nlp_id(nlp_id))
 
@@ -118,16 +97,18 @@ class AuthorityExternalIdsIndex(object):
 
         return final_dict
 
-    def index_in_redis(self):
-        r = redis.Redis(db=9)
+    def index_in_redis(self, db: int = EXTERNAL_IDS_INDEX_DB):
+        r = redis.Redis(db=db)
         r.flushdb()
 
-        chunk_max_size = 1000
-        keys_to_json = {k: json.dumps(v) for k, v in self.final_index.items()}
-        chunks = [dict(itertools.islice(keys_to_json.items(), i, i + chunk_max_size)) for i in range(0, len(keys_to_json), chunk_max_size)]
+        # serialize lazily and send straight to redis in pipelined chunks
+        keys_to_json = ((k, json.dumps(v)) for k, v in self.final_index.items())
+        bulk_load_to_redis(r, keys_to_json,
+                           chunk_size=REDIS_BULK_LOAD_CHUNK_SIZE,
+                           chunks_per_pipeline=REDIS_BULK_LOAD_CHUNKS_PER_PIPELINE)
 
-        for chunk in chunks:
-            r.mset(chunk)
+        # new index generation - caches of app workers are cleared when the rebuilt index is swapped in
+        r.set(EXTERNAL_IDS_INDEX_GENERATION_KEY, new_index_generation())
 
         r.close()
 
@@ -0,0 +1,49 @@
+import logging
+import os
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import redis
+
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY
+from config.redis_config import AUTHORITY_INDEX_DB
+from sqlite_clients.authority_index_snapshot import write_authority_index_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+
+def yield_authority_index_items(r, chunk_size: int = 1000) -> Iterator[Tuple[str, str]]:
+    # streams all (key, value) pairs from redis db - keys are scanned and values fetched in chunks
+    keys = []
+
+    for key in r.scan_iter(count=chunk_size):
+        keys.append(key)
+        if len(keys) >= chunk_size:
+            yield from ((k, v) for k, v in zip(keys, r.mget(*keys)) if v is not None)
+            keys = []
+
+    if keys:
+        yield from ((k, v) for k, v in zip(keys, r.mget(*keys)) if v is not None)
+
+
+def export_authority_index_snapshot(path_to_snapshot: Path, db: int = AUTHORITY_INDEX_DB) -> int:
+    logger.info(f'Rozpoczęto eksport indeksu rekordów wzorcowych (db={db}) do pliku {path_to_snapshot}...')
+
+    r = redis.Redis(db=db, decode_responses=True)
+
+    # snapshot is written to temporary file and renamed when complete, so readers never see partial snapshot
+    path_to_tmp = path_to_snapshot.with_name(path_to_snapshot.name + '.tmp')
+    if path_to_tmp.exists():
+        path_to_tmp.unlink()
+
+    # index generation is not an index entry
+    items = ((key, value) for key, value in yield_authority_index_items(r) if key != AUTHORITY_INDEX_GENERATION_KEY)
+    exported_count = write_authority_index_snapshot(str(path_to_tmp), items)
+    os.replace(path_to_tmp, path_to_snapshot)
+
+    r.close()
+
+    logger.info(f'Zakończono eksport indeksu rekordów wzorcowych. Wyeksportowano kluczy: {exported_count}.')
+
+    return exported_count
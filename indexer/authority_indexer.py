@@ -1,14 +1,17 @@
 import logging
-import ujson
+from multiprocessing import Pool
 from pathlib import Path
+from typing import List, Tuple
 
 from tqdm import tqdm
-from pymarc import MARCReader
 import redis
 
-from config.indexer_config import AUTHORITY_INDEX_FIELDS
-from utils.indexer_utils import get_nlp_id, get_mms_id, get_viaf_id, get_coordinates
-from utils.marc_utils import prepare_name_for_indexing
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY
+from config.indexer_config import INDEXER_BATCH_SIZE
+from config.redis_config import AUTHORITY_INDEX_DB
+from utils.cache_utils import new_index_generation
+from utils.indexer_utils import get_authority_index_entries, yield_record_batches
+from utils.mmap_marc_reader import MmapMARCReader
 
 
 logger = logging.getLogger(__name__)
@@ -17,122 +20,114 @@ logger_interfield_duplicates = logging.getLogger('logger_interfield_duplicates')
 PATH_TO_DB = Path.cwd() / 'nlp_database' / 'production' / 'authorities-all.marc'
 
 
-def flush_db() -> None:
-    r = redis.Redis(db=8)  # use db=8 to avoid conflicts with test local dev Redis instance
+def flush_db(db: int = AUTHORITY_INDEX_DB) -> None:
+    r = redis.Redis(db=db)  # use db=8 (or its shadow) to avoid conflicts with test local dev Redis instance
     r.flushdb()
     r.close()
 
 
-def create_authority_index(data: Path = PATH_TO_DB) -> None:
-    logger.info('Rozpoczęto indeksowanie rekordów wzorcowych...')
+def get_authority_index_entries_from_batch(batch: Tuple[str, int, int]) -> List[Tuple[str, dict, str]]:
+    # parses records from byte range of the file and extracts index entries (runs in worker process)
+    path_to_file, start, end = batch
+
+    with MmapMARCReader(path_to_file, start, end) as rdr:
+        entries = get_authority_index_entries(list(rdr))
+        if rdr.failed:
+            logger.warning(f'Pominięto uszkodzonych rekordów: {rdr.failed} (bajty {start}-{end}).')
+
+    return [entry for entry in entries if entry]
+
+
+def log_duplicate(descr_from_helper: dict, serialized_to_dict: dict, interfield: bool) -> None:
+    message = (f'Dublet: {descr_from_helper.get("heading")} - '
+               f'{descr_from_helper.get("heading_tag")} - '
+               f'{descr_from_helper.get("nlp_id")} - '
+               f'{descr_from_helper.get("mms_id")} || '
+               f'{serialized_to_dict.get("heading")} - '
+               f'{serialized_to_dict.get("heading_tag")} - '
+               f'{serialized_to_dict.get("nlp_id")} - '
+               f'{serialized_to_dict.get("mms_id")}.')
+
+    logger.error(message)
+    if interfield:
+        logger_interfield_duplicates.error(message)
+
+
+def merge_authority_entry(helper_dict: dict, heading_to_index: str, serialized_to_dict: dict) -> bool:
+    # checks if entry is not a duplicate using heading_tag and returns True if it should be indexed
+    # least desirable tag: 130
+    descr_from_helper = helper_dict.get(heading_to_index)
+    fld = serialized_to_dict.get('heading_tag')
+    nlp_id = serialized_to_dict.get('nlp_id')
+
+    if descr_from_helper:
+        if descr_from_helper.get('heading_tag') != '130' and fld == '130':
+            # if authority with the same heading is already indexed
+            # and the new one (currently processed) is 130 heading
+            # just skip it and log the event
+            log_duplicate(descr_from_helper, serialized_to_dict, interfield=True)
+            return False
+
+        else:
+            # if authority with the same heading is already indexed
+            # and the new one (currently processed) is not 130 heading
+            # log the event and do the usual job
+            # record will be normally processed and will overwrite the existing record
+            log_duplicate(descr_from_helper, serialized_to_dict,
+                          interfield=descr_from_helper.get('heading_tag') != fld)
+
+    helper_dict.update({heading_to_index: serialized_to_dict,
+                        nlp_id: serialized_to_dict})
+
+    return True
+
+
+def create_authority_index(data: Path = PATH_TO_DB, workers: int = 1, db: int = AUTHORITY_INDEX_DB) -> None:
+    logger.info(f'Rozpoczęto indeksowanie rekordów wzorcowych (procesy: {workers})...')
     authority_count = 0
 
-    r = redis.Redis(db=8)
+    r = redis.Redis(db=db)
 
     helper_dict = {}      # stores all authorities during initial indexing to disambiguate duplicates
     buff = {}             # used for batch indexing in Redis
 
-    with open(str(data), 'rb') as fp:
-        rdr = MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore', permissive=True)
-
-        for rcd in tqdm(rdr):
-            for fld in AUTHORITY_INDEX_FIELDS:
-                if fld in rcd:
-                    heading_full = rcd.get_fields(fld)[0].value()
-                    heading_to_index = prepare_name_for_indexing(heading_full)
-                    nlp_id = get_nlp_id(rcd)
-                    mms_id = get_mms_id(rcd)
-                    viaf_id = get_viaf_id(rcd)
-                    coordinates = get_coordinates(rcd)
-
-                    # heading_tag is used to disambiguate authority duplicates
-                    # if duplicate is detected, authorities with tag 130 are ignored
-                    serialized_to_dict = {'nlp_id': nlp_id,
-                                          'mms_id': mms_id,
-                                          'viaf_id': viaf_id,
-                                          'coords': coordinates,
-                                          'heading': heading_full,
-                                          'heading_tag': fld}
-
-                    serialized_to_json = ujson.dumps(serialized_to_dict, ensure_ascii=False)
-
-                    # check if not duplicate using heading_tag
-                    # least desirable tag: 130
-                    descr_from_helper = helper_dict.get(heading_to_index)
-
-                    if descr_from_helper:
-                        if descr_from_helper.get('heading_tag') != '130' and fld == '130':
-                            # if authority with the same heading is already indexed
-                            # and the new one (currently processed) is 130 heading
-                            # just skip it (break the loop) and log the event
-
-                            logger.error(f'Dublet: {descr_from_helper.get("heading")} - '
-                                         f'{descr_from_helper.get("heading_tag")} - '
-                                         f'{descr_from_helper.get("nlp_id")} - '
-                                         f'{descr_from_helper.get("mms_id")} || '
-                                         f'{heading_full} - '
-                                         f'{fld} - '
-                                         f'{nlp_id} - '
-                                         f'{mms_id}.')
-
-                            logger_interfield_duplicates.error(f'Dublet: {descr_from_helper.get("heading")} - '
-                                                               f'{descr_from_helper.get("heading_tag")} - '
-                                                               f'{descr_from_helper.get("nlp_id")} - '
-                                                               f'{descr_from_helper.get("mms_id")} || '
-                                                               f'{heading_full} - '
-                                                               f'{fld} - '
-                                                               f'{nlp_id} - '
-                                                               f'{mms_id}.')
-
-                            break  # breaks only the inner loop (searching for fields to index)
-
-                        else:
-                            # if authority with the same heading is already indexed
-                            # and the new one (currently processed) is not 130 heading
-                            # log the event and do the usual job
-                            # record will be normally processed and will overwrite the existing record
-
-                            logger.error(f'Dublet: {descr_from_helper.get("heading")} - '
-                                         f'{descr_from_helper.get("heading_tag")} - '
-                                         f'{descr_from_helper.get("nlp_id")} - '
-                                         f'{descr_from_helper.get("mms_id")} || '
-                                         f'{heading_full} - '
-                                         f'{fld} - '
-                                         f'{nlp_id} - '
-                                         f'{mms_id}.')
-
-                            if descr_from_helper.get('heading_tag') != fld:
-                                logger_interfield_duplicates.error(f'Dublet: {descr_from_helper.get("heading")} - '
-                                                                   f'{descr_from_helper.get("heading_tag")} - '
-                                                                   f'{descr_from_helper.get("nlp_id")} - '
-                                                                   f'{descr_from_helper.get("mms_id")} || '
-                                                                   f'{heading_full} - '
-                                                                   f'{fld} - '
-                                                                   f'{nlp_id} - '
-                                                                   f'{mms_id}.')
-
-                            helper_dict.update({heading_to_index: serialized_to_dict,
-                                                nlp_id: serialized_to_dict})
-
-                    else:
-                        helper_dict.update({heading_to_index: serialized_to_dict,
-                                            nlp_id: serialized_to_dict})
-
-                    buff.update({heading_to_index: serialized_to_json,
-                                 nlp_id: serialized_to_json})
-
-                    authority_count += 1
-                    break
-
-            if len(buff) > 1000:
-                # index records in chunks by 1000
-                r.mset(buff)
-                buff.clear()
+    # reader: splits file into batches of records by record length from leader
+    batches = yield_record_batches(str(data), INDEXER_BATCH_SIZE)
+
+    # parsing and field extraction is done in worker processes (if any),
+    # entries are merged in file order, so duplicates resolution is deterministic
+    pool = Pool(workers) if workers > 1 else None
+    entries_batches = pool.imap(get_authority_index_entries_from_batch, batches) if pool \
+        else map(get_authority_index_entries_from_batch, batches)
+
+    try:
+        with tqdm() as progress_bar:
+            for entries in entries_batches:
+                for heading_to_index, serialized_to_dict, serialized_to_json in entries:
+                    if merge_authority_entry(helper_dict, heading_to_index, serialized_to_dict):
+                        buff.update({heading_to_index: serialized_to_json,
+                                     serialized_to_dict.get('nlp_id'): serialized_to_json})
+                        authority_count += 1
+
+                    if len(buff) > 1000:
+                        # index records in chunks by 1000
+                        r.mset(buff)
+                        buff.clear()
+
+                progress_bar.update(len(entries))
 
         if buff:
             # index records remaining in buffer
             r.mset(buff)
 
+        # new index generation - caches of app workers are cleared when the rebuilt index is swapped in
+        r.set(AUTHORITY_INDEX_GENERATION_KEY, new_index_generation())
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
     r.close()
 
     logger.info(f'Zakończono indeksowanie rekordów wzorcowych. Zaindeksowano: {authority_count}.')
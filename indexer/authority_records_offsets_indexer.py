@@ -0,0 +1,39 @@
+import logging
+import os
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from config.authority_records_config import PATH_TO_AUTHORITY_RECORDS, PATH_TO_AUTHORITY_RECORDS_OFFSETS
+from sqlite_clients.authority_records_offsets import write_authority_records_offsets
+from utils.mmap_marc_reader import MmapMARCReader, get_raw_control_field
+
+
+logger = logging.getLogger(__name__)
+
+
+def yield_authority_records_offsets(rdr: MmapMARCReader) -> Iterator[Tuple[str, int, int]]:
+    # (nlp_id, offset, length) of every record - nlp_id is read from directory, records are not parsed
+    for ordinal in range(len(rdr)):
+        nlp_id = get_raw_control_field(rdr.get_raw(ordinal), '001')
+        if nlp_id:
+            start, end = rdr.get_byte_range(ordinal, ordinal + 1)
+            yield nlp_id, start, end - start
+
+
+def create_authority_records_offsets_index(data: Path = PATH_TO_AUTHORITY_RECORDS,
+                                           path_to_offsets: Path = PATH_TO_AUTHORITY_RECORDS_OFFSETS) -> int:
+    logger.info(f'Rozpoczęto indeksowanie położenia rekordów wzorcowych w pliku {data}...')
+
+    # index is written to temporary file and renamed when complete, so the app never sees partial index
+    path_to_tmp = path_to_offsets.with_name(path_to_offsets.name + '.tmp')
+    if path_to_tmp.exists():
+        path_to_tmp.unlink()
+
+    with MmapMARCReader(str(data)) as rdr:
+        indexed_count = write_authority_records_offsets(str(path_to_tmp), str(data),
+                                                        yield_authority_records_offsets(rdr))
+    os.replace(path_to_tmp, path_to_offsets)
+
+    logger.info(f'Zakończono indeksowanie położenia rekordów wzorcowych. Zaindeksowano: {indexed_count}.')
+
+    return indexed_count
@@ -0,0 +1,104 @@
+import logging
+from pathlib import Path
+from typing import Iterator, List, Optional, Set
+
+import aioredis
+from pymarc import MARCReader, Record
+from tqdm import tqdm
+
+from objects.polona_lod import create_polona_lod_documents
+from utils.polona_lod_store_utils import add_polona_lod_documents_to_pipeline, pop_stale_polona_lod_documents
+from config.indexer_config import POLONA_LOD_CHUNK_SIZE
+from config.polona_lod_config import POLONA_LOD_STALE_KEY
+from config.redis_config import AUTHORITY_INDEX_DB, EXTERNAL_IDS_INDEX_DB, POLONA_LOD_DB
+
+
+logger = logging.getLogger(__name__)
+
+PATH_TO_BIBS = Path.cwd() / 'nlp_database' / 'production' / 'bibs-all.marc'
+
+
+def yield_bib_chunks(data: Path, chunk_size: int, bib_ids: Optional[Set[str]] = None) -> Iterator[List[Record]]:
+    # reads bibliographic records from dump file in chunks (only records from bib_ids, if given)
+    chunk = []
+    if bib_ids is not None and not bib_ids:
+        return
+
+    with open(data, 'rb') as fp:
+        rdr = MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore', permissive=True)
+
+        for rcd in rdr:
+            # deleted records (leader/05 = d) have no documents
+            if not rcd or not rcd['001'] or rcd.leader[5] == 'd':
+                continue
+            if bib_ids is not None and rcd['001'].value() not in bib_ids:
+                continue
+
+            chunk.append(rcd)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
+
+async def create_polona_lod_store(data: Path = PATH_TO_BIBS, db: int = POLONA_LOD_DB,
+                                  bib_ids: Optional[Set[str]] = None, stale: bool = False,
+                                  chunk_size: int = POLONA_LOD_CHUNK_SIZE) -> int:
+    """
+    Precomputes documents of all records from dump, or only of records from bib_ids and/or marked as stale
+    by authority updater (incremental run in live db). In incremental run documents of records that are
+    not in the dump (or are deleted) are removed. Documents marked as stale again during the run are not written
+    (they stay in stale set for the next run).
+    """
+    logger.info(f'Rozpoczęto przygotowywanie dokumentów Polona LOD...')
+    documents_count = 0
+
+    conn_auth_int = await aioredis.create_redis_pool('redis://localhost', db=AUTHORITY_INDEX_DB, encoding='utf-8')
+    conn_auth_ext = await aioredis.create_redis_pool('redis://localhost', db=EXTERNAL_IDS_INDEX_DB, encoding='utf-8')
+    conn_polona_lod = await aioredis.create_redis_pool('redis://localhost', db=db, encoding='utf-8')
+
+    stale_bib_ids = set()
+    found_bib_ids = set()
+
+    try:
+        if stale:
+            stale_bib_ids = await pop_stale_polona_lod_documents(conn_polona_lod)
+            logger.info(f'Dokumentów do przeliczenia po aktualizacji rekordów wzorcowych: {len(stale_bib_ids)}.')
+            bib_ids = (bib_ids or set()) | stale_bib_ids
+
+        with tqdm() as progress_bar:
+            for chunk in yield_bib_chunks(data, chunk_size, bib_ids):
+                documents, headings = await create_polona_lod_documents(chunk, conn_auth_int, conn_auth_ext)
+
+                # documents of whole chunk are written in single round trip
+                pipe = conn_polona_lod.pipeline()
+                add_polona_lod_documents_to_pipeline(pipe, documents, headings)
+                await pipe.execute()
+
+                found_bib_ids.update(documents)
+                documents_count += len(documents)
+                progress_bar.update(len(chunk))
+
+        if bib_ids is not None:
+            # records deleted from the dump
+            deleted_bib_ids = bib_ids - found_bib_ids
+            if deleted_bib_ids:
+                await conn_polona_lod.delete(*deleted_bib_ids)
+                logger.info(f'Usunięto dokumentów rekordów usuniętych: {len(deleted_bib_ids)}.')
+
+    except Exception:
+        # stale documents, which were not recomputed, are left for the next run
+        not_recomputed_bib_ids = stale_bib_ids - found_bib_ids
+        if not_recomputed_bib_ids:
+            await conn_polona_lod.sadd(POLONA_LOD_STALE_KEY, *not_recomputed_bib_ids)
+        raise
+
+    finally:
+        for conn in [conn_auth_int, conn_auth_ext, conn_polona_lod]:
+            conn.close()
+            await conn.wait_closed()
+
+    logger.info(f'Zakończono przygotowywanie dokumentów Polona LOD. Zapisano: {documents_count}.')
+    return documents_count
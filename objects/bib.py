@@ -1,33 +1,35 @@
 from typing import Optional
-import io
 from asyncinit import asyncinit
 
-import xml.etree.ElementTree as ET
 from xml.sax.saxutils import escape
 
-from pymarc import marcxml
-from pymarc_patches.xml_handler_patch import parse_xml_to_array_patched
+from pymarc_patches.parser_backends import parse_marcxml_bytes
 
-from utils.marc_utils import process_record
+from utils.marc_utils import process_records_chunk, records_to_marcxml, stream_records_to_marcxml
+from utils.executor_utils import run_cpu_bound
+from utils.cache_utils import get_with_cache, upstream_response_cache
+from utils.metrics_utils import metrics
 from config.base_url_config import IS_LOCAL, LOC_HOST, LOC_PORT, PROD_HOST
 
 
 @asyncinit
 class BibliographicRecordsChunk(object):
-    async def __init__(self, aiohttp_session, conn_auth_int, conn_auth_ext, query, identifier_type):
+    async def __init__(self, aiohttp_session, conn_auth_int, conn_auth_ext, query, identifier_type, stream=False):
         self.aiohttp_session = aiohttp_session
         self.conn_auth_int = conn_auth_int
         self.conn_auth_ext = conn_auth_ext
         self.query = query
         self.for_omnis = self.get_for_omnis_from_query()
         self.identifier_type = identifier_type
+        self.stream = stream
         self.response_code = None
         self.marcxml_response_content = await self.get_marcxml_response()
         self.next_page_for_data_bn = None
         self.next_page_for_user = None
         self.marc_objects_chunk = None
         self.marc_processed_objects_chunk = None
-        self.xml_processed_chunk = await self.process_response()
+        # in stream mode response is processed lazily, while iterating over stream_output_xml()
+        self.xml_processed_chunk = await self.process_response() if not self.stream else None
 
 
     def get_for_omnis_from_query(self):
@@ -42,35 +44,29 @@ class BibliographicRecordsChunk(object):
             else:
                 return False
 
-    async def get_marcxml_response(self) -> Optional[bytes]:
-        if 'http://data.bn.org.pl/api/bibs.marcxml?{}' not in self.query:
-            processed_query = f'http://data.bn.org.pl/api/bibs.marcxml?{self.query}'
+    @staticmethod
+    def create_query_for_data_bn(query) -> str:
+        if 'http://data.bn.org.pl/api/bibs.marcxml?{}' not in query:
+            return f'http://data.bn.org.pl/api/bibs.marcxml?{query}'
         else:
-            processed_query = self.query
+            return query
 
-        async with self.aiohttp_session.get(processed_query) as response:
-            self.response_code = response.status
-            if self.response_code == 200:
-                return await response.read()
-            else:
-                return None
+    async def get_marcxml_response(self) -> Optional[bytes]:
+        processed_query = self.create_query_for_data_bn(self.query)
+
+        # repeated queries are served from cache of upstream responses
+        self.response_code, content = await get_with_cache(self.aiohttp_session, processed_query,
+                                                           upstream_response_cache)
+        return content
 
     async def process_response(self):
         if self.response_code == 200:
-            self.next_page_for_data_bn = self.get_next_page_for_data_bn()
+            self.next_page_for_data_bn, self.marc_objects_chunk = await self.read_marc_from_bytes_like_marcxml()
             self.next_page_for_user = self.create_next_page_for_user()
-            self.marc_objects_chunk = await self.read_marc_from_bytes_like_marcxml()
             self.marc_processed_objects_chunk = await self.batch_process_records()
-            xml_processed_chunk = self.produce_output_xml()
+            xml_processed_chunk = await self.produce_output_xml()
             return xml_processed_chunk
 
-    def get_next_page_for_data_bn(self):
-        root = ET.fromstring(self.marcxml_response_content)
-        if root[0].text:
-            return root[0].text
-        else:
-            return ''
-
     def create_next_page_for_user(self):
         if IS_LOCAL:
             base = f'{LOC_HOST}:{LOC_PORT}'
@@ -88,27 +84,43 @@ class BibliographicRecordsChunk(object):
         return next_page_for_user
 
     async def read_marc_from_bytes_like_marcxml(self):
-        return parse_xml_to_array_patched(io.BytesIO(self.marcxml_response_content), normalize_form='NFC')
+        # nextPage link and records are read in a single pass (outside of the event loop)
+        with metrics.time('parse'):
+            return await run_cpu_bound(parse_marcxml_bytes, self.marcxml_response_content, 'NFC')
 
     async def batch_process_records(self):
-            processed_recs = [await process_record(rcd,
-                                                   self.conn_auth_int,
-                                                   self.identifier_type,
-                                                   self.conn_auth_ext,
-                                                   for_omnis=self.for_omnis) for rcd in self.marc_objects_chunk]
-            return processed_recs
-
-    def produce_output_xml(self):
-        processed_records_in_xml = []
-
-        for rcd in self.marc_processed_objects_chunk:
-            xmlized_rcd = marcxml.record_to_xml(rcd, namespace=True)
-            processed_records_in_xml.append(bytearray(xmlized_rcd))
+        processed_recs = await process_records_chunk(self.marc_objects_chunk,
+                                                     self.conn_auth_int,
+                                                     self.identifier_type,
+                                                     self.conn_auth_ext,
+                                                     for_omnis=self.for_omnis)
+        return processed_recs
+
+    def produce_output_xml_beginning(self) -> bytes:
+        return f'<resp><nextPage>{self.next_page_for_user}</nextPage><collection>'.encode('utf-8')
+
+    @staticmethod
+    def produce_output_xml_end() -> bytes:
+        return '</collection></resp>'.encode('utf-8')
+
+    async def produce_output_xml(self):
+        out_xml = [self.produce_output_xml_beginning()]
+        with metrics.time('serialization'):
+            out_xml.extend(await run_cpu_bound(records_to_marcxml, self.marc_processed_objects_chunk))
+        out_xml.append(self.produce_output_xml_end())
+
+        return b''.join(out_xml)
+
+    async def stream_output_xml(self):
+        # yields response in parts: beginning with nextPage as soon as it is known, then every enriched record
+        if self.response_code == 200:
+            self.next_page_for_data_bn, self.marc_objects_chunk = await self.read_marc_from_bytes_like_marcxml()
+            self.next_page_for_user = self.create_next_page_for_user()
+            yield self.produce_output_xml_beginning()
 
-        joined = bytearray().join(processed_records_in_xml)
+            self.marc_processed_objects_chunk = await self.batch_process_records()
 
-        out_xml_beginning = f'<resp><nextPage>{self.next_page_for_user}</nextPage><collection>'.encode('utf-8')
-        out_xml_end = '</collection></resp>'.encode('utf-8')
-        out_xml = bytearray().join([out_xml_beginning, joined, out_xml_end])
+            async for rcd_xml in stream_records_to_marcxml(self.marc_processed_objects_chunk):
+                yield rcd_xml
 
-        return bytes(out_xml)
+            yield self.produce_output_xml_end()
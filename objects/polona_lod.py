@@ -1,10 +1,15 @@
-from typing import Optional
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
 
-from pymarc import MARCReader, Record
+import ujson
+
+from pymarc import Record
 from asyncinit import asyncinit
 
-from utils.marc_utils import prepare_name_for_indexing, process_record
-from config.indexer_config import FIELDS_TO_CHECK
+from utils.marc_utils import extract_and_resolve_terms_chunk, read_marc_record_from_bytes
+from utils.executor_utils import run_cpu_bound
+from utils.cache_utils import get_with_cache, upstream_response_cache
+from utils.metrics_utils import metrics
 
 FIELDS_TO_NAT_LANG = {'100': 'Twórca/współtwórca', '110': 'Twórca/współtwórca', '111': 'Twórca/współtwórca',
                       '130': 'Tytuł ujednolicony', '730': 'Tytuł ujednolicony',
@@ -20,88 +25,79 @@ FIELDS_TO_NAT_LANG = {'100': 'Twórca/współtwórca', '110': 'Twórca/współtw
 class PolonaLodRecord(object):
     async def __init__(self, bib_nlp_id, aiohttp_session, conn_auth_int, conn_auth_ext):
         self.bib_nlp_id = bib_nlp_id
-        self.bib_bytes = await self.get_single_marc_bib_record_from_data_bn(aiohttp_session)
-        self.bib_pymarc_record = self.read_single_marc_record_from_binary()
+        self.bib_bytes = await self.get_single_marc_bib_record_from_data_bn(self.bib_nlp_id, aiohttp_session)
+        self.bib_pymarc_record = await self.read_single_marc_record_from_binary()
         self.extracted_authorities = await self.extract_selected_authorities_from_record(conn_auth_int, conn_auth_ext)
-        self.converted_json = self.convert_authorities_to_polona_json()
+        self.converted_json = self.convert_authorities_to_polona_json(self.extracted_authorities)
 
-    async def get_single_marc_bib_record_from_data_bn(self, aiohttp_session) -> Optional[bytes]:
-        query = f'http://data.bn.org.pl/api/bibs.marc?id={self.bib_nlp_id}'
+    @staticmethod
+    async def get_single_marc_bib_record_from_data_bn(bib_nlp_id, aiohttp_session) -> Optional[bytes]:
+        query = f'http://data.bn.org.pl/api/bibs.marc?id={bib_nlp_id}'
 
-        async with aiohttp_session.get(query) as response:
-            if response.status == 200:
-                return await response.read()
-            else:
-                return None
+        # popular records are served from cache of upstream responses
+        _, content = await get_with_cache(aiohttp_session, query, upstream_response_cache)
+        return content
 
-    def read_single_marc_record_from_binary(self) -> Optional[Record]:
+    async def read_single_marc_record_from_binary(self) -> Optional[Record]:
         if self.bib_bytes:
-            marc_rdr = MARCReader(self.bib_bytes,
-                                  to_unicode=True,
-                                  force_utf8=True,
-                                  utf8_handling='ignore',
-                                  permissive=True)
-            for rcd in marc_rdr:
-                return rcd
+            with metrics.time('parse'):
+                return await run_cpu_bound(read_marc_record_from_bytes, self.bib_bytes)
         else:
             return None
 
     async def extract_selected_authorities_from_record(self, conn_auth_int, conn_auth_ext):
-        extracted_authorities = {}
-
         if self.bib_pymarc_record:
-            processed_record = await process_record(self.bib_pymarc_record,
-                                              conn_auth_int,
-                                              'all_ids',
-                                              conn_auth_ext,
-                                              polona=True)
-
-            for marc_field_and_subfields in FIELDS_TO_CHECK:
-                fld, subflds = marc_field_and_subfields[0], marc_field_and_subfields[1]
+            # read-only: record is not modified, every field is normalized once
+            [resolved_terms] = await extract_and_resolve_terms_chunk([self.bib_pymarc_record],
+                                                                     conn_auth_int,
+                                                                     'all_ids',
+                                                                     conn_auth_ext)
 
-                if fld in self.bib_pymarc_record:
-                    raw_objects_flds_list = self.bib_pymarc_record.get_fields(fld)
+            return self.extract_selected_authorities(resolved_terms)
+        else:
+            return None
 
-                    for raw_fld in raw_objects_flds_list:
-                        term_to_search = prepare_name_for_indexing(
-                            ' '.join(subfld for subfld in raw_fld.get_subfields(*subflds)))
+    @staticmethod
+    def extract_selected_authorities(resolved_terms: List[Tuple[str, str, dict]]) -> Optional[dict]:
+        # resolved_terms: (field tag, term, resolved ids) of the record (see extract_and_resolve_terms_chunk)
+        extracted_authorities = {}
 
-                        single_extracted_authority = self.get_authorities_ids_from_internal_db(term_to_search,
-                                                                                               processed_record)
+        for fld, term_to_search, resolved_ids in resolved_terms:
+            single_extracted_authority = PolonaLodRecord.get_authorities_ids_from_internal_db(resolved_ids)
 
-                        if single_extracted_authority:
-                            extracted_authorities.setdefault(FIELDS_TO_NAT_LANG.get(fld),
-                                                             {}).setdefault(term_to_search,
-                                                                            {}).update(single_extracted_authority)
+            if single_extracted_authority:
+                extracted_authorities.setdefault(FIELDS_TO_NAT_LANG.get(fld),
+                                                 {}).setdefault(term_to_search,
+                                                                {}).update(single_extracted_authority)
 
+        return extracted_authorities if extracted_authorities else None
 
-            return extracted_authorities if extracted_authorities else None
-        else:
-            return None
+    @staticmethod
+    def create_polona_json(resolved_terms: List[Tuple[str, str, dict]]) -> dict:
+        # the same as get_json() for record with already resolved terms
+        extracted_authorities = PolonaLodRecord.extract_selected_authorities(resolved_terms)
+        return PolonaLodRecord.convert_authorities_to_polona_json(extracted_authorities)
 
     @staticmethod
-    def get_authorities_ids_from_internal_db(term_to_search, processed_record):
+    def get_authorities_ids_from_internal_db(resolved_ids: dict) -> Optional[dict]:
         all_ids = {}
 
-        if term_to_search in processed_record:
-            i_ids = processed_record.get(term_to_search).get('internal_ids')
-            if i_ids:
-                all_ids.update(i_ids)
-            e_ids = processed_record.get(term_to_search).get('external_ids')
-            if e_ids:
-                all_ids.update(e_ids)
+        i_ids = resolved_ids.get('internal_ids')
+        if i_ids:
+            all_ids.update(i_ids)
+        e_ids = resolved_ids.get('external_ids')
+        if e_ids:
+            all_ids.update(e_ids)
 
         return all_ids if all_ids else None
 
-    def get_full_authority_records_from_internal_db(self):
-        pass
-
-    def convert_authorities_to_polona_json(self):
+    @staticmethod
+    def convert_authorities_to_polona_json(extracted_authorities: Optional[dict]) -> dict:
         converted_json = {}
 
-        if self.extracted_authorities:
+        if extracted_authorities:
 
-            for auth_role, auth in self.extracted_authorities.items():
+            for auth_role, auth in extracted_authorities.items():
                 for auth_name, auth_ids in auth.items():
                     heading = auth_ids.get('heading')
                     for auth_id_type, auth_id in auth_ids.items():
@@ -150,9 +146,13 @@ class PolonaLodRecord(object):
         return self.converted_json
 
     def get_json_v2(self):
+        return self.convert_polona_json_to_v2(self.converted_json)
+
+    @staticmethod
+    def convert_polona_json_to_v2(converted_json: dict) -> dict:
         descriptors = []
 
-        for auth_role, descriptor in self.converted_json.items():
+        for auth_role, descriptor in converted_json.items():
             descriptors_with_auth_role = {'name': auth_role}
             subjects = []
 
@@ -172,3 +172,53 @@ class PolonaLodRecord(object):
             descriptors.append(descriptors_with_auth_role)
 
         return {'descriptors': descriptors}
+
+
+async def create_polona_lod_documents(marc_records: List[Record], conn_auth_int,
+                                      conn_auth_ext) -> Tuple[Dict[str, Dict[str, str]], Dict[str, Set[str]]]:
+    # serialized PolonaLodRecord.get_json() (v1) and get_json_v2() (v2) of every record, by bib nlp_id
+    # and headings (normalized terms) every document was computed from
+    resolved_terms_per_record = await extract_and_resolve_terms_chunk(marc_records, conn_auth_int, 'all_ids',
+                                                                      conn_auth_ext)
+    documents = {}
+    headings = {}
+
+    for rcd, resolved_terms in zip(marc_records, resolved_terms_per_record):
+        bib_nlp_id = rcd['001'].value()
+        converted_json = PolonaLodRecord.create_polona_json(resolved_terms)
+        converted_json_v2 = PolonaLodRecord.convert_polona_json_to_v2(converted_json)
+        documents[bib_nlp_id] = {
+            'v1': ujson.dumps(converted_json, ensure_ascii=False, escape_forward_slashes=False),
+            'v2': ujson.dumps(converted_json_v2, ensure_ascii=False, escape_forward_slashes=False)}
+        headings[bib_nlp_id] = {term for _, term, _ in resolved_terms}
+
+    return documents, headings
+
+
+async def create_polona_lod_jsons_batch(bib_nlp_ids: List[str], aiohttp_session, conn_auth_int, conn_auth_ext,
+                                        concurrency: int) -> Dict[str, dict]:
+    # the same as PolonaLodRecord(...).get_json() for many records:
+    # records are fetched concurrently (at most concurrency requests at a time)
+    # and resolved together - terms of all records are sent to redis once (see resolve_terms)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_record(bib_nlp_id: str) -> Optional[Record]:
+        async with semaphore:
+            bib_bytes = await PolonaLodRecord.get_single_marc_bib_record_from_data_bn(bib_nlp_id, aiohttp_session)
+        if not bib_bytes:
+            return None
+        with metrics.time('parse'):
+            return await run_cpu_bound(read_marc_record_from_bytes, bib_bytes)
+
+    fetched_records = await asyncio.gather(*[fetch_record(bib_nlp_id) for bib_nlp_id in bib_nlp_ids])
+    found = [(bib_nlp_id, rcd) for bib_nlp_id, rcd in zip(bib_nlp_ids, fetched_records) if rcd]
+
+    resolved_terms_per_record = await extract_and_resolve_terms_chunk([rcd for _, rcd in found], conn_auth_int,
+                                                                      'all_ids', conn_auth_ext)
+
+    # records not found in data.bn.org.pl get empty json (as in single record endpoint)
+    converted_jsons = {bib_nlp_id: {} for bib_nlp_id in bib_nlp_ids}
+    for (bib_nlp_id, _), resolved_terms in zip(found, resolved_terms_per_record):
+        converted_jsons[bib_nlp_id] = PolonaLodRecord.create_polona_json(resolved_terms)
+
+    return converted_jsons
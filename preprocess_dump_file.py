@@ -1,92 +1,153 @@
-from typing import List
-import ujson
-
-from pymarc import MARCReader, Record
+import argparse
+import logging
+import os
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from pymarc import Record
 import redis
 from tqdm import tqdm
 
-from config.indexer_config import FIELDS_TO_CHECK_FOR_OMNIS
-from utils.marc_utils import prepare_name_for_indexing
+from config.indexer_config import PREPROCESS_BATCH_SIZE
+from config.redis_config import AUTHORITY_INDEX_DB
+from sqlite_clients.authority_index_snapshot import AuthorityIndexSnapshot
+from utils.indexer_utils import yield_record_batches
+from utils.marc_utils import get_fields_and_terms
+from utils.mmap_marc_reader import MmapMARCReader
+from utils.serialization_utils import decode_authority_value
+
 
+logger = logging.getLogger(__name__)
 
-CONN_INT = redis.Redis(db=8)
+# connection to authority index (redis or local snapshot) and identifier type of the worker process
+# (set by init_worker)
+conn_auth_int = None
+worker_identifier_type = None
 
 
-def get_terms_to_search_and_references_to_raw_flds(marc_record) -> dict:
-    terms_fields_ids = {}
+def init_worker(db: int, identifier_type: str, snapshot: Optional[Path] = None) -> None:
+    # every worker process opens its own connection (connections can't be shared between processes)
+    # with snapshot all lookups are local - redis is not needed at all
+    global conn_auth_int, worker_identifier_type
+    conn_auth_int = AuthorityIndexSnapshot(str(snapshot)) if snapshot else redis.Redis(db=db, decode_responses=True)
+    worker_identifier_type = identifier_type
 
-    for marc_field_and_subfields in FIELDS_TO_CHECK_FOR_OMNIS:
-        fld, subflds = marc_field_and_subfields[0], marc_field_and_subfields[1]
 
-        if fld in marc_record:
-            raw_objects_flds_list = marc_record.get_fields(fld)
+def enrich_records(marc_records: List[Record], conn, identifier_type: str) -> List[Record]:
+    """
+    Adds authority identifiers to many bibliographic records at once - terms of all records
+    are normalized once and sent to authority index in single MGET.
+    """
 
-            for raw_fld in raw_objects_flds_list:
-                term_to_search = prepare_name_for_indexing(
-                    ' '.join(subfld for subfld in raw_fld.get_subfields(*subflds)))
+    # (raw fld, term to search) of every record
+    fields_and_terms = [get_fields_and_terms(rcd, for_omnis=True) for rcd in marc_records]
 
-                terms_fields_ids.setdefault(term_to_search, {}).setdefault('raw_flds', []).append(raw_fld)
+    unique_terms = list({term for rcd_fields_and_terms in fields_and_terms for _, term in rcd_fields_and_terms})
+    internal_ids = dict(zip(unique_terms, conn.mget(*unique_terms))) if unique_terms else {}
 
-    return terms_fields_ids
+    decoded_ids = {term: decode_authority_value(int_ids) for term, int_ids in internal_ids.items() if int_ids}
+
+    # add single subfield |0 to fields in marc record by identifier type
+    if identifier_type in ['nlp_id', 'mms_id']:
+        for rcd_fields_and_terms in fields_and_terms:
+            for raw_fld, term in rcd_fields_and_terms:
+                ident = decoded_ids.get(term, {}).get(identifier_type)
+                if ident:
+                    raw_fld.add_subfield('0', ident)
 
+    return marc_records
 
-def process_record(marc_record, conn_auth_int, identifier_type):
+
+def process_record(marc_record: Record, conn, identifier_type: str) -> Record:
     """
     Main processing loop for adding authority identifiers to bibliographic record.
     """
 
-    # get all terms to search for in redis index and get all references to raw flds with these terms
-    terms_fields_ids = get_terms_to_search_and_references_to_raw_flds(marc_record)
-
-    # get all internal ids (meaning: from original NLP database via data.bn.org.pl) from redis index db=0
-    internal_ids = conn_auth_int.mget(*list(terms_fields_ids.keys()))
+    return enrich_records([marc_record], conn, identifier_type)[0]
 
-    for term, int_ids in zip(list(terms_fields_ids.keys()), internal_ids):
-        if int_ids:
-            fields_ids = terms_fields_ids.get(term)
-            in_json = ujson.loads(int_ids)
-            fields_ids.setdefault('internal_ids', in_json)
 
-    # add single subfield |0 to fields in marc record by identifier type
-    if identifier_type in ['nlp_id', 'mms_id']:
-        for flds_ids in terms_fields_ids.values():
-            for field in flds_ids.get('raw_flds'):
-                if flds_ids.get('internal_ids'):
-                    field.add_subfield('0', flds_ids.get('internal_ids').get(identifier_type))
+def enrich_batch(batch: Tuple[str, int, int]) -> Tuple[int, bytes]:
+    # parses records from byte range of the file, enriches them and serializes back (runs in worker process)
+    # returns number of records and enriched records as iso2709
+    path_to_file, start, end = batch
 
-    return marc_record
+    with MmapMARCReader(path_to_file, start, end) as rdr:
+        records = list(rdr)
+        if rdr.failed:
+            logger.warning(f'Pominięto uszkodzonych rekordów: {rdr.failed} (bajty {start}-{end}).')
 
+    enriched_records = enrich_records(records, conn_auth_int, worker_identifier_type)
 
-def yield_record_from_file(input_file: str) -> Record:
-    with open(input_file, 'rb') as fp:
-        rdr = MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore', permissive=True)
-        for rcd in rdr:
-            yield rcd
+    return len(enriched_records), b''.join(rcd.as_marc() for rcd in enriched_records)
 
 
-def write_to_file(output_file: str, records_to_write: List[Record]) -> None:
-    with open(output_file, 'ab') as fp:
-        for rcd in records_to_write:
-            fp.write(rcd.as_marc())
+def enrich_dump_file(input_file: Path, output_file: Path, workers: int = 1,
+                     batch_size: int = PREPROCESS_BATCH_SIZE, identifier_type: str = 'nlp_id',
+                     db: int = AUTHORITY_INDEX_DB, snapshot: Optional[Path] = None,
+                     offsets_index: Optional[Path] = None) -> Tuple[int, float]:
+    # returns number of written records and throughput (records/sec)
+    logger.info(f'Rozpoczęto wzbogacanie rekordów z pliku {input_file} (procesy: {workers}, paczka: {batch_size})...')
+    records_count = 0
+    start_time = time.perf_counter()
 
+    # reader: splits file into batches of records by record length from leader
+    # (record boundaries can be cached in offsets index file and reused in next runs)
+    batches = yield_record_batches(str(input_file), batch_size,
+                                   offsets_index_path=str(offsets_index) if offsets_index else None)
 
-def main_loop(input_file, output_file):
-    write_buffer = []
+    # parsing, normalization and lookup is done in worker processes (if any),
+    # batches are written in file order
+    pool: Optional[Pool] = Pool(workers, initializer=init_worker, initargs=(db, identifier_type, snapshot)) \
+        if workers > 1 else None
+    if not pool:
+        init_worker(db, identifier_type, snapshot)
+    enriched_batches = pool.imap(enrich_batch, batches) if pool else map(enrich_batch, batches)
 
-    for rcd in tqdm(yield_record_from_file(input_file)):
-        processed_rcd = process_record(rcd, CONN_INT, 'nlp_id')
-        write_buffer.append(processed_rcd)
+    try:
+        with open(output_file, 'wb') as fp, tqdm(unit='rcd') as progress_bar:
+            for batch_records_count, batch_content in enriched_batches:
+                fp.write(batch_content)
+                records_count += batch_records_count
+                progress_bar.update(batch_records_count)
 
-        if len(write_buffer) > 1000:
-            write_to_file(output_file, write_buffer)
-            write_buffer.clear()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-    write_to_file(output_file, write_buffer)
+    elapsed = time.perf_counter() - start_time
+    throughput = records_count / elapsed if elapsed else 0.0
 
+    logger.info(f'Zakończono wzbogacanie rekordów. Zapisano: {records_count} do pliku {output_file} '
+                f'({elapsed:.1f} s, {throughput:.0f} rekordów/s).')
 
-if __name__ == "__main__":
+    return records_count, throughput
 
-    file_in = 'bib_pigmentacja.mrc'
-    file_out = 'bib_pigmentacja_pre.mrc'
 
-    main_loop(file_in, file_out)
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Add authority identifiers (subfield 0) to bibliographic records '
+                                                 'dump (authority index has to be built first).')
+    parser.add_argument('input_file', type=Path, help='bibliographic records dump file (iso2709)')
+    parser.add_argument('output_file', type=Path, help='output file for enriched records (iso2709)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes enriching records (default: number of cpus)')
+    parser.add_argument('--batch-size', type=int, default=PREPROCESS_BATCH_SIZE,
+                        help=f'number of records in single batch (default: {PREPROCESS_BATCH_SIZE})')
+    parser.add_argument('--identifier-type', choices=['nlp_id', 'mms_id'], default='nlp_id',
+                        help='type of identifier added in subfield 0 (default: nlp_id)')
+    parser.add_argument('--snapshot', type=Path,
+                        help='authority index snapshot file (see run_indexer.py --export-snapshot) - lookups are '
+                             'done locally, without redis')
+    parser.add_argument('--offsets-index', type=Path,
+                        help='file with cached record offsets of input file (created if missing or outdated)')
+    args = parser.parse_args()
+
+    enrich_dump_file(args.input_file, args.output_file, workers=args.workers, batch_size=args.batch_size,
+                     identifier_type=args.identifier_type, snapshot=args.snapshot,
+                     offsets_index=args.offsets_index)
@@ -0,0 +1,84 @@
+import unicodedata
+import xml.etree.ElementTree as ET
+
+from pymarc import MARC_XML_NS
+
+from pymarc.field import Field
+from pymarc.record import Record
+
+
+CONTROLFIELD_TAGS = {'001', '002', '003', '004', '005', '006', '007', '008', '009', '04 '}
+
+
+def _normalize(text, normalize_form):
+    # ascii text is already normalized in every form, so unicodedata call can be skipped
+    if normalize_form is not None and not text.isascii():
+        return unicodedata.normalize(normalize_form, text)
+    return text
+
+
+def parse_xml_to_next_page_and_array_iterparse(xml_file, strict=False, normalize_form=None):
+    """
+    iterparse (expat + C ElementTree builder) counterpart of parse_xml_to_next_page_and_array_patched.
+    Elements are handled only on 'end' events, when their text and children are complete,
+    and every record is cleared as soon as it is built. Produces the same records,
+    with the same patches applied as in XmlHandlerPatched.
+    """
+    next_page = None
+    records = []
+    record = None
+
+    for event, elem in ET.iterparse(xml_file):
+        if elem.tag == 'nextPage':
+            next_page = elem.text or ''
+            continue
+
+        namespace, _, element = elem.tag.rpartition('}')
+        if strict and namespace[1:] != MARC_XML_NS:
+            continue
+
+        if element == 'record':
+            records.append(record if record is not None else Record())
+            record = None
+            elem.clear()
+            continue
+
+        if element not in ('leader', 'controlfield', 'datafield'):
+            continue
+
+        if record is None:
+            record = Record()
+
+        if element == 'leader':
+            record.leader = _normalize(elem.text or '', normalize_form)
+        elif element == 'controlfield':
+            tag = elem.attrib['tag']
+            # patch 1: if it is not a valid controlfield, omit it
+            if not tag < '010' or not tag.isdigit():
+                continue
+            field = Field(tag)
+            field.data = _normalize(elem.text or '', normalize_form)
+            record.add_field(field)
+        elif element == 'datafield':
+            tag = elem.attrib['tag']
+            # patch 3: if somehow datafield has controlfield tag, omit it
+            if tag in CONTROLFIELD_TAGS:
+                continue
+            ind1 = elem.get('ind1', ' ')
+            ind2 = elem.get('ind2', ' ')
+            # patch 2: if field lacks indicators or they're not ASCII, force to blank
+            try:
+                field = Field(tag, [ind1, ind2])
+            except (ValueError, UnicodeEncodeError):
+                field = Field(tag, [' ', ' '])
+
+            for subfield in elem:
+                subfield_namespace, _, subfield_element = subfield.tag.rpartition('}')
+                if subfield_element != 'subfield' or (strict and subfield_namespace[1:] != MARC_XML_NS):
+                    continue
+                field.subfields.append(subfield.attrib['code'])
+                field.subfields.append(_normalize(subfield.text or '', normalize_form))
+
+            record.add_field(field)
+
+    return next_page or '', records
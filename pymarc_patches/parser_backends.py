@@ -0,0 +1,25 @@
+import io
+
+from pymarc_patches.xml_handler_patch import parse_xml_to_next_page_and_array_patched
+from pymarc_patches.iterparse_patch import parse_xml_to_next_page_and_array_iterparse
+
+from config.parser_config import MARCXML_PARSER_BACKEND
+
+
+PARSER_BACKENDS = {'sax': parse_xml_to_next_page_and_array_patched,
+                   'iterparse': parse_xml_to_next_page_and_array_iterparse}
+
+
+def parse_xml_to_next_page_and_array(xml_file, strict=False, normalize_form=None, backend=MARCXML_PARSER_BACKEND):
+    """
+    parse data.bn.org.pl xml response with selected backend (see config.parser_config)
+    and return tuple: nextPage link and the records as an array.
+    """
+    return PARSER_BACKENDS[backend](xml_file, strict=strict, normalize_form=normalize_form)
+
+
+def parse_marcxml_bytes(content: bytes, normalize_form=None, backend=MARCXML_PARSER_BACKEND):
+    """
+    parse data.bn.org.pl xml response given as bytes (picklable entry point for executor workers).
+    """
+    return parse_xml_to_next_page_and_array(io.BytesIO(content), normalize_form=normalize_form, backend=backend)
@@ -9,7 +9,17 @@ from pymarc.record import Record
 
 
 class XmlHandlerPatched(XmlHandler):
+    def __init__(self, strict=False, normalize_form=None):
+        super().__init__(strict, normalize_form)
+        self.next_page = None
+
     def startElementNS(self, name, qname, attrs):
+        # patch 4: data.bn.org.pl wraps records in <resp><nextPage/><collection/></resp>,
+        # so nextPage link is captured in the same pass as records
+        if name == (None, 'nextPage'):
+            self._text = []
+            return
+
         if self._strict and name[0] != MARC_XML_NS:
             return
 
@@ -40,6 +50,12 @@ class XmlHandlerPatched(XmlHandler):
             self._subfield_code = attrs[(None, 'code')]
 
     def endElementNS(self, name, qname):
+        # patch 4: capture nextPage link
+        if name == (None, 'nextPage'):
+            self.next_page = u''.join(self._text)
+            self._text = []
+            return
+
         if self._strict and name[0] != MARC_XML_NS:
             return
 
@@ -89,3 +105,15 @@ def parse_xml_to_array_patched(xml_file, strict=False, normalize_form=None):
     handler = XmlHandlerPatched(strict, normalize_form)
     parse_xml(xml_file, handler)
     return handler.records
+
+
+def parse_xml_to_next_page_and_array_patched(xml_file, strict=False, normalize_form=None):
+    """
+    parse data.bn.org.pl xml response in a single pass and return tuple:
+    nextPage link (empty string if there is no next page) and the records as an array.
+    Valid values for normalize_form are 'NFC', 'NFKC', 'NFD', and 'NFKD'. See
+    unicodedata.normalize info.
+    """
+    handler = XmlHandlerPatched(strict, normalize_form)
+    parse_xml(xml_file, handler)
+    return handler.next_page or '', handler.records
@@ -1,8 +1,15 @@
+import argparse
 import logging
 import sys
+from pathlib import Path
 
 from indexer.authority_indexer import create_authority_index, flush_db
+from indexer.authority_index_snapshot import export_authority_index_snapshot
+from indexer.authority_records_offsets_indexer import create_authority_records_offsets_index
 from indexer.authority_external_ids_indexer import AuthorityExternalIdsIndex
+from utils.indexer_utils import swap_shadow_db
+from config.redis_config import AUTHORITY_INDEX_DB, AUTHORITY_INDEX_SHADOW_DB
+from config.redis_config import EXTERNAL_IDS_INDEX_DB, EXTERNAL_IDS_INDEX_SHADOW_DB, MIN_SHADOW_TO_LIVE_KEYS_RATIO
 
 # set up logging
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,6 +28,36 @@ logging.root.addHandler(strhandler)
 logging.root.addHandler(fhandler)
 logging.root.setLevel(level=logging.INFO)
 
-flush_db()
-create_authority_index()
-#AuthorityExternalIdsIndex().index_in_redis()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build authority index in Redis.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes parsing authority records (default: 1)')
+    parser.add_argument('--min-keys-ratio', type=float, default=MIN_SHADOW_TO_LIVE_KEYS_RATIO,
+                        help='minimal ratio of keys in rebuilt index to keys in live index required to swap them')
+    parser.add_argument('--export-snapshot', type=Path,
+                        help='after the swap export authority index to read-only sqlite snapshot file '
+                             '(used by offline jobs instead of redis, see preprocess_dump_file.py)')
+    parser.add_argument('--export-only', action='store_true',
+                        help='only export live authority index to snapshot file, without rebuilding it')
+    args = parser.parse_args()
+
+    if args.export_only:
+        if not args.export_snapshot:
+            parser.error('--export-only requires --export-snapshot')
+        export_authority_index_snapshot(args.export_snapshot, db=AUTHORITY_INDEX_DB)
+        sys.exit(0)
+
+    # index is built in shadow db, live db=8 keeps serving requests until the swap
+    flush_db(AUTHORITY_INDEX_SHADOW_DB)
+    create_authority_index(workers=args.workers, db=AUTHORITY_INDEX_SHADOW_DB)
+    if not swap_shadow_db(AUTHORITY_INDEX_DB, AUTHORITY_INDEX_SHADOW_DB, args.min_keys_ratio):
+        sys.exit(1)
+
+    # nlp_id -> (offset, length) of full records in authorities dump (served by /api/authority-records/)
+    create_authority_records_offsets_index()
+
+    if args.export_snapshot:
+        export_authority_index_snapshot(args.export_snapshot, db=AUTHORITY_INDEX_DB)
+
+    #AuthorityExternalIdsIndex().index_in_redis(db=EXTERNAL_IDS_INDEX_SHADOW_DB)
+    #swap_shadow_db(EXTERNAL_IDS_INDEX_DB, EXTERNAL_IDS_INDEX_SHADOW_DB, args.min_keys_ratio)
@@ -0,0 +1,51 @@
+import argparse
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+from indexer.authority_indexer import flush_db
+from indexer.polona_lod_indexer import PATH_TO_BIBS, create_polona_lod_store
+from utils.indexer_utils import swap_shadow_db
+from config.redis_config import POLONA_LOD_DB, POLONA_LOD_SHADOW_DB, MIN_SHADOW_TO_LIVE_KEYS_RATIO
+
+# set up logging
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+fhandler = logging.FileHandler('polona_lod_indexer.log', encoding='utf-8')
+strhandler = logging.StreamHandler(sys.stdout)
+
+fhandler.setFormatter(formatter)
+strhandler.setFormatter(formatter)
+
+logging.root.addHandler(strhandler)
+logging.root.addHandler(fhandler)
+logging.root.setLevel(level=logging.INFO)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute Polona LOD documents in Redis '
+                                                 '(authority indexes have to be built first).')
+    parser.add_argument('--data', type=Path, default=PATH_TO_BIBS,
+                        help='bibliographic records dump file (iso2709)')
+    parser.add_argument('--bib-ids', type=Path,
+                        help='file with bib nlp_ids (one per line) - only these documents are recomputed '
+                             'in live db (incremental run), otherwise all documents are rebuilt in shadow db')
+    parser.add_argument('--stale', action='store_true',
+                        help='recompute documents marked as stale by authority updater in live db '
+                             '(can be combined with --bib-ids)')
+    parser.add_argument('--min-keys-ratio', type=float, default=MIN_SHADOW_TO_LIVE_KEYS_RATIO,
+                        help='minimal ratio of keys in rebuilt store to keys in live store required to swap them')
+    args = parser.parse_args()
+
+    if args.bib_ids or args.stale:
+        bib_ids = None
+        if args.bib_ids:
+            with open(args.bib_ids, encoding='utf-8') as fp:
+                bib_ids = {line.strip() for line in fp if line.strip()}
+        asyncio.run(create_polona_lod_store(args.data, POLONA_LOD_DB, bib_ids, stale=args.stale))
+    else:
+        # store is built in shadow db, live db keeps serving requests until the swap
+        flush_db(POLONA_LOD_SHADOW_DB)
+        asyncio.run(create_polona_lod_store(args.data, POLONA_LOD_SHADOW_DB))
+        if not swap_shadow_db(POLONA_LOD_DB, POLONA_LOD_SHADOW_DB, args.min_keys_ratio):
+            sys.exit(1)
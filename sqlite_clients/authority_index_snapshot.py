@@ -0,0 +1,68 @@
+from typing import Iterable, List, Optional, Tuple
+import logging
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+# read-only copy of authority index (redis db=8) - the same keys and values (see serialization_utils)
+SNAPSHOT_TABLE = ('CREATE TABLE IF NOT EXISTS authority_index '
+                  '(key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+SNAPSHOT_INSERT = 'INSERT OR REPLACE INTO authority_index (key, value) VALUES (?, ?)'
+SNAPSHOT_SELECT = 'SELECT key, value FROM authority_index WHERE key IN ({placeholders})'
+
+# keys in single SELECT (sqlite limit of host parameters is 999 in older versions)
+SNAPSHOT_MGET_CHUNK_SIZE = 900
+
+
+def write_authority_index_snapshot(path_to_db_file: str, items: Iterable[Tuple[str, str]],
+                                   chunk_size: int = 10000) -> int:
+    # writes (key, value) pairs to new snapshot file and returns number of written keys
+    conn = sqlite3.connect(path_to_db_file)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute(SNAPSHOT_TABLE)
+
+    written_count = 0
+    chunk = []
+
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            conn.executemany(SNAPSHOT_INSERT, chunk)
+            written_count += len(chunk)
+            chunk = []
+
+    if chunk:
+        conn.executemany(SNAPSHOT_INSERT, chunk)
+        written_count += len(chunk)
+
+    conn.commit()
+    conn.close()
+
+    return written_count
+
+
+class AuthorityIndexSnapshot(object):
+    """
+    Local lookups in authority index snapshot - mget() has the same interface as redis.Redis.mget(),
+    so the snapshot can be used instead of redis connection by offline jobs.
+    """
+
+    def __init__(self, path_to_db_file: str):
+        self.path_to_db_file = path_to_db_file
+        # connection is opened in the process, which uses it (sqlite3 connections can't be shared between processes)
+        self.conn = sqlite3.connect(f'file:{path_to_db_file}?mode=ro', uri=True)
+
+    def mget(self, *keys: str) -> List[Optional[str]]:
+        found = {}
+
+        for chunk_start in range(0, len(keys), SNAPSHOT_MGET_CHUNK_SIZE):
+            keys_chunk = keys[chunk_start:chunk_start + SNAPSHOT_MGET_CHUNK_SIZE]
+            found.update(self.conn.execute(SNAPSHOT_SELECT.format(placeholders=', '.join('?' * len(keys_chunk))),
+                                           keys_chunk))
+
+        return [found.get(key) for key in keys]
+
+    def close(self):
+        self.conn.close()
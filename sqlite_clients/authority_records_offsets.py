@@ -0,0 +1,86 @@
+from typing import Dict, Iterable, List, Tuple
+import os
+import sqlite3
+import threading
+
+
+# nlp_id -> (offset, length) of the record in authorities dump
+# meta: size and mtime of the indexed dump (index is valid only for the same file)
+OFFSETS_TABLE = ('CREATE TABLE IF NOT EXISTS authority_records '
+                 '(nlp_id TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL) WITHOUT ROWID')
+META_TABLE = 'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+OFFSETS_INSERT = 'INSERT OR REPLACE INTO authority_records (nlp_id, offset, length) VALUES (?, ?, ?)'
+OFFSETS_SELECT = 'SELECT nlp_id, offset, length FROM authority_records WHERE nlp_id IN ({placeholders})'
+
+# ids in single SELECT (sqlite limit of host parameters is 999 in older versions)
+OFFSETS_GET_CHUNK_SIZE = 900
+
+
+def get_file_signature(path_to_file: str) -> Dict[str, str]:
+    file_stat = os.stat(path_to_file)
+    return {'file_size': str(file_stat.st_size), 'file_mtime_ns': str(file_stat.st_mtime_ns)}
+
+
+def write_authority_records_offsets(path_to_db_file: str, path_to_records_file: str,
+                                    items: Iterable[Tuple[str, int, int]], chunk_size: int = 10000) -> int:
+    # writes (nlp_id, offset, length) of records to new index file and returns number of written records
+    conn = sqlite3.connect(path_to_db_file)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute(OFFSETS_TABLE)
+    conn.execute(META_TABLE)
+
+    written_count = 0
+    chunk = []
+
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            conn.executemany(OFFSETS_INSERT, chunk)
+            written_count += len(chunk)
+            chunk = []
+
+    if chunk:
+        conn.executemany(OFFSETS_INSERT, chunk)
+        written_count += len(chunk)
+
+    conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                     get_file_signature(path_to_records_file).items())
+    conn.commit()
+    conn.close()
+
+    return written_count
+
+
+class AuthorityRecordsOffsets(object):
+    """
+    Read-only lookups of record offsets in authorities dump - single connection is shared by threads
+    of the worker (queries are serialized with lock).
+    """
+
+    def __init__(self, path_to_db_file: str):
+        self.path_to_db_file = path_to_db_file
+        self.conn = sqlite3.connect(f'file:{path_to_db_file}?mode=ro', uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def is_valid_for(self, path_to_records_file: str) -> bool:
+        # index has to be built from the same version of the dump
+        with self.lock:
+            meta = dict(self.conn.execute('SELECT key, value FROM meta'))
+        return meta == get_file_signature(path_to_records_file)
+
+    def get_offsets(self, nlp_ids: List[str]) -> Dict[str, Tuple[int, int]]:
+        # only found ids are returned
+        found = {}
+
+        with self.lock:
+            for chunk_start in range(0, len(nlp_ids), OFFSETS_GET_CHUNK_SIZE):
+                nlp_ids_chunk = nlp_ids[chunk_start:chunk_start + OFFSETS_GET_CHUNK_SIZE]
+                rows = self.conn.execute(OFFSETS_SELECT.format(placeholders=', '.join('?' * len(nlp_ids_chunk))),
+                                         nlp_ids_chunk)
+                found.update((nlp_id, (offset, length)) for nlp_id, offset, length in rows)
+
+        return found
+
+    def close(self):
+        self.conn.close()
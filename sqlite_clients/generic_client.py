@@ -1,47 +1,73 @@
-from typing import Callable, Optional
+from typing import Callable, Iterator, Optional, Tuple
+import logging
 import sqlite3
 
 
+logger = logging.getLogger(__name__)
+
+# best score per descriptor is selected by sqlite itself
+# ties are resolved in favour of the last row (the highest rowid), as in the original row by row filtering
+BEST_SCORE_QUERY = ('SELECT bn__descr_nlp_id, {fetched_id_column} FROM ('
+                    'SELECT bn__descr_nlp_id, {fetched_id_column}, '
+                    'ROW_NUMBER() OVER (PARTITION BY bn__descr_nlp_id ORDER BY score DESC, rowid DESC) AS score_rank '
+                    'FROM {table_name}) '
+                    'WHERE score_rank = 1')
+
+# covering index for BEST_SCORE_QUERY (rowid is stored in every index entry)
+BEST_SCORE_INDEX = ('CREATE INDEX IF NOT EXISTS {table_name}_best_score_idx '
+                    'ON {table_name} (bn__descr_nlp_id, score, {fetched_id_column})')
+
+
 class GenericClient(object):
-    def __init__(self, path_to_db_file: str, sql_query: str,
-                 dict_key_name: str, id_processing_method: Optional[Callable[[str], str]] = None):
+    def __init__(self, path_to_db_file: str, fetched_id_column: str,
+                 dict_key_name: str, id_processing_method: Optional[Callable[[str], str]] = None,
+                 table_name: str = 'results', fetch_batch_size: int = 10000):
         self.path_to_db_file = path_to_db_file
-        self.sql_query = sql_query
+        self.fetched_id_column = fetched_id_column
         self.dict_key_name = dict_key_name
         self.id_processing_method = id_processing_method
-        self.conn = self.open_connection()
+        self.table_name = table_name
+        self.fetch_batch_size = fetch_batch_size
+        self.conn = None
         self.filtered_dict = {}
 
     def open_connection(self):
+        # connection is opened in the thread, which uses it (sqlite3 connections are bound to their thread)
         conn = sqlite3.connect(self.path_to_db_file)
         return conn
 
     def close_connection(self):
         self.conn.close()
 
-    def get_rows_from_db(self) -> tuple:
-        c = self.conn.cursor()
-        for row in c.execute(self.sql_query):
-            yield row
-
-    def filter_by_best_score(self, row: tuple):
-        nlp_id, fetched_id, score, max_score = row
-        fetched_from_f_dict = self.filtered_dict.get(nlp_id)
+    def create_best_score_index(self) -> None:
+        try:
+            self.conn.execute(BEST_SCORE_INDEX.format(table_name=self.table_name,
+                                                      fetched_id_column=self.fetched_id_column))
+            self.conn.commit()
+        except sqlite3.OperationalError as e:
+            # e.g. read-only database file - query still works, only slower
+            logger.warning(f'Nie utworzono indeksu w {self.path_to_db_file}: {e}.')
 
-        if (fetched_from_f_dict and score >= fetched_from_f_dict['score']) or not fetched_from_f_dict:
-            fetched_id = fetched_id if not self.id_processing_method else self.id_processing_method(fetched_id)
-            self.filtered_dict[nlp_id] = {self.dict_key_name: fetched_id, 'score': score}
+    def get_rows_from_db(self) -> Iterator[Tuple[str, str]]:
+        c = self.conn.cursor()
+        c.execute(BEST_SCORE_QUERY.format(table_name=self.table_name,
+                                          fetched_id_column=self.fetched_id_column))
 
-    def remove_scores(self):
-        for external_ids_dict in self.filtered_dict.values():
-            external_ids_dict.pop('score')
+        rows = c.fetchmany(self.fetch_batch_size)
+        while rows:
+            yield from rows
+            rows = c.fetchmany(self.fetch_batch_size)
 
     def run_process(self):
-        for r in self.get_rows_from_db():
-            self.filter_by_best_score(r)
-        self.remove_scores()
+        id_processing_method = self.id_processing_method
+
+        for nlp_id, fetched_id in self.get_rows_from_db():
+            fetched_id = fetched_id if not id_processing_method else id_processing_method(fetched_id)
+            self.filtered_dict[nlp_id] = {self.dict_key_name: fetched_id}
 
     def create_index(self) -> dict:
+        self.conn = self.open_connection()
+        self.create_best_score_index()
         self.run_process()
         self.close_connection()
         return self.filtered_dict
@@ -0,0 +1,48 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from indexer.authority_index_snapshot import export_authority_index_snapshot
+from sqlite_clients.authority_index_snapshot import AuthorityIndexSnapshot
+
+
+class FakeRedis(object):
+    def __init__(self, data):
+        self.data = data
+
+    def scan_iter(self, count=None):
+        return iter(list(self.data))
+
+    def mget(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def close(self):
+        pass
+
+
+class TestAuthorityIndexSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path_to_snapshot = Path(self.tmp_dir.name) / 'authority_index.db'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_exported_snapshot_returns_the_same_values_as_redis(self):
+        data = {f'KEY {num}': f'[2,"a{num:013d}",null,null,null,"Key {num}","100"]' for num in range(2500)}
+        fake_redis = FakeRedis(data)
+
+        with mock.patch('indexer.authority_index_snapshot.redis.Redis', return_value=fake_redis):
+            exported_count = export_authority_index_snapshot(self.path_to_snapshot)
+
+        keys = ['MISSING', *data, 'KEY 7']
+        snapshot = AuthorityIndexSnapshot(str(self.path_to_snapshot))
+        try:
+            self.assertEqual(exported_count, len(data))
+            self.assertEqual(snapshot.mget(*keys), fake_redis.mget(*keys))
+        finally:
+            snapshot.close()
+
+        self.assertFalse(Path(str(self.path_to_snapshot) + '.tmp').exists())
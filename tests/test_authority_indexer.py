@@ -0,0 +1,145 @@
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import indexer.authority_indexer
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY, EXTERNAL_IDS_INDEX_GENERATION_KEY
+from indexer.authority_external_ids_indexer import AuthorityExternalIdsIndex
+from utils.indexer_utils import yield_record_batches, swap_shadow_db, bulk_load_to_redis
+
+
+PATH_TO_TEST_AUTHORITIES = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'authorities_test_100.mrc'
+
+
+class FakeRedis(object):
+    def __init__(self, *args, **kwargs):
+        self.data = {}
+
+    def mset(self, mapping):
+        self.data.update(mapping)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def flushdb(self):
+        self.data = {}
+
+    def close(self):
+        pass
+
+
+class TestRecordBatches(unittest.TestCase):
+
+    def test_batches_cover_whole_file(self):
+        batches = list(yield_record_batches(str(PATH_TO_TEST_AUTHORITIES), 30))
+
+        self.assertEqual(len(batches), 4)
+        self.assertEqual(batches[0][1], 0)
+        self.assertEqual(batches[-1][2], PATH_TO_TEST_AUTHORITIES.stat().st_size)
+
+
+class TestCreateAuthorityIndex(unittest.TestCase):
+
+    def create_index(self, workers):
+        fake_redis = FakeRedis()
+        with mock.patch('indexer.authority_indexer.redis.Redis', return_value=fake_redis), \
+                mock.patch('indexer.authority_indexer.INDEXER_BATCH_SIZE', 7):
+            indexer.authority_indexer.create_authority_index(PATH_TO_TEST_AUTHORITIES, workers=workers)
+
+        # every build gets new index generation
+        self.assertTrue(fake_redis.data.pop(AUTHORITY_INDEX_GENERATION_KEY))
+        return fake_redis.data
+
+    def test_parallel_index_matches_sequential_index(self):
+        sequential = self.create_index(workers=1)
+        parallel = self.create_index(workers=3)
+
+        self.assertTrue(sequential)
+        self.assertEqual(parallel, sequential)
+
+
+class FakeRedisServer(object):
+    def __init__(self, keys_count_by_db):
+        self.keys_count_by_db = keys_count_by_db
+        self.swapped = []
+        self.clients = []
+
+    def connect(self, db):
+        server = self
+        client = mock.Mock()
+        client.dbsize.side_effect = lambda: server.keys_count_by_db[db]
+        client.swapdb.side_effect = lambda first, second: server.swapped.append((first, second))
+        self.clients.append(client)
+        return client
+
+
+class TestSwapShadowDb(unittest.TestCase):
+
+    def swap(self, keys_count_by_db):
+        server = FakeRedisServer(keys_count_by_db)
+        with mock.patch('utils.indexer_utils.redis.Redis', side_effect=server.connect):
+            result = swap_shadow_db(8, 10, 0.9)
+
+        # all connections are closed
+        self.assertTrue(all(client.close.called for client in server.clients))
+        return result, server.swapped
+
+    def test_complete_shadow_index_is_swapped(self):
+        self.assertEqual(self.swap({8: 1000, 10: 995}), (True, [(8, 10)]))
+        self.assertEqual(self.swap({8: 0, 10: 995}), (True, [(8, 10)]))
+
+    def test_incomplete_shadow_index_is_not_swapped(self):
+        self.assertEqual(self.swap({8: 1000, 10: 500}), (False, []))
+        self.assertEqual(self.swap({8: 0, 10: 0}), (False, []))
+
+
+class FakePipeline(object):
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def mset(self, mapping):
+        self.commands.append(mapping)
+
+    def execute(self):
+        self.redis_client.max_pipeline_length = max(self.redis_client.max_pipeline_length, len(self.commands))
+        for mapping in self.commands:
+            self.redis_client.mset(mapping)
+        self.commands = []
+
+
+class TestBulkLoadToRedis(unittest.TestCase):
+
+    def test_all_items_are_loaded_in_bounded_pipelines(self):
+        fake_redis = FakeRedis()
+        fake_redis.max_pipeline_length = 0
+        fake_redis.pipeline = lambda transaction: FakePipeline(fake_redis)
+
+        items = ((f'a{num}', f'{{"wikidata_uri": "Q{num}"}}') for num in range(10501))
+        loaded_count = bulk_load_to_redis(fake_redis, items, chunk_size=100, chunks_per_pipeline=10)
+
+        self.assertEqual(loaded_count, 10501)
+        self.assertEqual(len(fake_redis.data), 10501)
+        self.assertEqual(fake_redis.data['a10500'], '{"wikidata_uri": "Q10500"}')
+        self.assertLessEqual(fake_redis.max_pipeline_length, 10)
+
+
+class TestAuthorityExternalIdsIndex(unittest.TestCase):
+
+    def test_every_build_gets_new_index_generation(self):
+        generations = []
+
+        for _ in range(2):
+            fake_redis = FakeRedis()
+            fake_redis.max_pipeline_length = 0
+            fake_redis.pipeline = lambda transaction: FakePipeline(fake_redis)
+
+            with mock.patch.object(AuthorityExternalIdsIndex, 'create_authority_external_ids_index',
+                                   return_value={'a1234567x': {'wikidata_uri': 'http://www.wikidata.org/entity/Q1'}}), \
+                    mock.patch('indexer.authority_external_ids_indexer.redis.Redis', return_value=fake_redis):
+                AuthorityExternalIdsIndex().index_in_redis()
+
+            generations.append(fake_redis.data.pop(EXTERNAL_IDS_INDEX_GENERATION_KEY))
+            self.assertEqual(list(fake_redis.data), ['a1234567x'])
+
+        self.assertNotEqual(generations[0], generations[1])
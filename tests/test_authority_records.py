@@ -0,0 +1,60 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import ujson
+from pymarc import MARCReader
+
+from indexer.authority_records_offsets_indexer import create_authority_records_offsets_index
+from utils.authority_records_utils import open_authority_records_store, convert_raw_authority_records
+
+
+PATH_TO_TEST_AUTHORITIES = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'authorities_test_100.mrc'
+
+
+class TestAuthorityRecordsStore(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path_to_records = Path(self.tmp_dir.name) / 'authorities.marc'
+        self.path_to_offsets = Path(self.tmp_dir.name) / 'authorities-offsets.db'
+        shutil.copyfile(PATH_TO_TEST_AUTHORITIES, self.path_to_records)
+
+        with open(self.path_to_records, 'rb') as fp:
+            self.records = {rcd['001'].value(): rcd for rcd in MARCReader(fp, to_unicode=True, force_utf8=True,
+                                                                           permissive=True) if rcd}
+
+        self.indexed_count = create_authority_records_offsets_index(self.path_to_records, self.path_to_offsets)
+        self.store = open_authority_records_store(self.path_to_records, self.path_to_offsets)
+
+    def tearDown(self):
+        if self.store:
+            self.store.close()
+        self.tmp_dir.cleanup()
+
+    async def test_records_are_read_by_nlp_id(self):
+        nlp_ids = list(self.records)[::10]
+
+        raw_records = await self.store.get_raw_records([*nlp_ids, 'a0000000000000'])
+
+        self.assertEqual(self.indexed_count, len(self.records))
+        self.assertIsNone(raw_records.pop('a0000000000000'))
+        self.assertEqual(raw_records, {nlp_id: self.records[nlp_id].as_marc() for nlp_id in nlp_ids})
+
+    async def test_output_formats(self):
+        nlp_id = next(iter(self.records))
+        raw_records = await self.store.get_raw_records([nlp_id, 'a0000000000000'])
+
+        as_json = ujson.loads(convert_raw_authority_records(raw_records, 'json'))
+        as_marcxml = convert_raw_authority_records(raw_records, 'marcxml')
+
+        self.assertEqual(as_json, {nlp_id: self.records[nlp_id].as_dict(), 'a0000000000000': None})
+        self.assertEqual(as_marcxml.count(b'<record'), 1)
+        self.assertEqual(convert_raw_authority_records(raw_records, 'marc'), self.records[nlp_id].as_marc())
+
+    def test_outdated_index_is_not_used(self):
+        with open(self.path_to_records, 'ab') as fp:
+            fp.write(next(iter(self.records.values())).as_marc())
+
+        self.assertIsNone(open_authority_records_store(self.path_to_records, self.path_to_offsets))
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import unittest
+from datetime import datetime, timedelta
+
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY
+from config.updater_config import UPDATER_WATERMARK_OVERLAP
+from updater.authority_updater import AuthorityUpdater, ChainEnd
+from tests.test_utils import FakeRedis, FakeSession
+from updater.updater_state import AuthorityUpdaterState, LOCK_KEY, REFRESH_LOCK_SCRIPT
+from utils.updater_utils import split_date_range
+
+
+def create_page(next_page, nlp_ids):
+    records = ''.join(f'<record><leader>00000nz  a2200000n  4500</leader>'
+                      f'<controlfield tag="001">{nlp_id}</controlfield></record>' for nlp_id in nlp_ids)
+    return (f'<resp><nextPage>{next_page}</nextPage>'
+            f'<collection xmlns="http://www.loc.gov/MARC21/slim">{records}</collection></resp>').encode('utf-8')
+
+
+class TestYieldRecordsFromDataBn(unittest.IsolatedAsyncioTestCase):
+
+    async def test_all_pages_of_all_chains_are_yielded(self):
+        pages = {'chain_1': create_page('chain_1_page_2', ['a1', 'a2']),
+                 'chain_1_page_2': create_page('', ['a3']),
+                 'chain_2': create_page('chain_2_page_2', ['a4']),
+                 'chain_2_page_2': create_page('chain_2_page_3', ['a5']),
+                 'chain_2_page_3': None}
+        session = FakeSession(pages)
+
+        nlp_ids = []
+        chain_ends = []
+        async for item in AuthorityUpdater.yield_records_from_data_bn_for_authority_index_update(
+                {'1': 'chain_1', '2': 'chain_2'}, session, prefetch_depth=1):
+            if isinstance(item, ChainEnd):
+                chain_ends.append(item)
+            else:
+                nlp_ids.extend(rcd['001'].value() for rcd in item.records)
+
+        self.assertEqual(sorted(nlp_ids), ['a1', 'a2', 'a3', 'a4', 'a5'])
+        self.assertEqual(sorted(query for query, _ in session.requests), sorted(pages))
+        self.assertEqual(sorted(chain_ends), [ChainEnd('1', True), ChainEnd('2', False)])
+
+    async def test_producer_cancelled_with_full_queue_finishes(self):
+        session = FakeSession({'chain_1': create_page('chain_1_page_2', ['a1']),
+                               'chain_1_page_2': create_page('chain_1_page_3', ['a2'])})
+        queue = asyncio.Queue(maxsize=1)
+        producer = asyncio.ensure_future(
+            AuthorityUpdater.fetch_records_from_data_bn_for_authority_index_update('1', 'chain_1', session, queue))
+
+        # consumer is gone - producer waits for free slot in full queue
+        while not queue.full():
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        producer.cancel()
+
+        await asyncio.wait_for(asyncio.gather(producer, return_exceptions=True), timeout=1)
+        self.assertTrue(producer.cancelled())
+
+
+class FakeUpdaterState(object):
+    def __init__(self):
+        self.cursors = {}
+
+    async def save_cursor(self, chain_id, next_query):
+        self.cursors[chain_id] = next_query or ''
+
+
+class TestUpdateResume(unittest.IsolatedAsyncioTestCase):
+
+    async def test_interrupted_chain_is_resumed_from_saved_cursor(self):
+        pages = {'chain_1': create_page('', ['a1']),
+                 'chain_2': create_page('chain_2_page_2', ['a2']),
+                 'chain_2_page_2': None}
+        session = FakeSession(pages)
+        updater_state = FakeUpdaterState()
+        updater = AuthorityUpdater()
+
+        completed = await updater.update_updated_records_in_authority_index(
+            {'1': 'chain_1', '2': 'chain_2'}, session, FakeRedis({}), updater_state)
+
+        self.assertFalse(completed)
+        self.assertEqual(updater_state.cursors, {'1': '', '2': 'chain_2_page_2'})
+
+        # upstream is back - only not completed chain is fetched, starting from the saved cursor
+        pages['chain_2_page_2'] = create_page('', ['a3'])
+        session.requests.clear()
+        remaining_queries = {chain_id: query for chain_id, query in updater_state.cursors.items() if query}
+
+        completed = await updater.update_updated_records_in_authority_index(
+            remaining_queries, session, FakeRedis({}), updater_state)
+
+        self.assertTrue(completed)
+        self.assertEqual(session.requests, [('chain_2_page_2', None)])
+        self.assertEqual(updater_state.cursors, {'1': '', '2': ''})
+
+
+class FakeStateRedis(object):
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+
+    def __init__(self):
+        self.data = {}
+        self.refreshed = 0
+
+    async def set(self, key, value, expire=None, exist=None):
+        if exist and key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    async def eval(self, script, keys, args):
+        if script == REFRESH_LOCK_SCRIPT and self.data.get(keys[0]) == args[0]:
+            self.refreshed += 1
+            return 1
+        return 0
+
+
+class TestUpdaterLock(unittest.IsolatedAsyncioTestCase):
+
+    async def test_lock_is_refreshed_by_heartbeat_until_cancelled(self):
+        conn_state = FakeStateRedis()
+        updater_state = AuthorityUpdaterState(conn_state, owner='worker-1')
+        self.assertTrue(await updater_state.acquire_lock())
+
+        # long phase without saved cursors (e.g. removing deleted records)
+        lock_heartbeat = asyncio.ensure_future(updater_state.keep_lock(interval=0.01))
+        await asyncio.sleep(0.05)
+        lock_heartbeat.cancel()
+        refreshed = conn_state.refreshed
+        await asyncio.sleep(0.03)
+
+        self.assertGreaterEqual(refreshed, 2)
+        self.assertEqual(conn_state.refreshed, refreshed)
+
+    async def test_lock_of_other_worker_is_not_refreshed(self):
+        conn_state = FakeStateRedis()
+        self.assertTrue(await AuthorityUpdaterState(conn_state, owner='worker-1').acquire_lock())
+
+        self.assertFalse(await AuthorityUpdaterState(conn_state, owner='worker-2').acquire_lock())
+        self.assertFalse(await AuthorityUpdaterState(conn_state, owner='worker-2').refresh_lock())
+        self.assertEqual(conn_state.data[LOCK_KEY], 'worker-1')
+
+
+class TestUpdateWindow(unittest.TestCase):
+
+    def test_window_starts_at_watermark(self):
+        updater = AuthorityUpdater()
+        watermark = datetime(2021, 6, 1, 12, 0)
+
+        self.assertEqual(updater.get_update_date_from(watermark),
+                         watermark - timedelta(seconds=UPDATER_WATERMARK_OVERLAP))
+        # without watermark (first update) the default window is used
+        self.assertLess(updater.get_update_date_from(None), updater.last_auth_update - timedelta(days=1))
+
+
+class TestSplitDateRange(unittest.TestCase):
+
+    def test_sub_ranges_are_adjacent(self):
+        sub_ranges = split_date_range(datetime(2021, 6, 1), datetime(2021, 6, 3), 4)
+
+        self.assertEqual(sub_ranges, [('2021-06-01T00:00:00Z', '2021-06-01T12:00:00Z'),
+                                      ('2021-06-01T12:00:00Z', '2021-06-02T00:00:00Z'),
+                                      ('2021-06-02T00:00:00Z', '2021-06-02T12:00:00Z'),
+                                      ('2021-06-02T12:00:00Z', '2021-06-03T00:00:00Z')])
+
+
+def create_entry(nlp_id, heading, heading_tag='100'):
+    to_update = {'nlp_id': nlp_id, 'mms_id': None, 'viaf_id': None, 'coords': None,
+                 'heading': heading, 'heading_tag': heading_tag}
+    return heading.upper(), to_update, json.dumps(to_update)
+
+
+class TestGetAuthorityIndexChanges(unittest.TestCase):
+
+    def test_changes_follow_heading_and_130_rules(self):
+        unchanged = create_entry('a1', 'Kowalski Jan')
+        modified = create_entry('a2', 'Nowak Anna')
+        renamed = create_entry('a3', 'Polska')
+        skipped_130 = create_entry('a4', 'Pan Tadeusz', heading_tag='130')
+        new = create_entry('a5', 'Powieść polska', heading_tag='155')
+
+        entries = {entry[1]['nlp_id']: entry for entry in [unchanged, modified, renamed, skipped_130, new]}
+        auths_to_update = {'a1': unchanged[2],
+                           'a2': json.dumps(dict(modified[1], viaf_id='12345')),
+                           'a3': json.dumps(dict(renamed[1], heading='Polska (państwo)')),
+                           'a4': json.dumps(dict(skipped_130[1], heading_tag='100', viaf_id='1'))}
+
+        headings_to_delete, entries_to_set = AuthorityUpdater.get_authority_index_changes(entries, auths_to_update)
+
+        self.assertEqual(headings_to_delete, ['POLSKA PAŃSTWO'])
+        self.assertEqual(entries_to_set, {'a2': modified[2], 'NOWAK ANNA': modified[2],
+                                          'a3': renamed[2], 'POLSKA': renamed[2],
+                                          'a5': new[2], 'POWIEŚĆ POLSKA': new[2]})
+
+
+class TestRemoveDeletedRecords(unittest.IsolatedAsyncioTestCase):
+
+    async def test_deleted_records_are_removed_in_single_transaction(self):
+        heading, to_update, json_to_update = create_entry('a1', 'Kowalski Jan')
+        conn_auth_int = FakeRedis({'a1': json_to_update, heading: json_to_update, 'a2': json_to_update})
+
+        await AuthorityUpdater.remove_deleted_records_from_authority_index(['a1', 'a9'], conn_auth_int)
+
+        # index generation is changed in the same transaction
+        self.assertTrue(conn_auth_int.data.pop(AUTHORITY_INDEX_GENERATION_KEY))
+        self.assertEqual(conn_auth_int.data, {'a2': json_to_update})
+        self.assertEqual(conn_auth_int.mget_calls, 1)
+        self.assertEqual(len(conn_auth_int.transactions), 1)
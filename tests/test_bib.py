@@ -0,0 +1,49 @@
+import json
+import unittest
+from pathlib import Path
+
+from pymarc import MARCReader, marcxml
+
+from objects.bib import BibliographicRecordsChunk
+from tests.test_utils import FakeRedis, FakeSession
+import utils.cache_utils
+
+
+PATH_TO_TEST_BIBS = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'bibs_test_100.mrc'
+NEXT_PAGE = 'http://data.bn.org.pl/api/bibs.marcxml?sinceId=100&amp;limit=100'
+
+
+def create_data_bn_response():
+    with open(PATH_TO_TEST_BIBS, 'rb') as fp:
+        records = [marcxml.record_to_xml(rcd, namespace=True) for rcd in
+                   MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore', permissive=True) if rcd]
+
+    return b''.join([f'<resp><nextPage>{NEXT_PAGE}</nextPage><collection>'.encode('utf-8'),
+                     *records,
+                     b'</collection></resp>'])
+
+
+class FakeQueryParams(dict):
+    def __str__(self):
+        return '&'.join(f'{key}={value}' for key, value in self.items())
+
+
+class TestBibliographicRecordsChunk(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        utils.cache_utils.authority_int_cache.clear()
+        utils.cache_utils.upstream_response_cache.clear()
+
+    async def create_chunk(self, stream):
+        conn_auth = FakeRedis(default=json.dumps({'nlp_id': 'a0000001234567', 'mms_id': '9810000000005606'}))
+        return await BibliographicRecordsChunk(FakeSession(create_data_bn_response()), conn_auth, conn_auth,
+                                               FakeQueryParams(limit=100), 'nlp_id', stream=stream)
+
+    async def test_streamed_output_matches_whole_page_output(self):
+        whole_page = (await self.create_chunk(stream=False)).xml_processed_chunk
+        streamed_chunk = await self.create_chunk(stream=True)
+        streamed = [part async for part in streamed_chunk.stream_output_xml()]
+
+        self.assertEqual(b''.join(streamed), whole_page)
+        self.assertEqual(len(streamed), 102)
+        self.assertTrue(streamed[0].startswith(b'<resp><nextPage>http://'))
@@ -0,0 +1,131 @@
+import time
+import unittest
+
+import ujson
+
+import utils.cache_utils
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY
+from tests.test_utils import FakeRedis, FakeResponse, FakeSession
+from updater.authority_updater import AuthorityUpdater
+from utils.serialization_utils import decode_authority_value
+
+
+class TestLRUTTLCache(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = utils.cache_utils.LRUTTLCache(max_size=2)
+        cache.set('POLSKA', {'nlp_id': 'a0000001'})
+        cache.set('POWIEŚĆ POLSKA', {'nlp_id': 'a0000002'})
+        cache.get('POLSKA')
+        cache.set('HISTORIA', None)
+
+        self.assertEqual(cache.get('POLSKA'), {'nlp_id': 'a0000001'})
+        self.assertIs(cache.get('POWIEŚĆ POLSKA'), utils.cache_utils.MISSING)
+        self.assertIsNone(cache.get('HISTORIA'))
+
+    def test_expired_entry_is_evicted(self):
+        cache = utils.cache_utils.LRUTTLCache(max_size=2, ttl=0.01)
+        cache.set('POLSKA', {'nlp_id': 'a0000001'})
+        time.sleep(0.02)
+
+        self.assertIs(cache.get('POLSKA'), utils.cache_utils.MISSING)
+        self.assertEqual(len(cache), 0)
+
+    def test_hits_and_misses_are_counted(self):
+        cache = utils.cache_utils.LRUTTLCache(max_size=2)
+        cache.set('POLSKA', {'nlp_id': 'a0000001'})
+        cache.get('POLSKA')
+        cache.invalidate('POLSKA')
+        cache.get('POLSKA')
+
+        self.assertEqual(cache.get_stats()['hits'], 1)
+        self.assertEqual(cache.get_stats()['misses'], 1)
+
+
+class TestMgetWithCacheGeneration(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.entry = ujson.dumps({'nlp_id': 'a1', 'heading': 'Kowalski Jan'})
+        self.conn_auth_int = FakeRedis({'a1': self.entry, 'KOWALSKI JAN': self.entry})
+        # caches of two uvicorn workers
+        self.caches = [utils.cache_utils.LRUTTLCache(10, ttl=3600, generation_key=AUTHORITY_INDEX_GENERATION_KEY)
+                       for _ in range(2)]
+
+    async def lookup(self, cache, keys):
+        return await utils.cache_utils.mget_with_cache(self.conn_auth_int, keys, cache, decode_authority_value)
+
+    async def test_update_in_one_worker_invalidates_caches_of_all_workers(self):
+        for cache in self.caches:
+            self.assertEqual((await self.lookup(cache, ['KOWALSKI JAN', 'NOWAK ADAM']))['KOWALSKI JAN']['nlp_id'],
+                             'a1')
+
+        # first worker runs the update: a1 is deleted and NOWAK ADAM (cached miss) is added
+        await AuthorityUpdater.remove_deleted_records_from_authority_index(['a1'], self.conn_auth_int)
+        tr = self.conn_auth_int.multi_exec()
+        tr.set('NOWAK ADAM', ujson.dumps({'nlp_id': 'a2', 'heading': 'Nowak Adam'}))
+        tr.set(AUTHORITY_INDEX_GENERATION_KEY, utils.cache_utils.new_index_generation())
+        await tr.execute()
+
+        for cache in self.caches:
+            resolved = await self.lookup(cache, ['KOWALSKI JAN', 'NOWAK ADAM'])
+            self.assertIsNone(resolved['KOWALSKI JAN'])
+            self.assertEqual(resolved['NOWAK ADAM']['nlp_id'], 'a2')
+
+    async def test_cached_keys_are_used_while_generation_is_the_same(self):
+        await self.lookup(self.caches[0], ['KOWALSKI JAN'])
+        self.conn_auth_int.data['KOWALSKI JAN'] = None
+
+        resolved = await self.lookup(self.caches[0], ['KOWALSKI JAN'])
+
+        self.assertEqual(resolved['KOWALSKI JAN']['nlp_id'], 'a1')
+        # generation is checked with every lookup (single MGET)
+        self.assertEqual(self.conn_auth_int.mget_calls, 2)
+
+
+class TestUpstreamResponseCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test_repeated_query_is_served_from_cache(self):
+        cache = utils.cache_utils.UpstreamResponseCache(max_bytes=1000, max_entry_bytes=100, ttl=60)
+        session = FakeSession([FakeResponse(b'<resp/>')])
+
+        first = await utils.cache_utils.get_with_cache(session, 'http://data.bn.org.pl/api/bibs.marcxml?a=1&b=2',
+                                                       cache)
+        second = await utils.cache_utils.get_with_cache(session, 'http://DATA.bn.org.pl/api/bibs.marcxml?b=2&a=1',
+                                                        cache)
+
+        self.assertEqual(first, (200, b'<resp/>'))
+        self.assertEqual(second, (200, b'<resp/>'))
+        self.assertEqual(len(session.requests), 1)
+
+    async def test_expired_entry_is_revalidated(self):
+        cache = utils.cache_utils.UpstreamResponseCache(max_bytes=1000, max_entry_bytes=100, ttl=0.01)
+        session = FakeSession([FakeResponse(b'<resp/>', headers={'ETag': '"v1"'}), FakeResponse(status=304)])
+
+        await utils.cache_utils.get_with_cache(session, 'http://data.bn.org.pl/api/bibs.marc?id=1', cache)
+        time.sleep(0.02)
+        revalidated = await utils.cache_utils.get_with_cache(session, 'http://data.bn.org.pl/api/bibs.marc?id=1',
+                                                             cache)
+
+        self.assertEqual(revalidated, (200, b'<resp/>'))
+        self.assertEqual(session.requests[1][1], {'If-None-Match': '"v1"'})
+        self.assertEqual(cache.revalidated, 1)
+
+    async def test_errors_are_not_cached(self):
+        cache = utils.cache_utils.UpstreamResponseCache(max_bytes=1000, max_entry_bytes=100, ttl=60)
+        session = FakeSession([FakeResponse(status=503), FakeResponse(b'<resp/>')])
+
+        self.assertEqual(await utils.cache_utils.get_with_cache(session, 'http://data.bn.org.pl/x', cache), (503, None))
+        self.assertEqual(await utils.cache_utils.get_with_cache(session, 'http://data.bn.org.pl/x', cache),
+                         (200, b'<resp/>'))
+
+    def test_cache_is_bounded_by_size_of_bodies(self):
+        cache = utils.cache_utils.UpstreamResponseCache(max_bytes=10, max_entry_bytes=6, ttl=60)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        cache.set('c', b'12345')
+        cache.set('too_large', b'1234567')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('too_large'))
+        self.assertEqual(cache.get('c').body, b'12345')
+        self.assertEqual(cache.size_in_bytes, 10)
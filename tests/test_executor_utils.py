@@ -0,0 +1,30 @@
+import unittest
+
+from pymarc_patches.parser_backends import parse_marcxml_bytes
+from utils.executor_utils import create_cpu_executor, run_cpu_bound
+from utils.marc_utils import records_to_marcxml
+from tests.test_bib import create_data_bn_response
+
+
+class TestRunCpuBound(unittest.IsolatedAsyncioTestCase):
+
+    async def test_executors_give_the_same_output_as_event_loop(self):
+        content = create_data_bn_response()
+        expected_next_page, expected_records = parse_marcxml_bytes(content, 'NFC')
+        expected_xml = records_to_marcxml(expected_records)
+
+        for kind in ['thread', 'process']:
+            executor = create_cpu_executor(kind, max_workers=1)
+            try:
+                next_page, records = await run_cpu_bound(parse_marcxml_bytes, content, 'NFC', executor=executor)
+                records_xml = await run_cpu_bound(records_to_marcxml, records, executor=executor)
+            finally:
+                executor.shutdown()
+
+            self.assertEqual(next_page, expected_next_page)
+            self.assertEqual(records_xml, expected_xml)
+
+    def test_unknown_executor_kind(self):
+        self.assertIsNone(create_cpu_executor(None))
+        with self.assertRaises(ValueError):
+            create_cpu_executor('gpu')
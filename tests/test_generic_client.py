@@ -0,0 +1,47 @@
+import random
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlite_clients.generic_client import GenericClient
+
+
+def reference_best_scores(rows, dict_key_name, id_processing_method):
+    # original row by row filtering - golden reference
+    filtered_dict = {}
+    for nlp_id, fetched_id, score, max_score in rows:
+        fetched_from_f_dict = filtered_dict.get(nlp_id)
+        if (fetched_from_f_dict and score >= fetched_from_f_dict['score']) or not fetched_from_f_dict:
+            fetched_id = fetched_id if not id_processing_method else id_processing_method(fetched_id)
+            filtered_dict[nlp_id] = {dict_key_name: fetched_id, 'score': score}
+    for external_ids_dict in filtered_dict.values():
+        external_ids_dict.pop('score')
+    return filtered_dict
+
+
+class TestGenericClient(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path_to_db = str(Path(self.tmp_dir.name) / 'test_wikidata_bn.db')
+
+        rnd = random.Random(0)
+        self.rows = [(f'a{rnd.randint(0, 200):013d}', f'Q{num}', rnd.choice([0.5, 0.75, 0.9, 1.0]), 1.0)
+                     for num in range(2000)]
+
+        conn = sqlite3.connect(self.path_to_db)
+        conn.execute('CREATE TABLE results (bn__descr_nlp_id TEXT, result__wkp_id TEXT, score REAL, max_score REAL)')
+        conn.executemany('INSERT INTO results VALUES (?, ?, ?, ?)', self.rows)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_best_scores_match_row_by_row_filtering(self):
+        id_processing_method = lambda wkp_id: f'http://www.wikidata.org/entity/{wkp_id}'
+        index = GenericClient(self.path_to_db, 'result__wkp_id', 'wikidata_uri',
+                              id_processing_method=id_processing_method, fetch_batch_size=7).create_index()
+
+        self.assertEqual(index, reference_best_scores(self.rows, 'wikidata_uri', id_processing_method))
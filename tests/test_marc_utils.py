@@ -0,0 +1,162 @@
+import copy
+import json
+import re
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from pymarc import MARCReader
+
+import utils.marc_utils
+import utils.cache_utils
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY, EXTERNAL_IDS_INDEX_GENERATION_KEY
+from tests.test_utils import FakeRedis
+from utils.metrics_utils import Metrics, STAGE_DURATION
+
+
+PATH_TO_TEST_BIBS = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'bibs_test_100.mrc'
+PATH_TO_TEST_AUTHORITIES = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'authorities_test_100.mrc'
+
+
+def reference_prepare_name_for_indexing(descriptor_name):
+    # original (character by character) implementation - golden reference
+    if descriptor_name:
+        descriptor_name = ''.join(char.replace(char, ' ') if not char.isalnum() else char for char in descriptor_name)
+        descriptor_name = re.sub(r'\s{2,}', ' ', descriptor_name)
+        descriptor_name = descriptor_name.strip()
+        descriptor_name = descriptor_name.upper()
+    return descriptor_name
+
+
+def read_test_bibs(path_to_test_file=PATH_TO_TEST_BIBS):
+    with open(path_to_test_file, 'rb') as fp:
+        return [rcd for rcd in MARCReader(fp, to_unicode=True, force_utf8=True,
+                                          utf8_handling='ignore', permissive=True) if rcd]
+
+
+def create_fake_indexes(records):
+    internal, external = {}, {}
+
+    for num, rcd in enumerate(records):
+        for fld in rcd.get_fields('100', '650', '651', '655', '700'):
+            term = utils.marc_utils.prepare_name_for_indexing(' '.join(fld.get_subfields('a', 'b', 'c', 'd')))
+            nlp_id = f'a{num:013d}'
+            internal.setdefault(term, json.dumps({'nlp_id': nlp_id, 'mms_id': f'98{num}', 'viaf_id': None,
+                                                  'coords': None, 'heading': term, 'heading_tag': fld.tag}))
+            external.setdefault(utils.marc_utils.transform_nlp_id(nlp_id),
+                                json.dumps({'wikidata_uri': f'http://www.wikidata.org/entity/Q{num}'}))
+
+    return FakeRedis(internal), FakeRedis(external)
+
+
+class TestPrepareNameForIndexing(unittest.TestCase):
+
+    def test_output_matches_reference_on_test_files(self):
+        names = ['', None, '  Kowalski,  Jan (1901-1980).  ', 'Powieść polska -- 20 w.', 'Straße\tß\u00a0ﬁ x²',
+                 'Ǆemal\u0301 \u2003 ½ Ⅻ', 'a\x1fb\u200bc']
+
+        for path_to_test_file in [PATH_TO_TEST_BIBS, PATH_TO_TEST_AUTHORITIES]:
+            for rcd in read_test_bibs(path_to_test_file):
+                for fld in rcd.fields:
+                    names.append(fld.value())
+                    if not fld.is_control_field():
+                        names.extend(fld.get_subfields(*'abcdnptxyz'))
+                        names.append(' '.join(fld.get_subfields('a', 'b', 'c', 'd')))
+
+        expected = [reference_prepare_name_for_indexing(name) for name in names]
+
+        self.assertEqual([utils.marc_utils.prepare_name_for_indexing(name) for name in names], expected)
+        self.assertEqual(utils.marc_utils.prepare_names_for_indexing(names), expected)
+
+
+def clear_authority_caches():
+    utils.cache_utils.authority_int_cache.clear()
+    utils.cache_utils.authority_ext_cache.clear()
+
+
+class TestProcessRecordsChunk(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        clear_authority_caches()
+
+    async def test_chunk_matches_per_record_processing(self):
+        records = read_test_bibs()
+        conn_int, conn_ext = create_fake_indexes(records)
+
+        for identifier_type in ['nlp_id', 'mms_id', 'all_ids']:
+            expected = [await utils.marc_utils.process_record(rcd, conn_int, identifier_type, conn_ext)
+                        for rcd in copy.deepcopy(records)]
+
+            clear_authority_caches()
+            conn_int.mget_calls, conn_ext.mget_calls = 0, 0
+            result = await utils.marc_utils.process_records_chunk(copy.deepcopy(records), conn_int,
+                                                                  identifier_type, conn_ext)
+
+            self.assertEqual([rcd.as_marc() for rcd in result], [rcd.as_marc() for rcd in expected])
+            self.assertEqual(conn_int.mget_calls, 1)
+            self.assertEqual(conn_ext.mget_calls, 1 if identifier_type == 'all_ids' else 0)
+
+    async def test_cached_terms_are_not_sent_to_redis(self):
+        records = read_test_bibs()
+        conn_int, conn_ext = create_fake_indexes(records)
+
+        await utils.marc_utils.process_records_chunk(copy.deepcopy(records), conn_int, 'all_ids', conn_ext)
+        conn_int.mget_calls, conn_ext.mget_calls = 0, 0
+        conn_int.mget_keys.clear()
+        conn_ext.mget_keys.clear()
+        await utils.marc_utils.process_records_chunk(copy.deepcopy(records), conn_int, 'all_ids', conn_ext)
+
+        # only generations of indexes are checked
+        self.assertEqual(conn_int.mget_calls, 1)
+        self.assertEqual(conn_int.mget_keys, [AUTHORITY_INDEX_GENERATION_KEY])
+        self.assertEqual(conn_ext.mget_calls, 1)
+        self.assertEqual(conn_ext.mget_keys, [EXTERNAL_IDS_INDEX_GENERATION_KEY])
+
+    async def test_extracted_terms_match_processed_records_and_records_are_not_modified(self):
+        records = read_test_bibs()
+        conn_int, conn_ext = create_fake_indexes(records)
+        records_before = [rcd.as_marc() for rcd in records]
+
+        resolved_terms_per_record = await utils.marc_utils.extract_and_resolve_terms_chunk(records, conn_int,
+                                                                                           'all_ids', conn_ext)
+
+        self.assertEqual([rcd.as_marc() for rcd in records], records_before)
+
+        for rcd, resolved_terms in zip(records, resolved_terms_per_record):
+            processed_record = await utils.marc_utils.process_record(copy.deepcopy(rcd), conn_int, 'all_ids',
+                                                                     conn_ext, polona=True)
+
+            self.assertEqual(list(dict.fromkeys(term for _, term, _ in resolved_terms)), list(processed_record))
+            for tag, term, resolved_ids in resolved_terms:
+                self.assertIn(tag, [raw_fld.tag for raw_fld in processed_record[term]['raw_flds']])
+                self.assertEqual(resolved_ids, {ids_type: ids for ids_type, ids in processed_record[term].items()
+                                                if ids_type != 'raw_flds'})
+
+
+class TestStreamRecordsToMarcxml(unittest.IsolatedAsyncioTestCase):
+
+    async def test_records_are_yielded_slice_by_slice(self):
+        records = read_test_bibs()[:12]
+        worker_metrics = Metrics()
+        serialized_slices = []
+        original_records_to_marcxml = utils.marc_utils.records_to_marcxml
+
+        def records_to_marcxml(marc_records):
+            serialized_slices.append(len(marc_records))
+            return original_records_to_marcxml(marc_records)
+
+        streamed = []
+        # serialized on the event loop (local function can't be sent to process executor)
+        with mock.patch('utils.marc_utils.records_to_marcxml', records_to_marcxml), \
+                mock.patch('utils.marc_utils.metrics', worker_metrics), \
+                mock.patch('utils.executor_utils.get_cpu_executor', return_value=None):
+            async for rcd_xml in utils.marc_utils.stream_records_to_marcxml(records, slice_size=5):
+                # the first record is sent before the rest of page is serialized
+                streamed.append((rcd_xml, len(serialized_slices)))
+
+        self.assertEqual([rcd_xml for rcd_xml, _ in streamed], utils.marc_utils.records_to_marcxml(records))
+        self.assertEqual(serialized_slices, [5, 5, 2])
+        self.assertEqual(streamed[0][1], 1)
+
+        # time of all slices is observed once
+        self.assertEqual(worker_metrics._pending[f'{STAGE_DURATION}_count{{stage="serialization"}}'], 1)
@@ -0,0 +1,121 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from utils.cache_utils import LRUTTLCache, mget_with_cache
+from utils.metrics_utils import Metrics, METRICS_KEY, STAGE_DURATION, RECORDS, CACHE_LOOKUPS
+from utils.metrics_utils import render_metrics, set_request_labels
+
+
+class FakePipeline(object):
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def hincrbyfloat(self, key, field, increment):
+        self.commands.append((key, field, increment))
+
+    async def execute(self):
+        if self.redis_client.broken:
+            raise ConnectionError()
+        for key, field, increment in self.commands:
+            hash_value = self.redis_client.data.setdefault(key, {})
+            hash_value[field] = hash_value.get(field, 0) + increment
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+        self.broken = False
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    async def hgetall(self, key):
+        # redis returns floats as strings
+        return {field: f'{value:g}' for field, value in self.data.get(key, {}).items()}
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    async def test_metrics_of_all_workers_are_aggregated(self):
+        conn_state = FakeRedis()
+        workers = [Metrics(buckets=(0.1, 1.0)), Metrics(buckets=(0.1, 1.0))]
+
+        async def handle_request(worker_metrics, identifier_type, duration):
+            set_request_labels('bibs', identifier_type)
+            worker_metrics.inc(RECORDS, 100)
+            worker_metrics.observe(STAGE_DURATION, duration, stage='total')
+
+        # every request is handled in its own task (labels are not shared between requests)
+        await asyncio.gather(asyncio.ensure_future(handle_request(workers[0], 'nlp_id', 0.05)),
+                             asyncio.ensure_future(handle_request(workers[1], 'nlp_id', 0.5)),
+                             asyncio.ensure_future(handle_request(workers[1], 'unknown', 2.0)))
+        for worker_metrics in workers:
+            await worker_metrics.flush(conn_state)
+
+        totals = await conn_state.hgetall(METRICS_KEY)
+        labels = 'endpoint="bibs",identifier_type="nlp_id"'
+
+        self.assertEqual(totals[f'{RECORDS}{{{labels}}}'], '200')
+        self.assertEqual(totals[f'{RECORDS}{{endpoint="bibs",identifier_type="other"}}'], '100')
+        self.assertEqual(totals[f'{STAGE_DURATION}_bucket{{{labels},le="0.1",stage="total"}}'], '1')
+        self.assertEqual(totals[f'{STAGE_DURATION}_bucket{{{labels},le="1.0",stage="total"}}'], '2')
+        self.assertEqual(totals[f'{STAGE_DURATION}_bucket{{{labels},le="+Inf",stage="total"}}'], '2')
+        self.assertEqual(totals[f'{STAGE_DURATION}_count{{{labels},stage="total"}}'], '2')
+
+    async def test_not_flushed_metrics_are_kept(self):
+        conn_state = FakeRedis()
+        worker_metrics = Metrics()
+        worker_metrics.inc(RECORDS, 10)
+
+        conn_state.broken = True
+        with self.assertRaises(ConnectionError):
+            await worker_metrics.flush(conn_state)
+
+        conn_state.broken = False
+        worker_metrics.inc(RECORDS, 5)
+        await worker_metrics.flush(conn_state)
+
+        self.assertEqual(await conn_state.hgetall(METRICS_KEY), {RECORDS: '15'})
+
+    async def test_cache_lookups_are_counted(self):
+        conn_state = FakeRedis()
+        worker_metrics = Metrics()
+        cache = LRUTTLCache(10, name='test')
+
+        class FakeIndex(object):
+            async def mget(self, *keys):
+                return [None for _ in keys]
+
+        with mock.patch('utils.cache_utils.metrics', worker_metrics):
+            await mget_with_cache(FakeIndex(), ['A', 'B'], cache, str)
+            await mget_with_cache(FakeIndex(), ['A', 'C'], cache, str)
+        await worker_metrics.flush(conn_state)
+
+        totals = await conn_state.hgetall(METRICS_KEY)
+        self.assertEqual(totals[f'{CACHE_LOOKUPS}{{cache="test",result="hit"}}'], '1')
+        self.assertEqual(totals[f'{CACHE_LOOKUPS}{{cache="test",result="miss"}}'], '3')
+        self.assertEqual(totals[f'{STAGE_DURATION}_count{{stage="redis_lookup"}}'], '2')
+
+
+class TestRenderMetrics(unittest.TestCase):
+
+    def test_prometheus_text_format(self):
+        totals = {f'{STAGE_DURATION}_bucket{{le="+Inf",stage="parse"}}': '3',
+                  f'{STAGE_DURATION}_bucket{{le="0.5",stage="parse"}}': '2',
+                  f'{STAGE_DURATION}_sum{{stage="parse"}}': '0.75',
+                  f'{STAGE_DURATION}_count{{stage="parse"}}': '3',
+                  f'{RECORDS}{{endpoint="bibs"}}': '100'}
+
+        lines = render_metrics(totals).splitlines()
+
+        self.assertEqual(lines, [f'# HELP {RECORDS} Processed marc records.',
+                                 f'# TYPE {RECORDS} counter',
+                                 f'{RECORDS}{{endpoint="bibs"}} 100',
+                                 lines[3],
+                                 f'# TYPE {STAGE_DURATION} histogram',
+                                 f'{STAGE_DURATION}_bucket{{le="0.5",stage="parse"}} 2',
+                                 f'{STAGE_DURATION}_bucket{{le="+Inf",stage="parse"}} 3',
+                                 f'{STAGE_DURATION}_count{{stage="parse"}} 3',
+                                 f'{STAGE_DURATION}_sum{{stage="parse"}} 0.75'])
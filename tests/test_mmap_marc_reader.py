@@ -0,0 +1,116 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from pymarc import MARCReader
+
+from utils.mmap_marc_reader import MmapMARCReader
+
+
+PATH_TO_TEST_BIBS = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'bibs_test_100.mrc'
+
+
+def read_with_marc_reader(content):
+    return [rcd.as_marc() for rcd in MARCReader(content, to_unicode=True, force_utf8=True, utf8_handling='ignore',
+                                                permissive=True) if rcd]
+
+
+class TestMmapMARCReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.content = PATH_TO_TEST_BIBS.read_bytes()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_file(self, content):
+        path_to_file = Path(self.tmp_dir.name) / 'bibs.mrc'
+        path_to_file.write_bytes(content)
+        return str(path_to_file)
+
+    def test_records_match_marc_reader(self):
+        with MmapMARCReader(str(PATH_TO_TEST_BIBS)) as rdr:
+            records = [rcd.as_marc() for rcd in rdr]
+            raw_records = [bytes(raw_record) for raw_record in rdr.iter_raw()]
+
+            self.assertEqual(records, read_with_marc_reader(self.content))
+            self.assertEqual(b''.join(raw_records), self.content)
+            self.assertEqual((rdr.count, rdr.failed), (100, 0))
+
+    def test_random_access_by_ordinal(self):
+        expected = read_with_marc_reader(self.content)
+
+        with MmapMARCReader(str(PATH_TO_TEST_BIBS)) as rdr:
+            self.assertEqual(len(rdr), 100)
+            self.assertEqual(rdr[57].as_marc(), expected[57])
+
+            # records from byte range of the file (e.g. batch of worker process)
+            start, end = rdr.get_byte_range(20, 30)
+
+        with MmapMARCReader(str(PATH_TO_TEST_BIBS), start, end) as rdr:
+            self.assertEqual([rcd.as_marc() for rcd in rdr], expected[20:30])
+
+    def test_corrupted_records_are_skipped(self):
+        first, second = read_with_marc_reader(self.content)[:2]
+        corrupted_leader = b'xxxxx' + first[5:]
+        corrupted_directory = first[:12] + b'99999' + first[17:]
+        truncated = second[:100]
+        path_to_file = self.write_file(first + corrupted_leader + corrupted_directory + second + truncated)
+
+        with MmapMARCReader(path_to_file) as rdr:
+            records = [rcd.as_marc() for rcd in rdr]
+
+            self.assertEqual(records, [first, second])
+            self.assertEqual((rdr.count, rdr.failed), (5, 3))
+
+    def test_offsets_index_is_cached(self):
+        path_to_file = self.write_file(self.content)
+        offsets_index_path = str(Path(self.tmp_dir.name) / 'bibs.idx')
+
+        with MmapMARCReader(path_to_file, offsets_index_path=offsets_index_path) as rdr:
+            offsets = rdr.offsets
+
+        with mock.patch.object(MmapMARCReader, 'build_offsets') as build_offsets:
+            with MmapMARCReader(path_to_file, offsets_index_path=offsets_index_path) as rdr:
+                self.assertEqual(rdr.offsets, offsets)
+            build_offsets.assert_not_called()
+
+        # modified file - index is rebuilt
+        self.write_file(self.content[:offsets[10]])
+        os.utime(path_to_file, ns=(0, 0))
+
+        with MmapMARCReader(path_to_file, offsets_index_path=offsets_index_path) as rdr:
+            self.assertEqual(len(rdr), 10)
+
+    def test_reader_is_closed_after_break_out_of_iteration(self):
+        with MmapMARCReader(str(PATH_TO_TEST_BIBS)) as rdr:
+            records = rdr.iter_records()
+            raw_records = rdr.iter_raw()
+            first_record, first_raw_record = next(records), next(raw_records)
+
+        # iterators are not exhausted and raw slice is still referenced
+        self.assertEqual(first_record.as_marc(), bytes(first_raw_record))
+        self.assertTrue(rdr.file_handle.closed)
+
+    def test_error_raised_while_iterating_is_not_hidden(self):
+        processed = []
+
+        def fail_on_third(rcd):
+            processed.append(rcd)
+            if len(processed) == 3:
+                raise KeyError('third')
+            return rcd
+
+        with self.assertRaises(KeyError) as raised:
+            with MmapMARCReader(str(PATH_TO_TEST_BIBS)) as rdr:
+                [fail_on_third(rcd) for rcd in rdr]
+
+        with self.assertRaises(ValueError):
+            with MmapMARCReader(str(PATH_TO_TEST_BIBS)) as rdr:
+                for raw_record in rdr.iter_raw():
+                    raise ValueError('raised with raw slice referenced')
+
+        self.assertEqual(raised.exception.args, ('third',))
@@ -0,0 +1,117 @@
+import json
+import unittest
+from pathlib import Path
+
+import ujson
+from pymarc import MARCReader
+
+from config.polona_lod_config import POLONA_LOD_DOCUMENT_TTL, POLONA_LOD_STALE_KEY
+from objects.polona_lod import PolonaLodRecord, create_polona_lod_documents, create_polona_lod_jsons_batch
+from tests.test_utils import FakeRedis, FakeSession
+from updater.authority_updater import AuthorityUpdater
+from utils.polona_lod_store_utils import add_polona_lod_documents_to_pipeline, mark_polona_lod_documents_stale
+from utils.polona_lod_store_utils import pop_stale_polona_lod_documents
+import utils.cache_utils
+
+
+PATH_TO_TEST_BIBS = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'bibs_test_100.mrc'
+
+
+class TestPolonaLodDocuments(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        for cache in [utils.cache_utils.authority_int_cache, utils.cache_utils.authority_ext_cache,
+                      utils.cache_utils.upstream_response_cache]:
+            cache.clear()
+
+        self.conn_auth_int = FakeRedis(default=json.dumps({'nlp_id': 'a0000001234567', 'heading': 'Kowalski, Jan',
+                                                           'coords': None}))
+        self.conn_auth_ext = FakeRedis(default=json.dumps({'viaf_uri': 'http://viaf.org/viaf/1', 'wikidata_uri': None}))
+
+    @staticmethod
+    def read_test_records():
+        with open(PATH_TO_TEST_BIBS, 'rb') as fp:
+            return [rcd for rcd in MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore',
+                                              permissive=True) if rcd][:10]
+
+    async def test_precomputed_documents_match_live_computation(self):
+        records = self.read_test_records()
+
+        documents, headings = await create_polona_lod_documents(records, self.conn_auth_int, self.conn_auth_ext)
+
+        for rcd in records:
+            bib_nlp_id = rcd['001'].value()
+            polona_back = await PolonaLodRecord(bib_nlp_id, FakeSession(rcd.as_marc()),
+                                                self.conn_auth_int, self.conn_auth_ext)
+            # compared as served (JSONResponse), e.g. None keys become 'null'
+            live_json = json.loads(json.dumps(polona_back.get_json()))
+            live_json_v2 = json.loads(json.dumps(polona_back.get_json_v2()))
+
+            self.assertTrue(live_json)
+            self.assertEqual(ujson.loads(documents[bib_nlp_id]['v1']), live_json)
+            self.assertEqual(ujson.loads(documents[bib_nlp_id]['v2']), live_json_v2)
+            self.assertTrue(headings[bib_nlp_id])
+
+    async def test_batch_matches_single_records(self):
+        records = self.read_test_records()
+        bib_nlp_ids = [rcd['001'].value() for rcd in records] + ['b0000000000000']
+        session = FakeSession({f'http://data.bn.org.pl/api/bibs.marc?id={rcd["001"].value()}': rcd.as_marc()
+                               for rcd in records})
+
+        converted_jsons = await create_polona_lod_jsons_batch(bib_nlp_ids, session, self.conn_auth_int,
+                                                              self.conn_auth_ext, concurrency=3)
+
+        self.assertEqual(list(converted_jsons), bib_nlp_ids)
+        for bib_nlp_id in bib_nlp_ids:
+            polona_back = await PolonaLodRecord(bib_nlp_id, session, self.conn_auth_int, self.conn_auth_ext)
+            self.assertEqual(converted_jsons[bib_nlp_id], polona_back.get_json())
+
+
+class TestPolonaLodDocumentsInvalidation(unittest.IsolatedAsyncioTestCase):
+
+    async def test_documents_of_deleted_authority_are_marked_stale(self):
+        heading = 'KOWALSKI JAN'
+        entry = json.dumps({'nlp_id': 'a1', 'heading': 'Kowalski Jan', 'heading_tag': '100'})
+        conn_auth_int = FakeRedis({'a1': entry, heading: entry})
+        conn_polona_lod = FakeRedis()
+
+        pipe = conn_polona_lod.pipeline()
+        add_polona_lod_documents_to_pipeline(pipe, {'b1': {'v1': '{}', 'v2': '{}'}, 'b2': {'v1': '{}', 'v2': '{}'}},
+                                             {'b1': {heading, 'POLSKA'}, 'b2': {'POLSKA'}})
+        await pipe.execute()
+
+        deleted_keys = await AuthorityUpdater.remove_deleted_records_from_authority_index(['a1'], conn_auth_int)
+        await AuthorityUpdater.invalidate_polona_lod_documents(conn_polona_lod, deleted_keys)
+
+        self.assertNotIn('b1', conn_polona_lod.data)
+        self.assertIn('b2', conn_polona_lod.data)
+        self.assertEqual(conn_polona_lod.data[POLONA_LOD_STALE_KEY], {'b1'})
+
+    async def test_documents_marked_stale_during_recomputation_are_not_written(self):
+        heading = 'KOWALSKI JAN'
+        conn_polona_lod = FakeRedis()
+        document = {'v1': '{}', 'v2': '{}'}
+
+        pipe = conn_polona_lod.pipeline()
+        add_polona_lod_documents_to_pipeline(pipe, {'b1': document, 'b2': document}, {'b1': {heading}, 'b2': {heading}})
+        await pipe.execute()
+        self.assertEqual(conn_polona_lod.ttls, {'b1': POLONA_LOD_DOCUMENT_TTL, 'b2': POLONA_LOD_DOCUMENT_TTL})
+
+        await mark_polona_lod_documents_stale(conn_polona_lod, [heading])
+
+        # recomputation starts - stale set is emptied at once
+        self.assertEqual(await pop_stale_polona_lod_documents(conn_polona_lod), {'b1', 'b2'})
+        self.assertEqual(conn_polona_lod.data.get(POLONA_LOD_STALE_KEY, set()), set())
+
+        # authority is changed again before document of b2 is written
+        pipe = conn_polona_lod.pipeline()
+        add_polona_lod_documents_to_pipeline(pipe, {'b1': document}, {'b1': {heading}})
+        await pipe.execute()
+        await mark_polona_lod_documents_stale(conn_polona_lod, [heading])
+        pipe = conn_polona_lod.pipeline()
+        add_polona_lod_documents_to_pipeline(pipe, {'b2': document}, {'b2': {heading}})
+        await pipe.execute()
+
+        self.assertNotIn('b1', conn_polona_lod.data)
+        self.assertNotIn('b2', conn_polona_lod.data)
+        self.assertEqual(conn_polona_lod.data[POLONA_LOD_STALE_KEY], {'b1', 'b2'})
@@ -0,0 +1,89 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from pymarc import MARCReader
+
+import preprocess_dump_file
+from sqlite_clients.authority_index_snapshot import write_authority_index_snapshot
+from utils.indexer_utils import get_authority_index_entry
+
+
+PATH_TO_TEST_DATA = Path(__file__).parent.parent / 'nlp_database' / 'test'
+# output of the original (single record, single process) implementation for bibs_test_100.mrc and nlp_id
+PATH_TO_EXPECTED_OUTPUT = PATH_TO_TEST_DATA / 'bibs_test_100_enriched_nlp_id.mrc'
+
+
+class FakeRedis(object):
+    # like redis.Redis - values are returned as bytes, unless decode_responses is set
+    def __init__(self, data, decode_responses=False, **kwargs):
+        self.data = data
+        self.decode_responses = decode_responses
+
+    def mget(self, *keys):
+        values = [self.data.get(key) for key in keys]
+        return values if self.decode_responses else [value.encode('utf-8') if value else value for value in values]
+
+
+def create_authority_index_data():
+    data = {}
+    with open(PATH_TO_TEST_DATA / 'authorities_test_100.mrc', 'rb') as fp:
+        for rcd in MARCReader(fp, to_unicode=True, force_utf8=True, permissive=True):
+            entry = rcd and get_authority_index_entry(rcd)
+            if entry:
+                heading_to_index, serialized_to_dict, serialized_to_json = entry
+                data.update({heading_to_index: serialized_to_json,
+                             serialized_to_dict.get('nlp_id'): serialized_to_json})
+    return data
+
+
+class TestEnrichDumpFile(unittest.TestCase):
+
+    def enrich(self, workers, batch_size, use_snapshot=False):
+        data = create_authority_index_data()
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch('preprocess_dump_file.redis.Redis',
+                           side_effect=lambda *args, **kwargs: FakeRedis(data, **kwargs)) as redis_client:
+            snapshot = None
+            if use_snapshot:
+                snapshot = Path(tmp_dir) / 'authority_index.db'
+                write_authority_index_snapshot(str(snapshot), data.items())
+
+            output_file = Path(tmp_dir) / 'bibs_pre.mrc'
+            records_count, _ = preprocess_dump_file.enrich_dump_file(PATH_TO_TEST_DATA / 'bibs_test_100.mrc',
+                                                                     output_file, workers=workers,
+                                                                     batch_size=batch_size, snapshot=snapshot)
+            if workers == 1:
+                # with snapshot redis is not used at all
+                self.assertEqual(redis_client.called, not use_snapshot)
+            return records_count, output_file.read_bytes()
+
+    def test_output_matches_original_implementation(self):
+        expected = PATH_TO_EXPECTED_OUTPUT.read_bytes()
+
+        sequential_count, sequential = self.enrich(workers=1, batch_size=100)
+        parallel_count, parallel = self.enrich(workers=3, batch_size=7)
+
+        self.assertEqual(sequential_count, 100)
+        self.assertEqual(parallel_count, sequential_count)
+        self.assertEqual(sequential, expected)
+        self.assertEqual(parallel, expected)
+        self.assertNotEqual(expected, (PATH_TO_TEST_DATA / 'bibs_test_100.mrc').read_bytes())
+
+    def test_snapshot_output_matches_redis_output(self):
+        _, from_redis = self.enrich(workers=1, batch_size=100)
+        _, from_snapshot = self.enrich(workers=1, batch_size=7, use_snapshot=True)
+        _, from_snapshot_parallel = self.enrich(workers=3, batch_size=7, use_snapshot=True)
+
+        self.assertEqual(from_snapshot, from_redis)
+        self.assertEqual(from_snapshot_parallel, from_redis)
+
+    def test_values_returned_as_bytes_are_decoded(self):
+        fake_redis = FakeRedis(create_authority_index_data())
+        with open(PATH_TO_TEST_DATA / 'bibs_test_100.mrc', 'rb') as fp:
+            records = list(MARCReader(fp, to_unicode=True, force_utf8=True, permissive=True))
+
+        enriched = preprocess_dump_file.enrich_records(records, fake_redis, 'nlp_id')
+
+        self.assertEqual(b''.join(rcd.as_marc() for rcd in enriched), PATH_TO_EXPECTED_OUTPUT.read_bytes())
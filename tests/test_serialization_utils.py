@@ -0,0 +1,55 @@
+import json
+import unittest
+from pathlib import Path
+
+from pymarc import MARCReader
+
+from utils.indexer_utils import get_authority_index_entry
+from utils.serialization_utils import decode_authority_value, encode_authority_value
+
+
+PATH_TO_TEST_AUTHORITIES = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'authorities_test_100.mrc'
+
+
+class TestAuthorityValueFormat(unittest.TestCase):
+
+    def setUp(self):
+        with open(PATH_TO_TEST_AUTHORITIES, 'rb') as fp:
+            records = [rcd for rcd in MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore',
+                                                 permissive=True) if rcd]
+        self.entries = [entry for entry in map(get_authority_index_entry, records) if entry]
+
+    def test_encoded_value_is_decoded_to_the_same_dict(self):
+        for heading_to_index, serialized_to_dict, encoded_value in self.entries:
+            decoded = decode_authority_value(encoded_value)
+
+            self.assertEqual(decoded, serialized_to_dict)
+            self.assertEqual(list(decoded), list(serialized_to_dict))
+
+    def test_legacy_json_values_are_decoded(self):
+        for heading_to_index, serialized_to_dict, encoded_value in self.entries:
+            self.assertEqual(decode_authority_value(json.dumps(serialized_to_dict)), serialized_to_dict)
+
+        self.assertIsNone(decode_authority_value(None))
+
+    def test_encoded_values_are_smaller_than_legacy_json(self):
+        encoded_size = sum(len(encoded_value.encode('utf-8')) for _, _, encoded_value in self.entries)
+        legacy_size = sum(len(json.dumps(serialized_to_dict, ensure_ascii=False).encode('utf-8'))
+                          for _, serialized_to_dict, _ in self.entries)
+
+        self.assertLess(encoded_size, legacy_size * 0.7)
+
+    def test_unknown_version_is_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_authority_value(encode_authority_value({'nlp_id': 'a0000001234567'}).replace('[2,', '[3,', 1))
+
+    def test_bytes_values_are_decoded(self):
+        for heading_to_index, serialized_to_dict, encoded_value in self.entries:
+            self.assertEqual(decode_authority_value(encoded_value.encode('utf-8')), serialized_to_dict)
+            self.assertEqual(decode_authority_value(json.dumps(serialized_to_dict).encode('utf-8')),
+                             serialized_to_dict)
+
+    def test_values_other_than_array_or_object_are_rejected(self):
+        for value in ['"a0000001234567"', b'12', 'null']:
+            with self.assertRaises(ValueError):
+                decode_authority_value(value)
@@ -0,0 +1,86 @@
+import asyncio
+import unittest
+
+from utils.single_flight_utils import SingleFlight
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_calls_share_one_computation(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'nlp_id': 'b0000001234567'}
+
+        results = await asyncio.gather(*[single_flight.do('b0000001234567', compute) for _ in range(5)])
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(single_flight.get_stats(), {'in_flight': 0, 'executed': 1, 'shared': 4})
+
+        # finished computation is not reused
+        await single_flight.do('b0000001234567', compute)
+        self.assertEqual(len(calls), 2)
+
+    async def test_error_is_passed_to_all_callers(self):
+        single_flight = SingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise ValueError('data.bn.org.pl')
+
+        results = await asyncio.gather(*[single_flight.do('key', compute) for _ in range(2)], return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_late_consumer_of_shared_stream_gets_all_parts(self):
+        single_flight = SingleFlight()
+        produced = []
+
+        async def parts():
+            for part in [b'<resp>', b'<record/>', b'</resp>']:
+                produced.append(part)
+                await asyncio.sleep(0.01)
+                yield part
+
+        async def consume(delay):
+            await asyncio.sleep(delay)
+            return [part async for part in single_flight.stream('key', parts)]
+
+        first, late = await asyncio.gather(consume(0), consume(0.015))
+
+        self.assertEqual(first, [b'<resp>', b'<record/>', b'</resp>'])
+        self.assertEqual(late, first)
+        self.assertEqual(len(produced), 3)
+
+    async def test_object_created_in_stream_is_not_shared_with_later_flights(self):
+        single_flight = SingleFlight()
+        created = []
+
+        class Chunk(object):
+            # like records chunks - upstream response is released while streaming
+            def __init__(self):
+                self.content = b'<record/>'
+
+            async def stream_output_xml(self):
+                content, self.content = self.content, None
+                await asyncio.sleep(0.01)
+                yield content.upper()
+
+        async def stream_chunk():
+            created.append(Chunk())
+            async for part in created[-1].stream_output_xml():
+                yield part
+
+        async def consume(delay):
+            await asyncio.sleep(delay)
+            return [part async for part in single_flight.stream('key', stream_chunk)]
+
+        # the last consumer comes after the first flight was finished and released
+        results = await asyncio.gather(consume(0), consume(0.005), consume(0.03))
+
+        self.assertEqual(results, [[b'<RECORD/>']] * 3)
+        self.assertEqual(len(created), 2)
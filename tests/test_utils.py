@@ -1,8 +1,108 @@
+import asyncio
 import unittest
 
 import utils.coordinates_utils
 
 
+# fakes shared by tests of modules using aiohttp session and aioredis connections
+
+
+class FakeResponse(object):
+    # response of data.bn.org.pl (status 500, if there is no content)
+    def __init__(self, content=None, status=None, headers=None):
+        self.status = status if status is not None else (200 if content is not None else 500)
+        self.content = content
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        await asyncio.sleep(0)
+        return self.content
+
+
+class FakeSession(object):
+    # responses: content returned for every query, contents by query (dict) or FakeResponses returned in order (list)
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, query, headers=None):
+        self.requests.append((query, headers))
+
+        if isinstance(self.responses, list):
+            return self.responses.pop(0)
+        if isinstance(self.responses, dict):
+            return FakeResponse(self.responses.get(query))
+        return FakeResponse(self.responses)
+
+
+class FakeMultiExec(object):
+    # transaction or pipeline - commands are applied at once by execute()
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def delete(self, *keys):
+        self.commands.append(lambda data: [data.pop(key, None) for key in keys])
+
+    def set(self, key, value):
+        self.mset({key: value})
+
+    def mset(self, mapping):
+        self.commands.append(lambda data: data.update(mapping))
+
+    def sadd(self, key, *members):
+        self.commands.append(lambda data: data.setdefault(key, set()).update(members))
+
+    def smembers(self, key):
+        self.commands.append(lambda data: list(data.get(key, set())))
+
+    def eval(self, script, keys, args):
+        # only utils.polona_lod_store_utils.WRITE_DOCUMENT_SCRIPT is run in pipelines
+        def write_document(data):
+            if keys[0] in data.get(keys[1], set()):
+                return 0
+            data.setdefault(keys[0], {}).update(zip(args[1::2], args[2::2]))
+            self.redis_client.ttls[keys[0]] = args[0]
+            return 1
+
+        self.commands.append(write_document)
+
+    async def execute(self):
+        self.redis_client.transactions.append(self.commands)
+        return [command(self.redis_client.data) for command in self.commands]
+
+
+class FakeRedis(object):
+    # single redis db (shared by all workers) - values by key or default value for every key
+    def __init__(self, data=None, default=None):
+        self.data = data if data is not None else {}
+        self.default = default
+        self.ttls = {}
+        self.transactions = []
+        self.mget_calls = 0
+        self.mget_keys = []
+
+    async def mget(self, *keys):
+        self.mget_calls += 1
+        self.mget_keys.extend(keys)
+        return [self.data.get(key, self.default) for key in keys]
+
+    async def sunion(self, *keys):
+        return sorted(set().union(*(self.data.get(key, set()) for key in keys)))
+
+    def multi_exec(self):
+        return FakeMultiExec(self)
+
+    def pipeline(self):
+        return FakeMultiExec(self)
+
+
 class TestDMSToDecimal(unittest.TestCase):
 
     def test_dms_to_decimal_E(self):
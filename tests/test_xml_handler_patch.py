@@ -0,0 +1,84 @@
+import io
+import unittest
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+from pymarc import MARCReader, marcxml
+
+from pymarc_patches.xml_handler_patch import parse_xml_to_array_patched, parse_xml_to_next_page_and_array_patched
+from pymarc_patches.iterparse_patch import parse_xml_to_next_page_and_array_iterparse
+
+
+PATH_TO_TEST_BIBS = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'bibs_test_100.mrc'
+PATH_TO_TEST_AUTHORITIES = Path(__file__).parent.parent / 'nlp_database' / 'test' / 'authorities_test_100.mrc'
+
+
+def create_data_bn_response(path_to_test_file, next_page):
+    with open(path_to_test_file, 'rb') as fp:
+        records = [marcxml.record_to_xml(rcd, namespace=True) for rcd in
+                   MARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore', permissive=True) if rcd]
+
+    return b''.join([f'<resp><nextPage>{next_page}</nextPage><collection>'.encode('utf-8'),
+                     *records,
+                     b'</collection></resp>'])
+
+MALFORMED_RESPONSE = '''<resp><nextPage></nextPage><collection xmlns="http://www.loc.gov/MARC21/slim">
+<record><leader>00000nz  a2200000n  4500</leader>
+<controlfield tag="001">a0000001234567</controlfield>
+<controlfield tag="035">invalid controlfield</controlfield>
+<datafield tag="009" ind1=" " ind2=" "><subfield code="a">datafield with controlfield tag</subfield></datafield>
+<datafield tag="100" ind1="1"><subfield code="a">Kowalski, Jan</subfield><subfield code="d">1901-1980</subfield></datafield>
+<datafield tag="650" ind1=" " ind2="7"><subfield code="a">Powies\u0301c\u0301 polska</subfield></datafield>
+</record></collection></resp>'''.encode('utf-8')
+
+
+class TestParseXmlToNextPageAndArrayPatched(unittest.TestCase):
+
+    def test_single_pass_matches_separate_parses(self):
+        for path_to_test_file in [PATH_TO_TEST_BIBS, PATH_TO_TEST_AUTHORITIES]:
+            content = create_data_bn_response(path_to_test_file,
+                                              'http://data.bn.org.pl/api/bibs.marcxml?sinceId=1&amp;limit=100')
+
+            next_page, records = parse_xml_to_next_page_and_array_patched(io.BytesIO(content), normalize_form='NFC')
+            expected_records = parse_xml_to_array_patched(io.BytesIO(content), normalize_form='NFC')
+
+            self.assertEqual(next_page, ET.fromstring(content)[0].text)
+            self.assertEqual([rcd.as_marc() for rcd in records], [rcd.as_marc() for rcd in expected_records])
+
+    def test_last_page_has_empty_next_page(self):
+        content = create_data_bn_response(PATH_TO_TEST_BIBS, '')
+        next_page, records = parse_xml_to_next_page_and_array_patched(io.BytesIO(content), normalize_form='NFC')
+
+        self.assertEqual(next_page, '')
+        self.assertEqual(len(records), 100)
+
+
+class TestParseXmlToNextPageAndArrayIterparse(unittest.TestCase):
+
+    def assert_same_as_sax(self, content, strict=False):
+        expected_next_page, expected_records = parse_xml_to_next_page_and_array_patched(io.BytesIO(content),
+                                                                                        strict=strict,
+                                                                                        normalize_form='NFC')
+        next_page, records = parse_xml_to_next_page_and_array_iterparse(io.BytesIO(content),
+                                                                        strict=strict,
+                                                                        normalize_form='NFC')
+
+        self.assertEqual(next_page, expected_next_page)
+        self.assertEqual([str(rcd.leader) for rcd in records], [str(rcd.leader) for rcd in expected_records])
+        self.assertEqual([rcd.as_marc() for rcd in records], [rcd.as_marc() for rcd in expected_records])
+
+    def test_iterparse_matches_sax_on_test_files(self):
+        for path_to_test_file in [PATH_TO_TEST_BIBS, PATH_TO_TEST_AUTHORITIES]:
+            content = create_data_bn_response(path_to_test_file,
+                                              'http://data.bn.org.pl/api/bibs.marcxml?sinceId=1&amp;limit=100')
+            self.assert_same_as_sax(content)
+            self.assert_same_as_sax(content, strict=True)
+
+    def test_iterparse_applies_patches_like_sax(self):
+        self.assert_same_as_sax(MALFORMED_RESPONSE)
+
+        next_page, records = parse_xml_to_next_page_and_array_iterparse(io.BytesIO(MALFORMED_RESPONSE),
+                                                                        normalize_form='NFC')
+        self.assertEqual([fld.tag for fld in records[0].fields], ['001', '100', '650'])
+        self.assertEqual(records[0]['100'].indicators, ['1', ' '])
+        self.assertEqual(records[0]['650']['a'], 'Powieść polska')
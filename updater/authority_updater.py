@@ -1,170 +1,304 @@
-import json
+import asyncio
 import logging
 import io
 
+from collections import namedtuple
 from datetime import datetime, timedelta
-import xml.etree.ElementTree as ET
 from xml.sax.saxutils import escape
 
-from pymarc_patches.xml_handler_patch import parse_xml_to_array_patched
+from pymarc_patches.parser_backends import parse_xml_to_next_page_and_array
 
-from utils.indexer_utils import get_nlp_id, get_mms_id, get_viaf_id, get_coordinates, is_data_bn_ok
-from utils.marc_utils import prepare_name_for_indexing
-from utils.updater_utils import get_nlp_id_from_json
+from utils.indexer_utils import get_authority_index_entries, is_data_bn_ok
+from utils.marc_utils import prepare_names_for_indexing
+from utils.updater_utils import get_nlp_id_from_json, split_date_range
+from utils.cache_utils import new_index_generation
+from utils.serialization_utils import decode_authority_value
+from utils.polona_lod_store_utils import mark_polona_lod_documents_stale
+from updater.updater_state import AuthorityUpdaterState
 
-from config.indexer_config import AUTHORITY_INDEX_FIELDS
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY
 from config.timedelta_config import TIMEDELTA_CONFIG
+from config.updater_config import UPDATER_PREFETCH_DEPTH, UPDATER_DATE_WINDOW_SPLITS, UPDATER_WATERMARK_OVERLAP
 
 
 logger = logging.getLogger(__name__)
 
 
+# items put by producers into prefetch queue
+# page of records with the query of the next page in its chain (None if it's the last page)
+FetchedPage = namedtuple('FetchedPage', ['chain_id', 'next_query', 'records'])
+# end of chain - completed is False if the chain was interrupted (upstream error)
+ChainEnd = namedtuple('ChainEnd', ['chain_id', 'completed'])
+
+
 class AuthorityUpdater(object):
     def __init__(self):
         self.update_in_progress = False
         self.last_auth_update = datetime.utcnow()
 
-    async def update_authority_index(self, aiohttp_session, conn_auth_int):
-        # data.bn.org.pl health check
-        if await is_data_bn_ok(aiohttp_session):
-
+    async def update_authority_index(self, aiohttp_session, conn_auth_int, conn_state, conn_polona_lod=None):
+        # only one worker at a time updates the index (lock is kept in redis)
+        updater_state = AuthorityUpdaterState(conn_state)
+        if not await updater_state.acquire_lock():
+            logger.info(f'Aktualizacja rekordów wzorcowych jest już w toku. Pomijam.')
+            return
+
+        # lock is refreshed until the update is finished
+        lock_heartbeat = asyncio.ensure_future(updater_state.keep_lock())
+
+        try:
+            # data.bn.org.pl health check
+            if await is_data_bn_ok(aiohttp_session):
+
+                # set updater status
+                self.update_in_progress = True
+                logger.info(f'Status data.bn.org.pl: OK.')
+                logger.info(f'Zmieniono status updatera rekordów wzorcowych na: {self.update_in_progress}.')
+
+                # set query address base
+                query_addr_json = 'http://data.bn.org.pl/api/authorities.json'
+                query_addr_marcxml = 'http://data.bn.org.pl/api/authorities.marcxml'
+
+                interrupted_run = await updater_state.get_run()
+                if interrupted_run:
+                    # resume interrupted update from saved cursors (already applied pages are not fetched again)
+                    date_from, date_to, updated_queries = interrupted_run
+                    logger.info(f'Wznawiam przerwaną aktualizację rekordów wzorcowych ({date_from} - {date_to}).')
+                else:
+                    # create dates for queries (from watermark of the last completed update)
+                    date_from = self.get_update_date_from(await updater_state.get_last_update())
+                    date_to = datetime.utcnow()
+
+                    # updatedDate window is split into sub-ranges fetched concurrently
+                    updated_queries = {
+                        str(chain_id): f'{query_addr_marcxml}?updatedDate={sub_from_iso_z}%2C{sub_to_iso_z}&limit=100'
+                        for chain_id, (sub_from_iso_z, sub_to_iso_z) in enumerate(
+                            split_date_range(date_from, date_to, UPDATER_DATE_WINDOW_SPLITS))}
+                    await updater_state.start_run(date_from, date_to, updated_queries)
+
+                date_from_iso_z = date_from.isoformat(timespec='seconds') + 'Z'
+                date_to_iso_z = date_to.isoformat(timespec='seconds') + 'Z'
+
+                # update authority records in authority index by record id (updates entries by record id and heading)
+                logger.info(f'Rozpoczynam aktualizację rekordów wzorcowych.')
+                logger.info(f'Rozpoczynam aktualizację rekordów wzorcowych nowych/zaktualizowanych.')
+                completed = await self.update_updated_records_in_authority_index(updated_queries, aiohttp_session,
+                                                                                 conn_auth_int, updater_state,
+                                                                                 conn_polona_lod)
+                if not completed:
+                    # cursors are kept, next run resumes from them
+                    logger.error(f'Aktualizacja rekordów wzorcowych przerwana. Zostanie wznowiona przy kolejnym '
+                                 f'uruchomieniu.')
+                    return
+                logger.info(f'Zaktualizowano.')
+
+                # get deleted authority records ids from data.bn.org.pl
+                logger.info(f'Rozpoczynam usuwanie rekordów wzorcowych usuniętych.')
+                logger.info(f'Pobieram identyfikatory.')
+                deleted_query = (f'{query_addr_json}?updatedDate={date_from_iso_z}%2C{date_to_iso_z}'
+                                 f'&deleted=true&limit=100')
+                deleted_records_ids = await self.get_records_ids_from_data_bn_for_authority_index_update(
+                    deleted_query, aiohttp_session)
+
+                # delete authority records from authority index by record id
+                # (deletes entries by record id and heading)
+                deleted_keys = await self.remove_deleted_records_from_authority_index(deleted_records_ids,
+                                                                                      conn_auth_int)
+                await self.invalidate_polona_lod_documents(conn_polona_lod, deleted_keys)
+                logger.info("Usunięto rekordów: {}".format(len(deleted_records_ids)))
+
+                # move watermark and clear cursors
+                await updater_state.finish_run(date_to)
+                self.last_auth_update = date_to
+                logger.info(f'Zakończono aktualizację rekordów wzorcowych.')
+
+        finally:
             # set updater status
-            self.update_in_progress = True
-            logger.info(f'Status data.bn.org.pl: OK.')
-            logger.info(f'Zmieniono status updatera rekordów wzorcowych na: {self.update_in_progress}.')
-
-            # create dates for queries
-            date_from = self.last_auth_update - timedelta(days=TIMEDELTA_CONFIG)
-            date_from_iso_z = date_from.isoformat(timespec='seconds') + 'Z'
-
-            date_to = datetime.utcnow()
-            date_to_iso_z = date_to.isoformat(timespec='seconds') + 'Z'
-
-            # set query address base
-            query_addr_json = 'http://data.bn.org.pl/api/authorities.json'
-            query_addr_marcxml = 'http://data.bn.org.pl/api/authorities.marcxml'
-
-            # update authority records in authority index by record id (updates entries by record id and heading)
-            logger.info(f'Rozpoczynam aktualizację rekordów wzorcowych.')
-            logger.info(f'Rozpoczynam aktualizację rekordów wzorcowych nowych/zaktualizowanych.')
-            updated_query = f'{query_addr_marcxml}?updatedDate={date_from_iso_z}%2C{date_to_iso_z}&limit=100'
-            await self.update_updated_records_in_authority_index(updated_query, aiohttp_session, conn_auth_int)
-            logger.info(f'Zaktualizowano.')
-
-            # get deleted authority records ids from data.bn.org.pl
-            logger.info(f'Rozpoczynam usuwanie rekordów wzorcowych usuniętych.')
-            logger.info(f'Pobieram identyfikatory.')
-            deleted_query = f'{query_addr_json}?updatedDate={date_from_iso_z}%2C{date_to_iso_z}&deleted=true&limit=100'
-            deleted_records_ids = await self.get_records_ids_from_data_bn_for_authority_index_update(deleted_query,
-                                                                                                     aiohttp_session)
-
-            # delete authority records from authority index by record id (deletes entries by record id and heading)
-            await self.remove_deleted_records_from_authority_index(deleted_records_ids, conn_auth_int)
-            logger.info("Usunięto rekordów: {}".format(len(deleted_records_ids)))
+            if self.update_in_progress:
+                self.update_in_progress = False
+                logger.info(f'Zmieniono status updatera rekordów wzorcowych na: {self.update_in_progress}.')
+            lock_heartbeat.cancel()
+            await updater_state.release_lock()
 
-            # set updater status
-            self.update_in_progress = False
-            self.last_auth_update = date_to
-            logger.info(f'Zakończono aktualizację rekordów wzorcowych.')
-            logger.info(f'Zmieniono status updatera rekordów wzorcowych na: {self.update_in_progress}.')
+    def get_update_date_from(self, last_update):
+        if last_update:
+            # incremental update - only records updated since the last completed update
+            return last_update - timedelta(seconds=UPDATER_WATERMARK_OVERLAP)
+
+        # first update (no watermark yet)
+        return self.last_auth_update - timedelta(days=TIMEDELTA_CONFIG)
 
     @staticmethod
-    async def yield_records_from_data_bn_for_authority_index_update(query, aiohttp_session):
+    async def fetch_records_from_data_bn_for_authority_index_update(chain_id, query, aiohttp_session, queue):
+        # producer: walks single nextPage chain and puts parsed pages into queue
+        # next page is requested as soon as the current one is parsed - it doesn't wait for the consumer,
+        # unless the queue is full
         counter = 0
-        while query:
-            async with aiohttp_session.get(query) as resp:
-                if resp.status == 200:
-                    binary_content = await resp.read()
-                    if binary_content:
-                        xml_array = parse_xml_to_array_patched(io.BytesIO(binary_content), normalize_form='NFC')
-                        root = ET.fromstring(binary_content.decode())
-                        query = escape(root[0].text) if root[0].text else None
+        completed = False
+        try:
+            while query:
+                async with aiohttp_session.get(query) as resp:
+                    if resp.status == 200:
+                        binary_content = await resp.read()
+                        if not binary_content:
+                            logger.info(f'Pusta odpowiedź data.bn.org.pl. Przerywam przetwarzanie.')
+                            break
+
+                        next_page, xml_array = parse_xml_to_next_page_and_array(io.BytesIO(binary_content),
+                                                                                normalize_form='NFC')
+                        query = escape(next_page) if next_page else None
                         if not query:
                             logger.info(f'Brak rekordów do przetworzenia lub koniec przetwarzania.')
                         else:
                             counter += 1
                             logger.info(f'Przekazano do przetworzenia paczkę nr {counter}.')
-                        yield xml_array
+                        await queue.put(FetchedPage(chain_id, query, xml_array))
+                    else:
+                        logger.info(f'Pojawił się problem z data.bn.org.pl. Przerywam przetwarzanie.')
+                        break
+            else:
+                completed = True
+        except Exception:
+            logger.exception(f'Pojawił się problem z pobieraniem rekordów. Przerywam przetwarzanie.')
+
+        # tell the consumer that this producer is done
+        # (not if the producer was cancelled - consumer is already gone and the queue may be full)
+        await queue.put(ChainEnd(chain_id, completed))
+
+    @staticmethod
+    async def yield_records_from_data_bn_for_authority_index_update(queries, aiohttp_session,
+                                                                    prefetch_depth=UPDATER_PREFETCH_DEPTH):
+        # consumer: yields parsed pages (FetchedPage) from all queries (nextPage chains, by chain id)
+        # as soon as they are prefetched, and ChainEnd when a chain is finished
+        # bounded queue keeps at most prefetch_depth pages waiting in memory
+        queue = asyncio.Queue(maxsize=prefetch_depth)
+        producers = [asyncio.ensure_future(
+            AuthorityUpdater.fetch_records_from_data_bn_for_authority_index_update(chain_id, query,
+                                                                                   aiohttp_session, queue))
+            for chain_id, query in queries.items()]
+
+        producers_left = len(producers)
+        try:
+            while producers_left:
+                item = await queue.get()
+                if isinstance(item, ChainEnd):
+                    producers_left -= 1
+                yield item
+        finally:
+            for producer in producers:
+                producer.cancel()
+
+    async def update_updated_records_in_authority_index(self, updated_queries, aiohttp_session, conn_auth_int,
+                                                        updater_state, conn_polona_lod=None):
+        # returns True if all chains were completed
+        completed = True
+
+        async for item in self.yield_records_from_data_bn_for_authority_index_update(updated_queries,
+                                                                                     aiohttp_session):
+            if isinstance(item, ChainEnd):
+                completed = completed and item.completed
+                continue
+
+            changed_keys = await self.update_records_page_in_authority_index(item.records, conn_auth_int)
+            await self.invalidate_polona_lod_documents(conn_polona_lod, changed_keys)
+            # page is applied - save cursor, so interrupted update resumes from the next page
+            await updater_state.save_cursor(item.chain_id, item.next_query)
+
+        return completed
+
+    @staticmethod
+    async def invalidate_polona_lod_documents(conn_polona_lod, changed_keys):
+        # precomputed polona lod documents of changed headings are served live until recomputed
+        if conn_polona_lod and changed_keys:
+            stale_bib_ids = await mark_polona_lod_documents_stale(conn_polona_lod, changed_keys)
+            if stale_bib_ids:
+                logger.info(f'Oznaczono do przeliczenia dokumentów Polona LOD: {len(stale_bib_ids)}.')
+
+    async def update_records_page_in_authority_index(self, rcd_array, conn_auth_int):
+        # returns changed keys (headings and nlp_ids)
+        # get index entries (by nlp_id) of all records from page
+        entries = {}
+
+        # headings of all records from page are normalized at once
+        for entry in get_authority_index_entries([rcd for rcd in rcd_array if rcd]):
+            if entry and entry[1].get('nlp_id'):
+                entries[entry[1].get('nlp_id')] = entry
+
+        if not entries:
+            return []
+
+        # check if records were already indexed and if so, get the old versions - single round trip for whole page
+        nlp_ids = list(entries.keys())
+        auths_to_update = await conn_auth_int.mget(*nlp_ids)
+
+        headings_to_delete, entries_to_set = self.get_authority_index_changes(entries,
+                                                                              dict(zip(nlp_ids, auths_to_update)))
+
+        # apply all changes from page atomically
+        # (with new index generation - cached lookups are dropped in all workers)
+        if headings_to_delete or entries_to_set:
+            tr = conn_auth_int.multi_exec()
+            if headings_to_delete:
+                tr.delete(*headings_to_delete)
+            if entries_to_set:
+                tr.mset(entries_to_set)
+            tr.set(AUTHORITY_INDEX_GENERATION_KEY, new_index_generation())
+            await tr.execute()
+
+        return [*headings_to_delete, *entries_to_set]
+
+    @staticmethod
+    def get_authority_index_changes(entries, auths_to_update):
+        # computes changes in authority index for page of records (in memory)
+        # returns list of old headings to delete and dict of keys and values to set
+        headings_to_delete = []
+        entries_to_set = {}
+
+        # old versions of already indexed records and their headings (normalized at once)
+        auths_to_update_dicts = {nlp_id: decode_authority_value(auth_to_update)
+                                 for nlp_id, auth_to_update in auths_to_update.items()
+                                 if nlp_id in entries and auth_to_update}
+        old_headings = dict(zip(auths_to_update_dicts,
+                                prepare_names_for_indexing([auth_dict.get('heading')
+                                                            for auth_dict in auths_to_update_dicts.values()])))
+
+        for nlp_id, (heading_to_index, to_update, json_to_update) in entries.items():
+            fld = to_update.get('heading_tag')
+            auth_to_update_dict = auths_to_update_dicts.get(nlp_id)
+
+            if auth_to_update_dict:
+                # rcd was already indexed and there is old version
+                # get the old heading for comparison
+                old_heading = old_headings[nlp_id]
+
+                if old_heading == heading_to_index:
+                    # heading wasn't modified
+                    if to_update == auth_to_update_dict:
+                        # nothing's changed, do nothing
+                        continue
+
+                    # something's changed
+                    if auth_to_update_dict.get('heading_tag') != '130' and fld == '130':
+                        # if authority with the same heading is already indexed
+                        # and the new one (currently processed) is 130 heading
+                        # just skip it
+                        continue
+
+                    # if authority with the same heading is already indexed
+                    # and the new one (currently processed) is not 130 heading
+                    # do the usual job
+                    # record will be normally processed and will overwrite the existing record
                 else:
-                    logger.info(f'Pojawił się problem z data.bn.org.pl. Przerywam przetwarzanie.')
-                    break
+                    # heading was modified
+                    headings_to_delete.append(old_heading)
+            else:
+                # record is new and it has to be indexed
+                logging.debug(f'Dodano nowe hasło: {heading_to_index}')
+
+            entries_to_set.update({nlp_id: json_to_update,
+                                   heading_to_index: json_to_update})
 
-    async def update_updated_records_in_authority_index(self, updated_query, aiohttp_session, conn_auth_int):
-        async for rcd_array in self.yield_records_from_data_bn_for_authority_index_update(updated_query,
-                                                                                          aiohttp_session):
-            for rcd in rcd_array:
-                if rcd:
-                    for fld in AUTHORITY_INDEX_FIELDS:
-                        if fld in rcd:
-                            heading_full = rcd.get_fields(fld)[0].value()
-                            heading_to_index = prepare_name_for_indexing(heading_full)
-                            mms_id = get_mms_id(rcd)
-                            nlp_id = get_nlp_id(rcd)
-                            viaf_id = get_viaf_id(rcd)
-                            coordinates = get_coordinates(rcd)
-
-                            to_update = {'nlp_id': nlp_id,
-                                         'mms_id': mms_id,
-                                         'viaf_id': viaf_id,
-                                         'coords': coordinates,
-                                         'heading': heading_full,
-                                         'heading_tag': fld}
-
-                            json_to_update = json.dumps(to_update, ensure_ascii=False)
-
-                            if nlp_id:
-                                # check if record was already indexed and if so, get the old version
-                                auth_to_update = await conn_auth_int.get(nlp_id)
-
-                                if auth_to_update:
-                                    # rcd was already indexed and there is old version
-                                    auth_to_update_dict = json.loads(auth_to_update)
-
-                                    # get the old heading for comparison
-                                    old_heading = prepare_name_for_indexing(auth_to_update_dict.get('heading'))
-
-                                    if old_heading == heading_to_index:
-                                        # heading wasn't modified
-                                        if to_update == auth_to_update_dict:
-                                            # nothing's changed, do nothing
-                                            break  # breaks only the inner loop (searching for fields to index)
-
-                                        else:
-                                            # something's changed
-                                            if auth_to_update_dict.get('heading_tag') != '130' and fld == '130':
-                                                # if authority with the same heading is already indexed
-                                                # and the new one (currently processed) is 130 heading
-                                                # just skip it (break the loop)
-
-                                                break  # breaks only the inner loop (searching for fields to index)
-                                            else:
-                                                # if authority with the same heading is already indexed
-                                                # and the new one (currently processed) is not 130 heading
-                                                # do the usual job
-                                                # record will be normally processed
-                                                # and will overwrite the existing record
-
-                                                await conn_auth_int.mset({nlp_id: json_to_update,
-                                                                         heading_to_index: json_to_update})
-
-                                                break  # breaks only the inner loop (searching for fields to index)
-                                    else:
-                                        # heading was modified
-                                        await conn_auth_int.delete(old_heading)
-                                        await conn_auth_int.mset({nlp_id: json_to_update,
-                                                                 heading_to_index: json_to_update})
-
-                                        break  # breaks only the inner loop (searching for fields to index)
-
-                                else:
-                                    # record is new and it has to be indexed
-
-                                    await conn_auth_int.mset({nlp_id: json_to_update,
-                                                              heading_to_index: json_to_update})
-
-                                    logging.debug(f'Dodano nowe hasło: {heading_to_index}')
-
-                                    break  # breaks only the inner loop (searching for fields to index)
+        return headings_to_delete, entries_to_set
 
     @staticmethod
     async def get_records_ids_from_data_bn_for_authority_index_update(query, aiohttp_session):
@@ -186,10 +320,31 @@ class AuthorityUpdater(object):
         return records_ids
 
     @staticmethod
-    async def remove_deleted_records_from_authority_index(records_ids, conn_auth_int):
-        for record_id in records_ids:
-            auth_to_delete = await conn_auth_int.get(record_id)
-            if auth_to_delete:
-                heading = prepare_name_for_indexing(json.loads(auth_to_delete).get('heading'))
-                await conn_auth_int.delete(heading)
-                await conn_auth_int.delete(record_id)
+    async def remove_deleted_records_from_authority_index(records_ids, conn_auth_int, chunk_size=1000):
+        # returns deleted keys (headings and nlp_ids)
+        deleted_keys = []
+
+        for chunk_start in range(0, len(records_ids), chunk_size):
+            records_ids_chunk = records_ids[chunk_start:chunk_start + chunk_size]
+
+            # get all records to delete in single round trip
+            auths_to_delete = await conn_auth_int.mget(*records_ids_chunk)
+
+            # headings of all records from chunk are normalized at once
+            found = [(record_id, decode_authority_value(auth_to_delete).get('heading'))
+                     for record_id, auth_to_delete in zip(records_ids_chunk, auths_to_delete) if auth_to_delete]
+            headings = prepare_names_for_indexing([heading for _, heading in found])
+
+            keys_to_delete = []
+            for (record_id, _), heading in zip(found, headings):
+                keys_to_delete.extend([heading, record_id])
+
+            # delete headings and record ids atomically (with new index generation)
+            if keys_to_delete:
+                tr = conn_auth_int.multi_exec()
+                tr.delete(*keys_to_delete)
+                tr.set(AUTHORITY_INDEX_GENERATION_KEY, new_index_generation())
+                await tr.execute()
+                deleted_keys.extend(keys_to_delete)
+
+        return deleted_keys
@@ -1,2 +1,24 @@
-async def do_authority_update(updater_instance, aiohttp_session, conn_auth_int):
-    await updater_instance.update_authority_index(aiohttp_session, conn_auth_int)
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+async def do_authority_update(updater_instance, aiohttp_session, conn_auth_int, conn_state, conn_polona_lod=None):
+    await updater_instance.update_authority_index(aiohttp_session, conn_auth_int, conn_state, conn_polona_lod)
+
+
+async def run_authority_update_scheduler(updater_instance, aiohttp_session, conn_auth_int, conn_state, interval,
+                                         conn_polona_lod=None):
+    # runs incremental update every interval seconds (lock in redis prevents concurrent updates between workers)
+    while True:
+        try:
+            await updater_instance.update_authority_index(aiohttp_session, conn_auth_int, conn_state,
+                                                          conn_polona_lod)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f'Pojawił się problem podczas zaplanowanej aktualizacji rekordów wzorcowych.')
+
+        await asyncio.sleep(interval)
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from config.updater_config import UPDATER_LOCK_TTL, UPDATER_LOCK_REFRESH_INTERVAL
+
+
+logger = logging.getLogger(__name__)
+
+LAST_UPDATE_KEY = 'updater:authorities:last_update'    # watermark: end of the last completed update window
+RUN_KEY = 'updater:authorities:run'                    # window of the update in progress (hash)
+CURSORS_KEY = 'updater:authorities:cursors'            # next query to fetch for every chain of the run (hash)
+LOCK_KEY = 'updater:authorities:lock'                  # cross-worker lock
+
+# deletes lock only if it is still owned by the releasing worker
+RELEASE_LOCK_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                       "return redis.call('del', KEYS[1]) else return 0 end")
+# prolongs lock only if it is still owned by the refreshing worker
+REFRESH_LOCK_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                       "return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end")
+
+
+class AuthorityUpdaterState(object):
+    """
+    Durable authority updater state kept in redis (STATE_DB) and shared by all uvicorn workers:
+    last update watermark, resume cursors of the update in progress and the lock.
+    """
+
+    def __init__(self, conn_state, owner: Optional[str] = None):
+        self.conn_state = conn_state
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+
+    async def acquire_lock(self) -> bool:
+        acquired = await self.conn_state.set(LOCK_KEY, self.owner, expire=UPDATER_LOCK_TTL,
+                                             exist=self.conn_state.SET_IF_NOT_EXIST)
+        return bool(acquired)
+
+    async def refresh_lock(self) -> bool:
+        refreshed = await self.conn_state.eval(REFRESH_LOCK_SCRIPT, keys=[LOCK_KEY],
+                                               args=[self.owner, UPDATER_LOCK_TTL])
+        return bool(refreshed)
+
+    async def keep_lock(self, interval: float = UPDATER_LOCK_REFRESH_INTERVAL) -> None:
+        # heartbeat for the whole update (fetching and applying pages, fetching and removing deleted records),
+        # runs until cancelled
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await self.refresh_lock():
+                    logger.error(f'Utracono blokadę aktualizacji rekordów wzorcowych.')
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f'Pojawił się problem z odświeżeniem blokady aktualizacji rekordów wzorcowych.')
+
+    async def release_lock(self) -> None:
+        await self.conn_state.eval(RELEASE_LOCK_SCRIPT, keys=[LOCK_KEY], args=[self.owner])
+
+    async def is_update_in_progress(self) -> bool:
+        return bool(await self.conn_state.exists(LOCK_KEY))
+
+    async def get_last_update(self) -> Optional[datetime]:
+        last_update = await self.conn_state.get(LAST_UPDATE_KEY)
+        return datetime.fromisoformat(last_update) if last_update else None
+
+    async def get_run(self) -> Optional[Tuple[datetime, datetime, Dict[str, str]]]:
+        # returns window and not yet completed queries (by chain id) of interrupted update, if any
+        run = await self.conn_state.hgetall(RUN_KEY)
+        if not run:
+            return None
+
+        cursors = await self.conn_state.hgetall(CURSORS_KEY)
+        return (datetime.fromisoformat(run['date_from']),
+                datetime.fromisoformat(run['date_to']),
+                {chain_id: query for chain_id, query in cursors.items() if query})
+
+    async def start_run(self, date_from: datetime, date_to: datetime, queries: Dict[str, str]) -> None:
+        tr = self.conn_state.multi_exec()
+        tr.delete(CURSORS_KEY)
+        tr.hmset_dict(RUN_KEY, {'date_from': date_from.isoformat(), 'date_to': date_to.isoformat()})
+        tr.hmset_dict(CURSORS_KEY, queries)
+        await tr.execute()
+
+    async def save_cursor(self, chain_id: str, next_query: Optional[str]) -> None:
+        # empty cursor means that the chain is completed
+        await self.conn_state.hset(CURSORS_KEY, chain_id, next_query or '')
+
+    async def finish_run(self, date_to: datetime) -> None:
+        tr = self.conn_state.multi_exec()
+        tr.set(LAST_UPDATE_KEY, date_to.isoformat())
+        tr.delete(RUN_KEY, CURSORS_KEY)
+        await tr.execute()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pymarc
+import ujson
+
+from config.authority_records_config import PATH_TO_AUTHORITY_RECORDS, PATH_TO_AUTHORITY_RECORDS_OFFSETS
+from sqlite_clients.authority_records_offsets import AuthorityRecordsOffsets
+from utils.marc_utils import read_marc_record_from_bytes, records_to_marcxml
+
+
+logger = logging.getLogger(__name__)
+
+# output formats of full authority records and their media types
+AUTHORITY_RECORDS_MEDIA_TYPES = {'json': 'application/json',
+                                 'marcxml': 'application/xml',
+                                 'marc': 'application/marc'}
+
+
+class AuthorityRecordsStore(object):
+    """
+    Full authority records read locally from authorities dump (positioned reads by offset and length
+    from offsets index - see indexer/authority_records_offsets_indexer.py).
+    """
+
+    def __init__(self, path_to_records: Path, path_to_offsets: Path):
+        self.path_to_records = path_to_records
+        self.offsets = AuthorityRecordsOffsets(str(path_to_offsets))
+        self.fd = os.open(str(path_to_records), os.O_RDONLY)
+
+    def read_raw_records(self, nlp_ids: List[str]) -> Dict[str, Optional[bytes]]:
+        # raw records (iso2709) by nlp_id, None if not found
+        offsets = self.offsets.get_offsets(nlp_ids)
+        return {nlp_id: os.pread(self.fd, offsets[nlp_id][1], offsets[nlp_id][0]) if nlp_id in offsets else None
+                for nlp_id in nlp_ids}
+
+    async def get_raw_records(self, nlp_ids: List[str]) -> Dict[str, Optional[bytes]]:
+        # disk reads are done outside of the event loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.read_raw_records, nlp_ids)
+
+    def close(self) -> None:
+        self.offsets.close()
+        os.close(self.fd)
+
+
+def open_authority_records_store(path_to_records: Path = PATH_TO_AUTHORITY_RECORDS,
+                                 path_to_offsets: Path = PATH_TO_AUTHORITY_RECORDS_OFFSETS
+                                 ) -> Optional[AuthorityRecordsStore]:
+    # None if dump or its offsets index is missing or the index was built from different version of the dump
+    if not path_to_records.exists() or not path_to_offsets.exists():
+        logger.warning(f'Brak pliku {path_to_records} lub indeksu {path_to_offsets}. '
+                       f'Pełne rekordy wzorcowe nie będą udostępniane.')
+        return None
+
+    store = AuthorityRecordsStore(path_to_records, path_to_offsets)
+    if not store.offsets.is_valid_for(str(path_to_records)):
+        logger.warning(f'Indeks {path_to_offsets} jest nieaktualny. Pełne rekordy wzorcowe nie będą udostępniane.')
+        store.close()
+        return None
+
+    return store
+
+
+def parse_raw_authority_records(raw_records: Dict[str, Optional[bytes]]) -> Dict[str, Optional[pymarc.Record]]:
+    # module level function, so it can be run in executor worker process (see utils.executor_utils)
+    return {nlp_id: read_marc_record_from_bytes(raw_record) if raw_record else None
+            for nlp_id, raw_record in raw_records.items()}
+
+
+def convert_raw_authority_records(raw_records: Dict[str, Optional[bytes]], output_format: str) -> bytes:
+    # serializes found records in requested format (module level function, see parse_raw_authority_records)
+    if output_format == 'marc':
+        return b''.join(raw_record for raw_record in raw_records.values() if raw_record)
+
+    records = parse_raw_authority_records(raw_records)
+
+    if output_format == 'marcxml':
+        out_xml = [b'<collection>']
+        out_xml.extend(records_to_marcxml([rcd for rcd in records.values() if rcd]))
+        out_xml.append(b'</collection>')
+        return b''.join(out_xml)
+
+    # json: records by nlp_id (null if not found)
+    return ujson.dumps({nlp_id: rcd.as_dict() if rcd else None for nlp_id, rcd in records.items()},
+                       ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
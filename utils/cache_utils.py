@@ -0,0 +1,280 @@
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from config.cache_config import AUTHORITY_INT_CACHE_MAX_SIZE, AUTHORITY_INT_CACHE_TTL
+from config.cache_config import AUTHORITY_INDEX_GENERATION_KEY
+from config.cache_config import AUTHORITY_EXT_CACHE_MAX_SIZE, AUTHORITY_EXT_CACHE_TTL
+from config.cache_config import EXTERNAL_IDS_INDEX_GENERATION_KEY
+from config.cache_config import UPSTREAM_CACHE_MAX_BYTES, UPSTREAM_CACHE_MAX_ENTRY_BYTES, UPSTREAM_CACHE_TTL
+from config.cache_config import UPSTREAM_CACHE_REVALIDATE
+from utils.metrics_utils import metrics, CACHE_LOOKUPS, UPSTREAM_RESPONSES
+
+
+# marks entries not found in cache (None is a valid, cached value meaning "not in redis index")
+MISSING = object()
+
+
+class LRUTTLCache(object):
+    """
+    Bounded in-process cache with least-recently-used and time-to-live eviction.
+    Not shared between uvicorn workers - every worker holds its own instance. If generation_key is set,
+    the cache is cleared whenever the value of this key in redis changes (see mget_with_cache).
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None, name: str = 'cache',
+                 generation_key: Optional[str] = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation_key = generation_key
+        # generation of redis index the cached values come from (MISSING - not known yet)
+        self.generation = MISSING
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            else:
+                del self._data[key]
+
+        self.misses += 1
+        return MISSING
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def set_generation(self, generation: Optional[str]) -> bool:
+        # returns True if generation has changed (cached values were cleared)
+        if generation == self.generation:
+            return False
+        self.clear()
+        self.generation = generation
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'generation': None if self.generation is MISSING else self.generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None}
+
+
+async def mget_with_cache(conn, keys: Iterable[str], cache: LRUTTLCache, decode) -> Dict[str, Any]:
+    """
+    Resolves keys with cache first and sends only the missing ones to redis (single MGET).
+    Values from redis are decoded once (using decode callable) and cached - including misses (None).
+    Returned values are shared with cache, so they must not be mutated by the caller.
+    If cache has generation_key, index generation is read in the same MGET (always - even if all keys are cached)
+    and values cached before the index was changed (in any worker) are not used.
+    """
+    resolved = {}
+    keys_to_fetch = []
+
+    for key in keys:
+        value = cache.get(key)
+        if value is MISSING:
+            keys_to_fetch.append(key)
+        else:
+            resolved[key] = value
+
+    metrics.inc(CACHE_LOOKUPS, len(resolved), cache=cache.name, result='hit')
+    metrics.inc(CACHE_LOOKUPS, len(keys_to_fetch), cache=cache.name, result='miss')
+
+    if cache.generation_key and (resolved or keys_to_fetch):
+        with metrics.time('redis_lookup'):
+            generation, *fetched = await conn.mget(cache.generation_key, *keys_to_fetch)
+
+        if cache.set_generation(generation) and resolved:
+            # index was changed - cached values are fetched again
+            keys_to_fetch.extend(resolved)
+            resolved = {}
+            with metrics.time('redis_lookup'):
+                fetched = await conn.mget(*keys_to_fetch)
+
+    elif keys_to_fetch:
+        with metrics.time('redis_lookup'):
+            fetched = await conn.mget(*keys_to_fetch)
+
+    if keys_to_fetch:
+        for key, raw_value in zip(keys_to_fetch, fetched):
+            value = decode(raw_value) if raw_value else None
+            cache.set(key, value)
+            resolved[key] = value
+
+    return resolved
+
+
+class UpstreamResponse(object):
+    __slots__ = ('body', 'etag', 'last_modified', 'expires_at')
+
+    def __init__(self, body: bytes, etag: Optional[str], last_modified: Optional[str], expires_at: float):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    def is_fresh(self) -> bool:
+        return self.expires_at > time.monotonic()
+
+    def can_be_revalidated(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+
+class UpstreamResponseCache(object):
+    """
+    In-process cache of data.bn.org.pl response bodies, bounded by total size of bodies (least-recently-used eviction).
+    Expired entries are kept (until evicted) if they can be revalidated with ETag/Last-Modified.
+    Not shared between uvicorn workers - every worker holds its own instance.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int, ttl: float, revalidate: bool = True):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.size_in_bytes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[UpstreamResponse]:
+        # returns fresh entry, or expired one if it can be revalidated
+        entry = self._data.get(key)
+
+        if entry is not None:
+            if entry.is_fresh() or (self.revalidate and entry.can_be_revalidated()):
+                self._data.move_to_end(key)
+                return entry
+            self.invalidate(key)
+
+        return None
+
+    def set(self, key: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        self.invalidate(key)
+        if len(body) > self.max_entry_bytes:
+            return
+
+        self._data[key] = UpstreamResponse(body, etag, last_modified, time.monotonic() + self.ttl)
+        self.size_in_bytes += len(body)
+
+        while self.size_in_bytes > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size_in_bytes -= len(evicted.body)
+
+    def refresh(self, entry: UpstreamResponse) -> None:
+        # entry was revalidated (304 Not Modified)
+        entry.expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self, *keys: str) -> None:
+        for key in keys:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.size_in_bytes -= len(entry.body)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size_in_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.revalidated + self.misses
+        return {'size': len(self._data),
+                'size_in_bytes': self.size_in_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.revalidated) / lookups, 4) if lookups else None}
+
+
+def normalize_query(url: str) -> str:
+    # the same query with differently ordered parameters (or host in other case) gets the same cache key
+    scheme, netloc, path, query, _ = urlsplit(url)
+    return urlunsplit((scheme.lower(), netloc.lower(), path,
+                       urlencode(sorted(parse_qsl(query, keep_blank_values=True))), ''))
+
+
+async def get_with_cache(aiohttp_session, url: str, cache: UpstreamResponseCache) -> Tuple[int, Optional[bytes]]:
+    """
+    GETs url through cache and returns tuple: response status and body (None if status is not 200).
+    Only 200 responses are cached. Expired entries with validators are revalidated with conditional GET.
+    """
+    key = normalize_query(url)
+    entry = cache.get(key)
+
+    if entry is not None and entry.is_fresh():
+        cache.hits += 1
+        metrics.inc(CACHE_LOOKUPS, cache='upstream', result='hit')
+        return 200, entry.body
+
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+    with metrics.time('upstream_fetch'):
+        async with aiohttp_session.get(url, headers=headers) as response:
+            metrics.inc(UPSTREAM_RESPONSES, status=response.status)
+
+            if response.status == 304 and entry is not None:
+                cache.revalidated += 1
+                metrics.inc(CACHE_LOOKUPS, cache='upstream', result='revalidated')
+                cache.refresh(entry)
+                return 200, entry.body
+
+            cache.misses += 1
+            metrics.inc(CACHE_LOOKUPS, cache='upstream', result='miss')
+            if response.status == 200:
+                body = await response.read()
+                cache.set(key, body, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                return 200, body
+            else:
+                return response.status, None
+
+
+def new_index_generation() -> str:
+    # set under generation key by every change of the index (unique, so any change is detected)
+    return uuid.uuid4().hex
+
+
+authority_int_cache = LRUTTLCache(AUTHORITY_INT_CACHE_MAX_SIZE, AUTHORITY_INT_CACHE_TTL, name='authority_int',
+                                  generation_key=AUTHORITY_INDEX_GENERATION_KEY)
+authority_ext_cache = LRUTTLCache(AUTHORITY_EXT_CACHE_MAX_SIZE, AUTHORITY_EXT_CACHE_TTL, name='authority_ext',
+                                  generation_key=EXTERNAL_IDS_INDEX_GENERATION_KEY)
+upstream_response_cache = UpstreamResponseCache(UPSTREAM_CACHE_MAX_BYTES, UPSTREAM_CACHE_MAX_ENTRY_BYTES,
+                                                UPSTREAM_CACHE_TTL, UPSTREAM_CACHE_REVALIDATE)
@@ -0,0 +1,48 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from config.executor_config import CPU_EXECUTOR_KIND, CPU_EXECUTOR_MAX_WORKERS
+
+
+# executor is created lazily in every app worker (after uvicorn forks them)
+_cpu_executor = None
+
+
+def create_cpu_executor(kind: Optional[str] = CPU_EXECUTOR_KIND,
+                        max_workers: int = CPU_EXECUTOR_MAX_WORKERS) -> Optional[Executor]:
+    if kind == 'process':
+        # spawn - forking process with running event loop and aiohttp threads is not safe
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cpu_bound')
+    if kind is None:
+        return None
+
+    raise ValueError(f'Nieznany rodzaj executora: {kind}.')
+
+
+def get_cpu_executor() -> Optional[Executor]:
+    global _cpu_executor
+    if _cpu_executor is None:
+        _cpu_executor = create_cpu_executor()
+    return _cpu_executor
+
+
+def shutdown_cpu_executor() -> None:
+    global _cpu_executor
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=False)
+        _cpu_executor = None
+
+
+async def run_cpu_bound(func: Callable, *args, executor: Optional[Executor] = None):
+    # runs cpu-bound function outside of the event loop, so other requests are not stalled
+    # with process executor func has to be module level function and args/result have to be picklable
+    executor = executor or get_cpu_executor()
+    if executor is None:
+        return func(*args)
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, func, *args)
@@ -1,8 +1,20 @@
-from typing import Optional
+import logging
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+import redis
+from pymarc import Record
+
+from config.indexer_config import AUTHORITY_INDEX_FIELDS
+from utils.marc_utils import prepare_names_for_indexing
+from utils.mmap_marc_reader import MmapMARCReader
+from utils.serialization_utils import encode_authority_value
 from utils.coordinates_utils import check_defg_034, get_list_of_coords_from_valid_marc, convert_to_bbox
 
 
+logger = logging.getLogger(__name__)
+
+
 def get_mms_id(rcd):
     return rcd.get_fields('009')[0].value() if rcd.get_fields('009') else None
 
@@ -35,9 +47,128 @@ def get_coordinates(rcd) -> Optional[str]:
     return None
 
 
+def get_authority_index_heading(rcd: Record) -> Optional[Tuple[str, str]]:
+    # returns tag and value of the first field to index found in record
+    for fld in AUTHORITY_INDEX_FIELDS:
+        if fld in rcd:
+            return fld, rcd.get_fields(fld)[0].value()
+
+    return None
+
+
+def get_authority_index_entries(records: List[Record]) -> List[Optional[Tuple[str, dict, str]]]:
+    # returns normalized heading, serialized authority and its encoded value (see utils.serialization_utils)
+    # for every record (None if record has no field to index) - headings of all records are normalized at once
+    headings = [get_authority_index_heading(rcd) for rcd in records]
+    headings_to_index = iter(prepare_names_for_indexing([heading_full for _, heading_full in filter(None, headings)]))
+    entries = []
+
+    for rcd, heading in zip(records, headings):
+        if not heading:
+            entries.append(None)
+            continue
+
+        fld, heading_full = heading
+        heading_to_index = next(headings_to_index)
+
+        # heading_tag is used to disambiguate authority duplicates
+        # if duplicate is detected, authorities with tag 130 are ignored
+        serialized_to_dict = {'nlp_id': get_nlp_id(rcd),
+                              'mms_id': get_mms_id(rcd),
+                              'viaf_id': get_viaf_id(rcd),
+                              'coords': get_coordinates(rcd),
+                              'heading': heading_full,
+                              'heading_tag': fld}
+
+        serialized_to_json = encode_authority_value(serialized_to_dict)
+
+        entries.append((heading_to_index, serialized_to_dict, serialized_to_json))
+
+    return entries
+
+
+def get_authority_index_entry(rcd: Record) -> Optional[Tuple[str, dict, str]]:
+    # single record variant of get_authority_index_entries
+    return get_authority_index_entries([rcd])[0]
+
+
 async def is_data_bn_ok(aiohttp_session):
     async with aiohttp_session.get('http://data.bn.org.pl') as response:
         if response.status == 200:
             return True
         else:
             return None
+
+
+def yield_record_batches(path_to_file: str, batch_size: int,
+                         offsets_index_path: Optional[str] = None) -> Iterator[Tuple[str, int, int]]:
+    # group records into contiguous batches (path, start offset, end offset) for parallel processing
+    # record boundaries are taken from offsets index (cached in offsets_index_path, if given)
+    with MmapMARCReader(path_to_file, offsets_index_path=offsets_index_path) as rdr:
+        for start_ordinal in range(0, len(rdr), batch_size):
+            yield (path_to_file, *rdr.get_byte_range(start_ordinal, start_ordinal + batch_size))
+
+
+def swap_shadow_db(live_db: int, shadow_db: int, min_keys_ratio: float) -> bool:
+    # atomically replaces live index with rebuilt (shadow) one, if rebuilt index passes keys count check
+    r = redis.Redis(db=shadow_db)
+    r_live = redis.Redis(db=live_db)
+
+    shadow_keys_count = r.dbsize()
+    live_keys_count = r_live.dbsize()
+    r_live.close()
+
+    if not shadow_keys_count or shadow_keys_count < live_keys_count * min_keys_ratio:
+        logger.error(f'Indeks w bazie {shadow_db} nie przeszedł weryfikacji (kluczy: {shadow_keys_count}, '
+                     f'w bazie {live_db}: {live_keys_count}). Nie podmieniono indeksu.')
+        r.close()
+        return False
+
+    # SWAPDB is atomic - all clients connected to live db see the new index at once
+    r.swapdb(live_db, shadow_db)
+    r.close()
+
+    logger.info(f'Podmieniono indeks: baza {shadow_db} -> {live_db} (kluczy: {shadow_keys_count}, '
+                f'poprzednio: {live_keys_count}).')
+    return True
+
+
+def bulk_load_to_redis(r, items: Iterable[Tuple[str, str]], chunk_size: int = 1000,
+                       chunks_per_pipeline: int = 10, log_every: int = 100000) -> int:
+    # streams (key, value) pairs to redis in pipelined MSETs - memory use doesn't depend on number of items
+    pipe = r.pipeline(transaction=False)
+    chunk = {}
+    chunks_in_pipeline = 0
+    loaded_count = 0
+    next_log_at = log_every
+    start = time.perf_counter()
+
+    for key, value in items:
+        chunk[key] = value
+
+        if len(chunk) >= chunk_size:
+            pipe.mset(chunk)
+            loaded_count += len(chunk)
+            chunk = {}
+            chunks_in_pipeline += 1
+
+            if chunks_in_pipeline >= chunks_per_pipeline:
+                pipe.execute()
+                chunks_in_pipeline = 0
+
+            if loaded_count >= next_log_at:
+                elapsed = time.perf_counter() - start
+                logger.info(f'Załadowano kluczy: {loaded_count} ({loaded_count / elapsed:.0f} kluczy/s).')
+                next_log_at += log_every
+
+    if chunk:
+        pipe.mset(chunk)
+        loaded_count += len(chunk)
+
+    pipe.execute()
+
+    elapsed = time.perf_counter() - start
+    logger.info(f'Zakończono ładowanie. Załadowano kluczy: {loaded_count} '
+                f'w {elapsed:.1f} s ({loaded_count / elapsed if elapsed else 0:.0f} kluczy/s).')
+
+    return loaded_count
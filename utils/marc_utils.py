@@ -1,23 +1,41 @@
-import re
 import json
+import time
+from functools import lru_cache
 
-from typing import Optional, Dict, List
+from typing import AsyncIterator, Optional, Dict, List, Tuple
 
 import pymarc
 
 from config.indexer_config import FIELDS_TO_CHECK, FIELDS_TO_CHECK_FOR_OMNIS
+from config.cache_config import NORMALIZED_NAMES_CACHE_MAX_SIZE
+from config.executor_config import SERIALIZATION_SLICE_SIZE
+from utils.cache_utils import authority_int_cache, authority_ext_cache, mget_with_cache
+from utils.executor_utils import run_cpu_bound
+from utils.serialization_utils import decode_authority_value
+from utils.metrics_utils import metrics, RECORDS, STAGE_DURATION, TERMS
 
 
+class _NonAlnumToSpaceTable(dict):
+    # translate table for str.translate, filled lazily: every character, which is not a letter or digit, maps to space
+    def __missing__(self, codepoint: int) -> int:
+        mapped = codepoint if chr(codepoint).isalnum() else 32
+        self[codepoint] = mapped
+        return mapped
+
+
+NON_ALNUM_TO_SPACE_TABLE = _NonAlnumToSpaceTable()
+
+
+@lru_cache(maxsize=NORMALIZED_NAMES_CACHE_MAX_SIZE)
 def prepare_name_for_indexing(descriptor_name: str) -> str:
     if descriptor_name:
         # 4.1 wszystko, co nie jest literą lub cyfrą zastępowane jest spacją
-        descriptor_name = ''.join(char.replace(char, ' ') if not char.isalnum() else char for char in descriptor_name)
+        descriptor_name = descriptor_name.translate(NON_ALNUM_TO_SPACE_TABLE)
 
         # 4.2 wielokrotne białe znaki są redukowane do jednej spacji
-        descriptor_name = re.sub(r'\s{2,}', ' ', descriptor_name)
-
         # 4.3 białe znaki z początku i końca są usuwane
-        descriptor_name = descriptor_name.strip()
+        # (after 4.1 the only white space left is space, so split/join does both)
+        descriptor_name = ' '.join(descriptor_name.split())
 
         # 4.4 wszystkie znaki podniesione do wielkich liter
         descriptor_name = descriptor_name.upper()
@@ -25,6 +43,12 @@ def prepare_name_for_indexing(descriptor_name: str) -> str:
     return descriptor_name
 
 
+def prepare_names_for_indexing(descriptor_names: List[str]) -> List[str]:
+    # batch variant - every distinct name is normalized only once
+    normalized = {name: prepare_name_for_indexing(name) for name in set(descriptor_names)}
+    return [normalized[name] for name in descriptor_names]
+
+
 def normalize_nlp_id_bib(nlp_id: str) -> str:
     if len(nlp_id) == 14 and nlp_id[1] in ['0', '1']:
         return nlp_id
@@ -47,14 +71,18 @@ def convert_nlp_id_auth_to_sierra_format(nlp_id: str) -> Optional[str]:
         return nlp_id
 
 
-async def get_terms_to_search_and_references_to_raw_flds(marc_record: pymarc.Record,
-                                                         for_omnis: bool = False) -> Dict[str, List[pymarc.Field]]:
-    # create empty dict for results
-    terms_fields_ids = {}
+def get_fields_and_terms(marc_record: pymarc.Record,
+                         for_omnis: bool = False) -> List[Tuple[pymarc.Field, str]]:
+    # read-only single pass over fields to check: every raw field (pymarc.Field) with its term to search,
+    # in order of fields to check (field tag is raw_fld.tag)
 
     # switch between fields to check
     fields_to_check = FIELDS_TO_CHECK_FOR_OMNIS if for_omnis else FIELDS_TO_CHECK
 
+    # list of raw field objects (pymarc.Field) and raw terms
+    raw_flds = []
+    raw_terms = []
+
     # iterate over constant: fields to check in marc record
     for marc_field_and_subfields in fields_to_check:
 
@@ -67,15 +95,24 @@ async def get_terms_to_search_and_references_to_raw_flds(marc_record: pymarc.Rec
             # get list of raw field objects (pymarc.Field)
             raw_objects_flds_list = marc_record.get_fields(fld)
 
-            # iterate over raw field objects
+            # iterate over raw field objects and get raw term from every raw field
             for raw_fld in raw_objects_flds_list:
+                raw_flds.append(raw_fld)
+                raw_terms.append(' '.join(subfld for subfld in raw_fld.get_subfields(*subflds)))
 
-                # get term from raw field and normalize it
-                term_to_search = prepare_name_for_indexing(
-                    ' '.join(subfld for subfld in raw_fld.get_subfields(*subflds)))
+    # normalize all terms from marc record at once
+    return list(zip(raw_flds, prepare_names_for_indexing(raw_terms)))
 
-                # create new entry in dict if necessary and/or append raw fld to list
-                terms_fields_ids.setdefault(term_to_search, {}).setdefault('raw_flds', []).append(raw_fld)
+
+async def get_terms_to_search_and_references_to_raw_flds(marc_record: pymarc.Record,
+                                                         for_omnis: bool = False) -> Dict[str, List[pymarc.Field]]:
+    # create empty dict for results
+    terms_fields_ids = {}
+
+    for raw_fld, term_to_search in get_fields_and_terms(marc_record, for_omnis=for_omnis):
+
+        # create new entry in dict if necessary and/or append raw fld to list
+        terms_fields_ids.setdefault(term_to_search, {}).setdefault('raw_flds', []).append(raw_fld)
 
     return terms_fields_ids
 
@@ -98,6 +135,32 @@ def calculate_check_digit(record_id: str) -> str:
     return record_id + check_digit
 
 
+def add_ids_to_raw_flds(terms_fields_ids: dict, identifier_type: str) -> None:
+    # add single subfield |0 to fields in marc record by identifier type
+    if identifier_type in ['nlp_id', 'mms_id']:
+        for flds_ids in terms_fields_ids.values():
+            for field in flds_ids.get('raw_flds'):
+                if flds_ids.get('internal_ids'):
+                    field.add_subfield('0', flds_ids.get('internal_ids').get(identifier_type))
+
+    # add multiple subfields |0 to fields in marc record if identifier type == all_ids
+    if identifier_type == 'all_ids':
+        for flds_ids in terms_fields_ids.values():
+            for field in flds_ids.get('raw_flds'):
+
+                i_ids = flds_ids.get('internal_ids')
+                if i_ids:
+                    for id_type, ident in i_ids.items():
+                        if ident and id_type != 'heading':
+                            field.add_subfield('0', f'({id_type}){ident}')
+
+                e_ids = flds_ids.get('external_ids')
+                if e_ids:
+                    for id_type, ident in e_ids.items():
+                        if ident:
+                            field.add_subfield('0', f'({id_type}){ident}')
+
+
 async def process_record(marc_record: pymarc.Record,
                          conn_auth_int,
                          identifier_type: str,
@@ -115,53 +178,188 @@ async def process_record(marc_record: pymarc.Record,
     # there are some cases, when there is nothing to resolve, so better check it
     if terms_fields_ids:
         # get all internal ids (meaning: from original NLP database via data.bn.org.pl) from redis index db=8
-        internal_ids = await conn_auth_int.mget(*list(terms_fields_ids.keys()))
+        # (cache first - only terms missing in cache are sent to redis)
+        internal_ids = await mget_with_cache(conn_auth_int, terms_fields_ids.keys(), authority_int_cache,
+                                             decode_authority_value)
 
         # add internal ids to terms_fields_ids dict and prepare helper list of tuples for external ids redis query
         helper_list_for_ext_ids_query = []
 
-        for term, int_ids in zip(list(terms_fields_ids.keys()), internal_ids):
-            if int_ids:
+        for term, in_json in internal_ids.items():
+            if in_json:
                 fields_ids = terms_fields_ids.get(term)
-                in_json = json.loads(int_ids)
                 fields_ids.setdefault('internal_ids', in_json)
                 helper_list_for_ext_ids_query.append((term, transform_nlp_id(in_json.get('nlp_id'))))
 
-        # add single subfield |0 to fields in marc record by identifier type
-        if identifier_type in ['nlp_id', 'mms_id']:
-            for flds_ids in terms_fields_ids.values():
-                for field in flds_ids.get('raw_flds'):
-                    if flds_ids.get('internal_ids'):
-                        field.add_subfield('0', flds_ids.get('internal_ids').get(identifier_type))
+        # get all external ids from redis index db=9 (only needed if identifier type == all_ids)
+        if identifier_type == 'all_ids' and helper_list_for_ext_ids_query:
+            external_ids = await mget_with_cache(conn_auth_ext,
+                                                 [nlp_id for term, nlp_id in helper_list_for_ext_ids_query],
+                                                 authority_ext_cache,
+                                                 json.loads)
+
+            for term, nlp_id in helper_list_for_ext_ids_query:
+                ext_ids = external_ids.get(nlp_id)
+                if ext_ids:
+                    fields_ids = terms_fields_ids.get(term)
+                    fields_ids.setdefault('external_ids', ext_ids)
+
+        add_ids_to_raw_flds(terms_fields_ids, identifier_type)
+
+    if polona:
+        return terms_fields_ids
+    else:
+        return marc_record
+
+
+async def resolve_terms(terms: List[str],
+                        conn_auth_int,
+                        identifier_type: str,
+                        conn_auth_ext) -> Dict[str, dict]:
+    """
+    Resolves unique terms with single MGET per redis index (db=8, db=9) - terms already present
+    in in-process cache are not sent to redis at all.
+    Returns dict: term -> {'internal_ids': ..., 'external_ids': ...} (only found ids, empty dict if none).
+    Ids are shared with cache, so they must not be mutated by the caller.
+    """
+    resolved_ids = {term: {} for term in terms}
+    metrics.inc(TERMS, len(resolved_ids))
+
+    # there are some cases, when there is nothing to resolve, so better check it
+    if resolved_ids:
+        # get all internal ids from redis index db=8 in one round trip (cache first)
+        resolved_internal_ids = await mget_with_cache(conn_auth_int, resolved_ids.keys(), authority_int_cache,
+                                                      decode_authority_value)
+
+        # get all external ids from redis index db=9 in one round trip (only needed if identifier type == all_ids)
+        resolved_external_ids = {}
 
-        # add multiple subfields |0 to fields in marc record if identifier type == all_ids
         if identifier_type == 'all_ids':
-            all_ids = {}
+            unique_nlp_ids = list(dict.fromkeys(transform_nlp_id(int_ids.get('nlp_id'))
+                                                for int_ids in resolved_internal_ids.values() if int_ids))
+            if unique_nlp_ids:
+                resolved_external_ids = await mget_with_cache(conn_auth_ext, unique_nlp_ids,
+                                                              authority_ext_cache, json.loads)
+
+        for term, ids in resolved_ids.items():
+            int_ids = resolved_internal_ids.get(term)
+            if int_ids:
+                ids['internal_ids'] = int_ids
+                ext_ids = resolved_external_ids.get(transform_nlp_id(int_ids.get('nlp_id')))
+                if ext_ids:
+                    ids['external_ids'] = ext_ids
 
-            if helper_list_for_ext_ids_query:
-                external_ids = await conn_auth_ext.mget(*[nlp_id for term, nlp_id in helper_list_for_ext_ids_query])
+    return resolved_ids
 
-                for term_nlp_id, ext_ids in zip(helper_list_for_ext_ids_query, external_ids):
-                    if ext_ids:
-                        fields_ids = terms_fields_ids.get(term_nlp_id[0])
-                        fields_ids.setdefault('external_ids', json.loads(ext_ids))
 
-            for flds_ids in terms_fields_ids.values():
-                for field in flds_ids.get('raw_flds'):
+async def resolve_records_chunk(marc_records: List[pymarc.Record],
+                                conn_auth_int,
+                                identifier_type: str,
+                                conn_auth_ext,
+                                for_omnis: bool = False) -> List[dict]:
+    """
+    Resolves authority identifiers of many bibliographic records at once (without modifying the records).
+    Terms from all records are deduplicated and resolved together (see resolve_terms),
+    so the number of redis round trips doesn't grow with the number of records in the chunk.
+    Returns terms_fields_ids (the same as process_record with polona=True) for every record.
+    """
 
-                    i_ids = flds_ids.get('internal_ids')
-                    if i_ids:
-                        for id_type, ident in i_ids.items():
-                            if ident and id_type != 'heading':
-                                field.add_subfield('0', f'({id_type}){ident}')
+    metrics.inc(RECORDS, len(marc_records))
 
-                    e_ids = flds_ids.get('external_ids')
-                    if e_ids:
-                        for id_type, ident in e_ids.items():
-                            if ident:
-                                field.add_subfield('0', f'({id_type}){ident}')
+    with metrics.time('term_extraction'):
+        # get all terms to search for and references to raw flds for every record in chunk
+        terms_fields_ids_per_record = [await get_terms_to_search_and_references_to_raw_flds(rcd,
+                                                                                            for_omnis=for_omnis)
+                                       for rcd in marc_records]
 
-    if polona:
-        return terms_fields_ids
-    else:
-        return marc_record
+        # deduplicate terms (preserving order) across the whole chunk
+        unique_terms = list(dict.fromkeys(term
+                                          for terms_fields_ids in terms_fields_ids_per_record
+                                          for term in terms_fields_ids))
+
+    resolved_ids = await resolve_terms(unique_terms, conn_auth_int, identifier_type, conn_auth_ext)
+
+    # spread resolved ids back onto terms_fields_ids of every record
+    for terms_fields_ids in terms_fields_ids_per_record:
+        for term, fields_ids in terms_fields_ids.items():
+            for ids_type, ids in resolved_ids.get(term).items():
+                fields_ids.setdefault(ids_type, ids)
+
+    return terms_fields_ids_per_record
+
+
+async def extract_and_resolve_terms_chunk(marc_records: List[pymarc.Record],
+                                          conn_auth_int,
+                                          identifier_type: str,
+                                          conn_auth_ext,
+                                          for_omnis: bool = False) -> List[List[Tuple[str, str, dict]]]:
+    """
+    Read-only extraction API: for every record returns list of tuples (field tag, term, resolved ids)
+    in order of fields to check. Every field is normalized once and records are not modified.
+    Terms of all records are resolved together (see resolve_terms).
+    """
+    metrics.inc(RECORDS, len(marc_records))
+
+    with metrics.time('term_extraction'):
+        fields_and_terms_per_record = [get_fields_and_terms(rcd, for_omnis=for_omnis) for rcd in marc_records]
+
+        unique_terms = list(dict.fromkeys(term
+                                          for fields_and_terms in fields_and_terms_per_record
+                                          for _, term in fields_and_terms))
+
+    resolved_ids = await resolve_terms(unique_terms, conn_auth_int, identifier_type, conn_auth_ext)
+
+    return [[(raw_fld.tag, term, resolved_ids.get(term)) for raw_fld, term in fields_and_terms]
+            for fields_and_terms in fields_and_terms_per_record]
+
+
+async def process_records_chunk(marc_records: List[pymarc.Record],
+                                conn_auth_int,
+                                identifier_type: str,
+                                conn_auth_ext,
+                                for_omnis: bool = False) -> List[pymarc.Record]:
+    """
+    Chunk-level processing loop for adding authority identifiers to many bibliographic records at once
+    (see resolve_records_chunk).
+    """
+    terms_fields_ids_per_record = await resolve_records_chunk(marc_records, conn_auth_int, identifier_type,
+                                                              conn_auth_ext, for_omnis=for_omnis)
+
+    # add subfields |0
+    for terms_fields_ids in terms_fields_ids_per_record:
+        add_ids_to_raw_flds(terms_fields_ids, identifier_type)
+
+    return marc_records
+
+
+def records_to_marcxml(marc_records: List[pymarc.Record]) -> List[bytes]:
+    # module level function, so it can be run in executor worker process (see utils.executor_utils)
+    return [pymarc.marcxml.record_to_xml(rcd, namespace=True) for rcd in marc_records]
+
+
+async def stream_records_to_marcxml(marc_records: List[pymarc.Record],
+                                    slice_size: int = SERIALIZATION_SLICE_SIZE) -> AsyncIterator[bytes]:
+    # records are serialized outside of the event loop in small slices - every slice is yielded as soon as it's ready
+    # serialization time of all slices is observed once (as for not streamed response)
+    elapsed = 0.0
+    try:
+        for start in range(0, len(marc_records), slice_size):
+            slice_start = time.perf_counter()
+            records_xml = await run_cpu_bound(records_to_marcxml, marc_records[start:start + slice_size])
+            elapsed += time.perf_counter() - slice_start
+
+            for rcd_xml in records_xml:
+                yield rcd_xml
+    finally:
+        metrics.observe(STAGE_DURATION, elapsed, stage='serialization')
+
+
+def read_marc_record_from_bytes(marc_bytes: bytes) -> Optional[pymarc.Record]:
+    # reads first record from iso2709 bytes (module level function, so it can be run in executor worker process)
+    marc_rdr = pymarc.MARCReader(marc_bytes,
+                                 to_unicode=True,
+                                 force_utf8=True,
+                                 utf8_handling='ignore',
+                                 permissive=True)
+    for rcd in marc_rdr:
+        return rcd
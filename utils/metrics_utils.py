@@ -0,0 +1,187 @@
+import asyncio
+import functools
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Optional
+
+from config.metrics_config import METRICS_DURATION_BUCKETS, METRICS_IDENTIFIER_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+# totals of all workers (hash: series in prometheus text format -> value) kept in STATE_DB
+METRICS_KEY = 'metrics:khw'
+
+STAGE_DURATION = 'khw_stage_duration_seconds'
+RECORDS = 'khw_records_total'
+TERMS = 'khw_terms_total'
+CACHE_LOOKUPS = 'khw_cache_lookups_total'
+UPSTREAM_RESPONSES = 'khw_upstream_responses_total'
+
+# metric name -> (type, help)
+METRICS = {STAGE_DURATION: ('histogram', 'Duration of request processing stages (upstream_fetch, parse, '
+                                         'term_extraction, redis_lookup, serialization, total).'),
+           RECORDS: ('counter', 'Processed marc records.'),
+           TERMS: ('counter', 'Unique terms resolved in authority index.'),
+           CACHE_LOOKUPS: ('counter', 'In-process cache lookups by cache and result.'),
+           UPSTREAM_RESPONSES: ('counter', 'Responses from data.bn.org.pl by status code.')}
+
+# labels of the request being processed (endpoint and identifier type) - copied to tasks started by the request
+request_labels: ContextVar[Optional[Dict[str, str]]] = ContextVar('metrics_request_labels', default=None)
+
+SERIES_PATTERN = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{.*\})?$')
+LE_PATTERN = re.compile(r',?le="([^"]*)"')
+
+
+def set_request_labels(endpoint: str, identifier_type: Optional[str] = None) -> None:
+    labels = {'endpoint': endpoint}
+    if identifier_type is not None:
+        # identifier type comes from request path - unknown values are not used as label values
+        labels['identifier_type'] = identifier_type if identifier_type in METRICS_IDENTIFIER_TYPES else 'other'
+    request_labels.set(labels)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_series(name: str, labels: Dict[str, str]) -> str:
+    if not labels:
+        return name
+    formatted_labels = ','.join(f'{label}="{escape_label_value(value)}"' for label, value in sorted(labels.items()))
+    return f'{name}{{{formatted_labels}}}'
+
+
+def format_le(bucket: float) -> str:
+    return '+Inf' if bucket == float('inf') else repr(float(bucket))
+
+
+class Metrics(object):
+    """
+    Counters and histograms of single worker. Only changes since the last flush are kept in memory,
+    flush() adds them to totals in redis (HINCRBYFLOAT), so totals of all uvicorn workers are aggregated there.
+    """
+
+    def __init__(self, buckets=METRICS_DURATION_BUCKETS):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._pending: Dict[str, float] = defaultdict(float)
+
+    @staticmethod
+    def get_labels(**labels: str) -> Dict[str, str]:
+        merged = dict(request_labels.get() or {})
+        merged.update((label, str(value)) for label, value in labels.items() if value is not None)
+        return merged
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        if amount:
+            self._pending[format_series(name, self.get_labels(**labels))] += amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        labels = self.get_labels(**labels)
+
+        # buckets are cumulative (as in prometheus text format)
+        for bucket in self.buckets:
+            if value <= bucket:
+                self._pending[format_series(f'{name}_bucket', dict(labels, le=format_le(bucket)))] += 1
+        self._pending[format_series(f'{name}_sum', labels)] += value
+        self._pending[format_series(f'{name}_count', labels)] += 1
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(STAGE_DURATION, time.perf_counter() - start, stage=stage)
+
+    async def time_stream(self, parts: AsyncIterator, start: float, stage: str = 'total') -> AsyncIterator:
+        # streamed response is timed until its last part is sent (start: time.perf_counter() of the request)
+        try:
+            async for part in parts:
+                yield part
+        finally:
+            self.observe(STAGE_DURATION, time.perf_counter() - start, stage=stage)
+
+    async def flush(self, conn_state) -> None:
+        pending, self._pending = self._pending, defaultdict(float)
+        if not pending:
+            return
+
+        try:
+            pipe = conn_state.pipeline()
+            for series, delta in pending.items():
+                pipe.hincrbyfloat(METRICS_KEY, series, delta)
+            await pipe.execute()
+        except Exception:
+            # changes are kept for the next flush
+            for series, delta in pending.items():
+                self._pending[series] += delta
+            raise
+
+
+def timed_endpoint(endpoint: str, identifier_type: Optional[str] = None):
+    # sets request labels and measures total time of (not streamed) endpoint
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            set_request_labels(endpoint, identifier_type)
+            with metrics.time('total'):
+                return await handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def flush_metrics(metrics_instance: Metrics, conn_state) -> None:
+    try:
+        await metrics_instance.flush(conn_state)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception(f'Pojawił się problem z zapisem metryk.')
+
+
+async def run_metrics_flusher(metrics_instance: Metrics, conn_state, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await flush_metrics(metrics_instance, conn_state)
+
+
+def get_series_sort_key(series: str):
+    # series of the same metric and labels are kept together, histogram buckets in order of their bounds
+    le = LE_PATTERN.search(series)
+    return LE_PATTERN.sub('', series), float(le.group(1)) if le else 0.0
+
+
+def render_metrics(totals: Dict[str, str]) -> str:
+    # prometheus text format (version 0.0.4) from totals of all workers
+    series_by_metric = defaultdict(list)
+
+    for series, value in totals.items():
+        matched = SERIES_PATTERN.match(series)
+        if not matched:
+            continue
+
+        name = matched.group('name')
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and METRICS.get(name[:-len(suffix)], ('',))[0] == 'histogram':
+                name = name[:-len(suffix)]
+                break
+
+        series_by_metric[name].append((series, value))
+
+    lines = []
+    for name in sorted(series_by_metric):
+        metric_type, metric_help = METRICS.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {metric_help}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(f'{series} {value}'
+                     for series, value in sorted(series_by_metric[name], key=lambda s: get_series_sort_key(s[0])))
+
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
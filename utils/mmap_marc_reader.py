@@ -0,0 +1,204 @@
+import logging
+import mmap
+import os
+import struct
+from array import array
+from typing import Iterator, Optional, Tuple
+
+import pymarc
+
+
+logger = logging.getLogger(__name__)
+
+END_OF_RECORD = 0x1d
+
+# cached offsets index file: header (magic, size and mtime of the indexed file) and offsets of all records
+# followed by the end offset of the last record (array of unsigned 64-bit integers)
+OFFSETS_INDEX_MAGIC = b'MRCIDX01'
+OFFSETS_INDEX_HEADER = struct.Struct('<8sQQ')
+
+
+def scan_record_ranges(buffer, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    # split ISO2709 buffer into (offset, length) of every record using record length from leader
+    # only leaders are read - records are not copied
+    end = len(buffer) if end is None else end
+    pos = start
+
+    while end - pos >= 5:
+        try:
+            length = int(buffer[pos:pos + 5])
+        except ValueError:
+            length = 0
+
+        if length < 5:
+            # corrupted leader - skip to the next record (right after the end of record marker)
+            end_of_record = buffer.find(b'\x1d', pos, end)
+            if end_of_record == -1:
+                break
+            length = end_of_record + 1 - pos
+
+        # truncated last record ends with the buffer
+        length = min(length, end - pos)
+        yield pos, length
+        pos += length
+
+
+def get_raw_control_field(raw_record, tag: str = '001') -> Optional[str]:
+    # value of control field read straight from the directory of raw record (without parsing the whole record)
+    try:
+        base_address = int(bytes(raw_record[12:17]))
+        directory = bytes(raw_record[24:base_address - 1])
+        encoded_tag = tag.encode('ascii')
+
+        for entry_start in range(0, len(directory) - 11, 12):
+            if directory[entry_start:entry_start + 3] == encoded_tag:
+                length = int(directory[entry_start + 3:entry_start + 7])
+                offset = base_address + int(directory[entry_start + 7:entry_start + 12])
+                return bytes(raw_record[offset:offset + length - 1]).decode('utf-8', errors='ignore')
+
+    except ValueError:
+        pass
+
+    return None
+
+
+class MmapMARCReader(object):
+    """
+    Reads ISO2709 file mapped into memory. Record boundaries (offsets index) are computed from
+    leader lengths once, so records can be accessed by ordinal and raw records are handed out
+    as memoryview slices of the mapped file (without copying).
+    Corrupted records are skipped while iterating (see count and failed counters).
+
+    Raw slices stay valid after the reader is closed - while any of them is referenced, the file stays mapped
+    and is unmapped when the last one is released (see close). Parsed records don't reference the mapped file.
+    """
+
+    def __init__(self, path_to_file: str, start: int = 0, end: Optional[int] = None,
+                 offsets_index_path: Optional[str] = None, to_unicode: bool = True, force_utf8: bool = True,
+                 utf8_handling: str = 'ignore'):
+        self.path_to_file = path_to_file
+        self.to_unicode = to_unicode
+        self.force_utf8 = force_utf8
+        self.utf8_handling = utf8_handling
+
+        # number of records read and number of corrupted (skipped) records
+        self.count = 0
+        self.failed = 0
+
+        self.file_handle = open(path_to_file, 'rb')
+        file_stat = os.fstat(self.file_handle.fileno())
+
+        # empty file can't be mapped
+        self.mm = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ) if file_stat.st_size else None
+        self.view = memoryview(self.mm) if self.mm else memoryview(b'')
+
+        if offsets_index_path and start == 0 and end is None:
+            # cached index of the whole file (rebuilt if the file was modified)
+            self.offsets = self.load_offsets_index(offsets_index_path, file_stat)
+            if self.offsets is None:
+                self.offsets = self.build_offsets(start, end)
+                self.save_offsets_index(offsets_index_path, file_stat, self.offsets)
+        else:
+            self.offsets = self.build_offsets(start, end)
+
+    def build_offsets(self, start: int = 0, end: Optional[int] = None) -> array:
+        offsets = array('Q')
+        record_end = start
+
+        for offset, length in scan_record_ranges(self.mm if self.mm else b'', start, end):
+            offsets.append(offset)
+            record_end = offset + length
+
+        offsets.append(record_end)
+        return offsets
+
+    @staticmethod
+    def load_offsets_index(offsets_index_path: str, file_stat: os.stat_result) -> Optional[array]:
+        try:
+            with open(offsets_index_path, 'rb') as fp:
+                magic, size, mtime_ns = OFFSETS_INDEX_HEADER.unpack(fp.read(OFFSETS_INDEX_HEADER.size))
+                if (magic, size, mtime_ns) != (OFFSETS_INDEX_MAGIC, file_stat.st_size, file_stat.st_mtime_ns):
+                    logger.info(f'Indeks rekordów {offsets_index_path} jest nieaktualny. Zostanie utworzony ponownie.')
+                    return None
+
+                offsets = array('Q')
+                offsets.frombytes(fp.read())
+                return offsets if offsets else None
+
+        except (OSError, struct.error, ValueError):
+            return None
+
+    @staticmethod
+    def save_offsets_index(offsets_index_path: str, file_stat: os.stat_result, offsets: array) -> None:
+        # index is written to temporary file and renamed, so readers never see partial index
+        path_to_tmp = f'{offsets_index_path}.tmp'
+        with open(path_to_tmp, 'wb') as fp:
+            fp.write(OFFSETS_INDEX_HEADER.pack(OFFSETS_INDEX_MAGIC, file_stat.st_size, file_stat.st_mtime_ns))
+            offsets.tofile(fp)
+        os.replace(path_to_tmp, offsets_index_path)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_raw(self, ordinal: int) -> memoryview:
+        # raw record (iso2709) as slice of the mapped file
+        return self.view[self.offsets[ordinal]:self.offsets[ordinal + 1]]
+
+    def get_byte_range(self, start_ordinal: int, stop_ordinal: int) -> Tuple[int, int]:
+        # byte range of records [start_ordinal, stop_ordinal) - used to split the file between workers
+        stop_ordinal = min(stop_ordinal, len(self))
+        return self.offsets[start_ordinal], self.offsets[stop_ordinal]
+
+    def parse(self, raw_record: memoryview) -> Optional[pymarc.Record]:
+        # pymarc parses bytes only, so the record is copied once here
+        if len(raw_record) < 24 or raw_record[-1] != END_OF_RECORD:
+            return None
+
+        try:
+            return pymarc.Record(bytes(raw_record),
+                                 to_unicode=self.to_unicode,
+                                 force_utf8=self.force_utf8,
+                                 utf8_handling=self.utf8_handling)
+        except Exception:
+            return None
+
+    def __getitem__(self, ordinal: int) -> Optional[pymarc.Record]:
+        # None for corrupted record
+        return self.parse(self.get_raw(ordinal))
+
+    def iter_raw(self, start_ordinal: int = 0, stop_ordinal: Optional[int] = None) -> Iterator[memoryview]:
+        stop_ordinal = len(self) if stop_ordinal is None else min(stop_ordinal, len(self))
+        for ordinal in range(start_ordinal, stop_ordinal):
+            yield self.get_raw(ordinal)
+
+    def iter_records(self, start_ordinal: int = 0, stop_ordinal: Optional[int] = None) -> Iterator[pymarc.Record]:
+        # raw slice is not kept in generator frame while the record is yielded (see close)
+        stop_ordinal = len(self) if stop_ordinal is None else min(stop_ordinal, len(self))
+        for ordinal in range(start_ordinal, stop_ordinal):
+            self.count += 1
+            rcd = self.parse(self.get_raw(ordinal))
+            if rcd is None:
+                self.failed += 1
+                logger.debug(f'Pominięto uszkodzony rekord ({self.path_to_file}).')
+                continue
+            yield rcd
+
+    def __iter__(self) -> Iterator[pymarc.Record]:
+        return self.iter_records()
+
+    def close(self) -> None:
+        self.view.release()
+        if self.mm:
+            try:
+                self.mm.close()
+            except BufferError:
+                # raw slices are still referenced (e.g. by partly consumed iter_raw) -
+                # file is unmapped when the last of them is released
+                logger.debug(f'Plik {self.path_to_file} pozostaje zmapowany do zwolnienia wszystkich rekordów.')
+        self.file_handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,57 @@
+from typing import Dict, Iterable, List, Set
+
+from config.polona_lod_config import POLONA_LOD_DOCUMENT_TTL, POLONA_LOD_HEADING_KEY_PREFIX, POLONA_LOD_STALE_KEY
+
+
+# writes document (hash) with expiry, unless it was marked as stale by authority updater in the meantime
+# (document may be computed from authority data older than the change - it's served live until recomputed)
+WRITE_DOCUMENT_SCRIPT = ("if redis.call('sismember', KEYS[2], KEYS[1]) == 1 then return 0 end "
+                         "redis.call('hmset', KEYS[1], unpack(ARGV, 2)) "
+                         "return redis.call('expire', KEYS[1], ARGV[1])")
+
+
+def get_heading_key(heading: str) -> str:
+    return f'{POLONA_LOD_HEADING_KEY_PREFIX}{heading}'
+
+
+def add_polona_lod_documents_to_pipeline(pipe, documents: Dict[str, Dict[str, str]], headings: Dict[str, Set[str]],
+                                         ttl: int = POLONA_LOD_DOCUMENT_TTL) -> None:
+    # every document is a hash with serialized v1 and v2 json, its bib nlp_id is added to sets of all headings
+    # of the record (also not resolved ones - heading added later to authority index changes the document)
+    bib_nlp_ids_by_heading = {}
+
+    for bib_nlp_id, versions in documents.items():
+        pipe.eval(WRITE_DOCUMENT_SCRIPT, keys=[bib_nlp_id, POLONA_LOD_STALE_KEY],
+                  args=[ttl, *(item for field_and_value in versions.items() for item in field_and_value)])
+        for heading in headings.get(bib_nlp_id, ()):
+            bib_nlp_ids_by_heading.setdefault(heading, []).append(bib_nlp_id)
+
+    for heading, bib_nlp_ids in bib_nlp_ids_by_heading.items():
+        pipe.sadd(get_heading_key(heading), *bib_nlp_ids)
+
+
+async def mark_polona_lod_documents_stale(conn_polona_lod, headings: Iterable[str]) -> List[str]:
+    # documents computed from changed headings are removed (served live until recomputed)
+    # and marked for recomputation - returns their bib nlp_ids
+    heading_keys = [get_heading_key(heading) for heading in dict.fromkeys(headings) if heading]
+    if not heading_keys:
+        return []
+
+    bib_nlp_ids = await conn_polona_lod.sunion(*heading_keys)
+    if bib_nlp_ids:
+        tr = conn_polona_lod.multi_exec()
+        tr.delete(*bib_nlp_ids)
+        tr.sadd(POLONA_LOD_STALE_KEY, *bib_nlp_ids)
+        await tr.execute()
+
+    return list(bib_nlp_ids)
+
+
+async def pop_stale_polona_lod_documents(conn_polona_lod) -> Set[str]:
+    # bib nlp_ids marked as stale are read and removed atomically - ids marked later stay in the set
+    tr = conn_polona_lod.multi_exec()
+    tr.smembers(POLONA_LOD_STALE_KEY)
+    tr.delete(POLONA_LOD_STALE_KEY)
+    stale_bib_ids, _ = await tr.execute()
+
+    return set(stale_bib_ids)
@@ -0,0 +1,36 @@
+from typing import Optional, Union
+
+import ujson
+
+
+# authority index (redis db=8) values
+# version 2: compact json array with fixed fields order (without repeated key names)
+# [2, nlp_id, mms_id, viaf_id, coords, heading, heading_tag]
+# legacy (version 1): json object with the same keys
+AUTHORITY_VALUE_FORMAT_VERSION = 2
+AUTHORITY_VALUE_FIELDS = ('nlp_id', 'mms_id', 'viaf_id', 'coords', 'heading', 'heading_tag')
+
+
+def encode_authority_value(serialized_to_dict: dict) -> str:
+    return ujson.dumps([AUTHORITY_VALUE_FORMAT_VERSION, *(serialized_to_dict.get(field)
+                                                          for field in AUTHORITY_VALUE_FIELDS)],
+                       ensure_ascii=False, escape_forward_slashes=False)
+
+
+def decode_authority_value(value: Optional[Union[str, bytes]]) -> Optional[dict]:
+    # detects format by the type of decoded json (array or object), so both formats can be read during migration
+    # value may be str or bytes (redis client without decode_responses)
+    if not value:
+        return None
+
+    decoded = ujson.loads(value)
+
+    if isinstance(decoded, list):
+        if decoded[0] != AUTHORITY_VALUE_FORMAT_VERSION:
+            raise ValueError(f'Nieznana wersja formatu wartości indeksu: {decoded[0]}.')
+        return dict(zip(AUTHORITY_VALUE_FIELDS, decoded[1:]))
+
+    if not isinstance(decoded, dict):
+        raise ValueError(f'Nieznany format wartości indeksu: {value[:20]!r}.')
+
+    return decoded
@@ -0,0 +1,95 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List
+
+
+class SharedStream(object):
+    """
+    Async iterable driven by single background task, which can be replayed by any number of consumers
+    (including the ones that joined late). Parts are kept until the stream is released by its SingleFlight.
+    """
+
+    def __init__(self, parts_iterator: AsyncIterator):
+        self.parts: List[Any] = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._produce(parts_iterator))
+
+    async def _produce(self, parts_iterator: AsyncIterator) -> None:
+        try:
+            async for part in parts_iterator:
+                self.parts.append(part)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        # wakes up all waiting consumers, next ones wait for the next part
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def iterate(self) -> AsyncIterator:
+        position = 0
+        while True:
+            while position < len(self.parts):
+                yield self.parts[position]
+                position += 1
+
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+
+            await self._changed.wait()
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent computations (per worker): the first caller starts the computation,
+    callers with the same key that come while it's in flight share its result.
+    Computation runs as separate task, so it's not cancelled if the caller that started it disconnects.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, Any] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def _start(self, key: Hashable, flight, done_future: asyncio.Future) -> None:
+        self._in_flight[key] = flight
+        self.executed += 1
+
+        def release(_):
+            if self._in_flight.get(key) is flight:
+                del self._in_flight[key]
+
+        done_future.add_done_callback(release)
+
+    async def do(self, key: Hashable, coro_factory: Callable[[], Awaitable]) -> Any:
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_factory())
+            self._start(key, future, future)
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(future)
+
+    def stream(self, key: Hashable, parts_factory: Callable[[], AsyncIterator]) -> AsyncIterator:
+        # the same as do(), but for streamed responses - every caller gets all parts of the shared stream
+        shared_stream = self._in_flight.get(key)
+        if shared_stream is None:
+            shared_stream = SharedStream(parts_factory())
+            self._start(key, shared_stream, shared_stream.task)
+        else:
+            self.shared += 1
+
+        return shared_stream.iterate()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'in_flight': len(self._in_flight),
+                'executed': self.executed,
+                'shared': self.shared}
@@ -1,4 +1,18 @@
+from datetime import datetime
+from typing import List, Tuple
+
+
 def get_nlp_id_from_json(rcd):
     for fld in rcd['marc']['fields']:
         if fld.get('001'):
             return fld.get('001')
+
+
+def split_date_range(date_from: datetime, date_to: datetime, parts: int) -> List[Tuple[str, str]]:
+    # splits date range into adjacent sub-ranges (as iso dates with Z suffix, as expected by data.bn.org.pl)
+    parts = max(parts, 1)
+    step = (date_to - date_from) / parts
+    boundaries = [date_from + step * i for i in range(parts)] + [date_to]
+
+    return [(sub_from.isoformat(timespec='seconds') + 'Z', sub_to.isoformat(timespec='seconds') + 'Z')
+            for sub_from, sub_to in zip(boundaries, boundaries[1:])]